@@ -0,0 +1,173 @@
+from threading import Lock, Semaphore
+from contextlib import contextmanager
+
+import config
+import progressbus
+
+# bounds the number of unfinished jobs admitted per priority, rejecting jobs
+# over that with OverCapacity, the number of PASIR ticket fetches running
+# at the same time per priority, making further fetches wait, and the number
+# of progress subscriptions open, rejecting further ones
+
+PRIORITIES = ['interactive', 'batch']
+
+class OverCapacity(Exception):
+   def __init__(self, priority, retry_after):
+      Exception.__init__(self,
+         'Server is over capacity for %s jobs, retry after %d seconds' % (priority, retry_after))
+      self.priority = priority
+      self.retry_after = retry_after
+
+
+class TooManySubscriptions(OverCapacity):
+   def __init__(self, retry_after):
+      Exception.__init__(self,
+         'Server is over capacity for progress subscriptions, retry after %d seconds' % retry_after)
+      self.priority = None
+      self.retry_after = retry_after
+
+
+class Slot:
+# capacity taken by one job, bound to the job's uid once it is created
+
+   def __init__(self, controller, priority):
+      self.controller = controller
+      self.priority = priority
+      self.uid = None
+
+   def bind(self, uid):
+      self.controller.bind(self, uid)
+
+   def release(self):
+      self.controller.release(self)
+
+
+class _AdmissionController:
+
+   def __init__(self):
+      self.lock = Lock()
+      self.limits = {
+         'interactive': config.MAX_JOBS_INTERACTIVE,
+         'batch': config.MAX_JOBS_BATCH}
+      self.slots = dict((priority, set()) for priority in PRIORITIES)
+      self.jobs = {}
+      self.admitted = dict((priority, 0) for priority in PRIORITIES)
+      self.rejected = dict((priority, 0) for priority in PRIORITIES)
+
+   def admit(self, priority):
+      if not priority in PRIORITIES: raise Exception('Unknown priority %s' % priority)
+      self.reconcile()
+      with self.lock:
+         limit = self.limits[priority]
+         if limit > 0 and len(self.slots[priority]) >= limit:
+            self.rejected[priority] += 1
+            raise OverCapacity(priority, config.RETRY_AFTER_SEC)
+         slot = Slot(self, priority)
+         self.slots[priority].add(slot)
+         self.admitted[priority] += 1
+         return slot
+
+   def bind(self, slot, uid):
+      with self.lock:
+         slot.uid = uid
+         self.jobs[uid] = slot
+
+   def release(self, slot):
+      with self.lock:
+         self.slots[slot.priority].discard(slot)
+         if slot.uid != None: self.jobs.pop(slot.uid, None)
+
+   def job_finished(self, uid):
+      slot = self.jobs.get(uid)
+      if slot != None: self.release(slot)
+
+   # jobs run by worker processes finish elsewhere and jobs may finish
+   # without passing job_finished(), release those that have finished or
+   # were deleted since
+   def reconcile(self):
+      uids = self.jobs.keys()
+      if len(uids) == 0: return
+      running = set([event['uid'] for event in progressbus.read_statuses(uids)
+         if not progressbus.is_terminal(event['status'])])
+      for uid in uids:
+         if not uid in running: self.job_finished(uid)
+
+   def get_load(self):
+      with self.lock:
+         return dict((priority, {
+            'jobs': len(self.slots[priority]),
+            'max_jobs': self.limits[priority],
+            'fetches': _fetch_counts[priority],
+            'max_fetches': _fetch_limits[priority],
+            'admitted': self.admitted[priority],
+            'rejected': self.rejected[priority]}) for priority in PRIORITIES)
+
+_controller = _AdmissionController()
+
+_fetch_limits = {
+   'interactive': config.MAX_FETCHES_INTERACTIVE,
+   'batch': config.MAX_FETCHES_BATCH}
+_fetch_slots = dict((priority, Semaphore(_fetch_limits[priority])) for priority in PRIORITIES)
+_fetch_counts = dict((priority, 0) for priority in PRIORITIES)
+_fetch_counts_lock = Lock()
+
+# takes capacity for a job of priority or raises OverCapacity, bind the slot
+# to the job's uid once created, or release it if the job isn't created
+def admit(priority):
+   return _controller.admit(priority)
+
+# admits a job for the with block, which binds the slot to the job created,
+# releasing it if the block fails, e.g.
+#    with admission.admitted('interactive') as slot:
+#       job = ...
+#       slot.bind(job.uid)
+@contextmanager
+def admitted(priority):
+   slot = admit(priority)
+   try:
+      yield slot
+   except:
+      slot.release()
+      raise
+
+# invoked as a job reaches a terminal status
+def job_finished(uid):
+   _controller.job_finished(uid)
+
+_subscription_slots = Semaphore(config.MAX_PROGRESS_SUBSCRIPTIONS)
+_subscription_count = [0]
+_subscription_lock = Lock()
+
+# takes capacity for a progress stream or long-poll, which holds an HTTP
+# thread while open, or raises TooManySubscriptions; returns the function
+# releasing it, which may be called more than once
+def subscribe():
+   if not _subscription_slots.acquire(False):
+      raise TooManySubscriptions(config.RETRY_AFTER_SEC)
+   with _subscription_lock: _subscription_count[0] += 1
+   released = []
+   def release():
+      with _subscription_lock:
+         if len(released) > 0: return
+         released.append(True)
+         _subscription_count[0] -= 1
+      _subscription_slots.release()
+   return release
+
+def get_subscriptions():
+   return {'subscriptions': _subscription_count[0],
+      'max_subscriptions': config.MAX_PROGRESS_SUBSCRIPTIONS}
+
+# waits for a fetch slot of priority, to be used as 'with fetch_slot(p):'
+@contextmanager
+def fetch_slot(priority):
+   _fetch_slots[priority].acquire()
+   with _fetch_counts_lock: _fetch_counts[priority] += 1
+   try:
+      yield
+   finally:
+      with _fetch_counts_lock: _fetch_counts[priority] -= 1
+      _fetch_slots[priority].release()
+
+def get_load():
+   return _controller.get_load()
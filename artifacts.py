@@ -0,0 +1,67 @@
+import os
+import gzip
+import shutil
+
+import config
+import logpipe
+
+# retention of a job's work dir once the job is done, see ARTIFACT_RETENTION:
+# the intermediates the model type declares are deleted and the CSVs read
+# and written by the classifier are replaced by <name>.gz, which find() and
+# open_output() resolve transparently
+
+_chunk_size = 1024*1024
+
+# gzips path in place, returns the bytes saved
+def compress(path):
+   gz_path = path + '.gz'
+   part_path = gz_path + '.part'
+   size = os.path.getsize(path)
+   try:
+      with open(path, 'rb') as f_in:
+         with gzip.open(part_path, 'wb', 6) as f_out:
+            shutil.copyfileobj(f_in, f_out, _chunk_size)
+      os.rename(part_path, gz_path)
+   finally:
+      if os.path.exists(part_path): os.remove(part_path)
+   os.remove(path)
+   return size - os.path.getsize(gz_path)
+
+# applies the retention policy to the work dir of a job that is done,
+# intermediates being names relative to it and outputs full paths
+def compact(job_context, intermediates, outputs):
+   if config.ARTIFACT_RETENTION == 'keep': return
+   saved = 0
+   try:
+      for name in intermediates:
+         path = os.path.join(job_context.work_dir, name)
+         if os.path.exists(path):
+            saved += os.path.getsize(path)
+            os.remove(path)
+      for path in outputs:
+         if os.path.exists(path): saved += compress(path)
+      job_context.logger.info('Artifacts compacted, %d bytes freed' % saved)
+      job_context.record_usage()
+   except Exception as e:
+      job_context.logger.exception('Failed to compact artifacts')
+   finally:
+      # compaction runs after the job has finished and its log was released
+      logpipe.release(job_context.log_path)
+
+# (path, compressed) of an output as written by the classifier or as
+# compacted, or None if it exists neither way
+def find(path):
+   if os.path.exists(path): return path, False
+   if os.path.exists(path + '.gz'): return path + '.gz', True
+   return None
+
+# iterates over the uncompressed content of an output found by find()
+def open_output(path, compressed):
+   f = gzip.open(path, 'rb') if compressed else open(path, 'rb')
+   try:
+      while True:
+         chunk = f.read(_chunk_size)
+         if not chunk: break
+         yield chunk
+   finally:
+      f.close()
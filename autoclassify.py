@@ -0,0 +1,95 @@
+from threading import Thread
+import time
+import logging
+import datetime
+
+import store
+import pasir
+import jobqueue
+import admission
+import warmup
+
+class AutoclassifyThread(Thread):
+   
+   def __init__(self, name, client_id, data_source, interval_sec, lookback_days):
+      Thread.__init__(self)
+      self.name = name
+      self.client_id = client_id
+      self.data_source = data_source
+      self.interval_sec = interval_sec
+      self.lookback_days = lookback_days
+      self.setDaemon(True)
+      self.job_timeout_sec = 6*60*60 # 6 hours
+      self.first_poll = True
+      self.classifier_uid = None
+   
+   def run(self):
+      logging.info('Setting up Autoclassify [%s] for client %s, data source %s every %d seconds' % 
+         (self.name, self.client_id, self.data_source, self.interval_sec))
+      while True:
+         # poll once across all processes sharing classr.db
+         if jobqueue.lead('autoclassify:%s' % self.name, 2*self.interval_sec + self.job_timeout_sec):
+            self.poll()
+         time.sleep(self.interval_sec)
+   
+   def poll(self):
+      try:
+         # wait a bit, if running right after server startup
+         if self.first_poll:
+            time.sleep(7)
+            self.first_poll = False
+         classifier = store.Classifier.get_active('PASIR')
+         if classifier == None:
+            logging.info('Autoclassify [%s] found no enabled PASIR classifier' % self.name)
+            return
+         # keep the model of the active classifier warm between polls
+         if classifier.uid != self.classifier_uid:
+            self.classifier_uid = classifier.uid
+            warmup.request(classifier.uid)
+         # look back a few days for tickets not classified yet, the ones that
+         # arrived late within WATERMARK_LOOKBACK_DAYS behind the watermark
+         # included
+         to_timestamp = datetime.datetime.combine(datetime.date.today(), datetime.time())
+         from_timestamp = to_timestamp - datetime.timedelta(days=self.lookback_days)
+         with admission.fetch_slot('batch'):
+            in_tickets, fetch_from, fetched_on = pasir.fetch_tickets(
+               classifier = classifier,
+               client_id = self.client_id,
+               data_source = self.data_source,
+               from_timestamp = from_timestamp,
+               to_timestamp = to_timestamp,
+               incremental = True)
+         if in_tickets.shape[0] == 0:
+            # nothing new, just move the watermark up to this poll
+            pasir.PasirWatermark.advance(self.client_id, self.data_source, classifier.uid,
+               from_timestamp, min(to_timestamp + datetime.timedelta(days=1), fetched_on))
+            return
+         logging.info('Autoclassify [%s] found %d new ticket(s)' % (self.name, in_tickets.shape[0]))
+         with admission.admitted('batch') as slot:
+            classification = pasir.PasirTicketClassification.create(
+               classifier = classifier,
+               client_id = self.client_id,
+               data_source = self.data_source,
+               from_timestamp = from_timestamp,
+               to_timestamp = to_timestamp,
+               incremental = True,
+               priority = 'batch')
+            slot.bind(classification.job_context.uid)
+         if jobqueue.dispatching():
+            # a worker fetches the unclassified tickets again
+            pasir.launch(classification)
+            finished = jobqueue.wait(classification.job_context.uid, self.job_timeout_sec)
+         else:
+            classification.fetch_from = fetch_from
+            classification.fetched_on = fetched_on
+            classification.classify_tickets(in_tickets)
+            finished = classification.wait(self.job_timeout_sec)
+         # finish the batch before polling again
+         if not finished:
+            logging.warning('Autoclassify [%s] job %s still running after %d hours, polling again' % 
+               (self.name, classification.job_context.uid, self.job_timeout_sec/3600))
+      except admission.OverCapacity as e:
+         logging.warning('Autoclassify [%s] skips this poll: %s' % (self.name, str(e)))
+      except Exception as e:
+         logging.exception('Autoclassify [%s] encountered an error, polling again in %d seconds' % 
+            (self.name, self.interval_sec))
@@ -1,45 +1,156 @@
-from threading import Thread, Timer
+from threading import Thread, Lock
 import time
 import logging
 import datetime
+import os
+import re
 
+import config
 import store
+import jobqueue
+
+# removes finished jobs (done, failed or cancelled) older than
+# clean_jobs_after_days, and once the file system of WORK_PATH or TEMP_PATH
+# fills up past DISK_HIGH_WATER_PCT, cached tarballs and the least recently
+# used finished jobs until it is back at DISK_LOW_WATER_PCT; resource dirs and
+# blobs no resource refers to, and stale downloads, are removed either way
+
+# temp files of resource downloads: <uid>.tar.gz archives cached by
+# Resource.to_targz, remote-<uid>.tar.gz fetched from remotes and the
+# <uuid>.part files of unfinished ones; TEMP_PATH may be shared, so nothing
+# else is touched
+_targz_pattern = re.compile(
+   r'^(?P<remote>remote-)?(?P<uid>.+)\.tar\.gz(?P<part>\.[0-9a-f-]{36}\.part)?$')
+
+# files still being written are left alone this long
+_temp_grace_sec = 60*60
+
+# percentage of the file system of path in use
+def disk_usage_pct(path):
+   st = os.statvfs(path)
+   if st.f_blocks == 0: return 0.0
+   return 100.0 * (st.f_blocks - st.f_bavail) / st.f_blocks
+
 
 class AutocleanThread(Thread):
-   
+
    def __init__(self, clean_jobs_after_days):
       Thread.__init__(self)
       self.clean_jobs_after_days = clean_jobs_after_days
       self.setDaemon(True)
-      self.interval_sec = 60*60*24 # 24 hours
-   
+      self.interval_sec = config.AUTOCLEAN_INTERVAL_SEC
+      self.high_water_pct = config.DISK_HIGH_WATER_PCT
+      self.low_water_pct = config.DISK_LOW_WATER_PCT
+      self.batch_size = 100
+      self.lock = Lock()
+      self.statistics = {
+         'runs': 0,
+         'jobs_removed': 0,
+         'files_removed': 0,
+         'bytes_reclaimed': 0,
+         'last_run_on': None,
+         'last_run_bytes_reclaimed': 0}
+
    def run(self):
-      logging.info('Setting up Autoclean for job data older than %d days' % 
-         self.clean_jobs_after_days)
-      while self.clean_jobs_after_days > 0:
-         logging.info('Autoclean scheduled next cleanup in %d hours' % 
-            (self.interval_sec/3600))
+      logging.info('Setting up Autoclean for job data older than %d days, '
+         'disk high/low water marks %d/%d%%, checking every %d seconds' %
+         (self.clean_jobs_after_days, self.high_water_pct, self.low_water_pct,
+         self.interval_sec))
+      while True:
          time.sleep(self.interval_sec)
-         self.cleanup()
-   
+         # clean up once across all processes sharing classr.db
+         if jobqueue.lead('autoclean', 2*self.interval_sec):
+            self.cleanup()
+
    def cleanup(self):
+      self.jobs_removed = 0
+      self.files_removed = 0
+      self.bytes_reclaimed = 0
       try:
-         logging.info('Autoclean starts to clean old jobs now')
-         # fetch list of job contexts
-         job_contexts = store.JobContext.get_all()
-         removed_jobs = 0
-         for job in job_contexts:
-            job_age = (datetime.datetime.now() - 
-               datetime.datetime.strptime(str(job.created_on),
-                  '%Y-%m-%d %H:%M:%S.%f'))
-            if (job.status == 'Done' and
-               job_age.days >= self.clean_jobs_after_days):
-               job.remove()
-               removed_jobs += 1
-         logging.info('Autoclean removed %d jobs older than %d days' % 
-            (removed_jobs, self.clean_jobs_after_days))
+         if self.clean_jobs_after_days > 0: self.remove_old_jobs()
+         self.bytes_reclaimed += store.Resource.cleanup()
+         self.clean_temp()
+         if self.high_water_pct > 0: self.evict_jobs()
       except Exception as e:
          logging.exception('Autoclean encountered an error, exits cleanup')
+      with self.lock:
+         self.statistics['runs'] += 1
+         self.statistics['jobs_removed'] += self.jobs_removed
+         self.statistics['files_removed'] += self.files_removed
+         self.statistics['bytes_reclaimed'] += self.bytes_reclaimed
+         self.statistics['last_run_on'] = str(datetime.datetime.now())
+         self.statistics['last_run_bytes_reclaimed'] = self.bytes_reclaimed
+      if self.jobs_removed > 0 or self.files_removed > 0:
+         logging.info('Autoclean removed %d jobs and %d temp files, reclaiming %d bytes' %
+            (self.jobs_removed, self.files_removed, self.bytes_reclaimed))
+
+   def remove_job(self, uid, size):
+      job = store.JobContext.get(uid)
+      if job == None: return
+      # jobs finished before sizes were recorded
+      if size == None: size = store.dir_size(job.work_dir)
+      job.remove()
+      self.jobs_removed += 1
+      self.bytes_reclaimed += size
+
+   def remove_old_jobs(self):
+      created_before = str(datetime.datetime.now() -
+         datetime.timedelta(days=self.clean_jobs_after_days))
+      while True:
+         candidates = store.JobContext.get_finished(self.batch_size, created_before)
+         for uid, size in candidates: self.remove_job(uid, size)
+         if len(candidates) < self.batch_size: break
 
+   def over_water(self, path, mark_pct):
+      return disk_usage_pct(path) > mark_pct
 
+   # removes the job dirs least recently used first
+   def evict_jobs(self):
+      if not self.over_water(config.WORK_PATH, self.high_water_pct): return
+      logging.warning('Autoclean found %s %.1f%% full, evicting jobs' %
+         (config.WORK_PATH, disk_usage_pct(config.WORK_PATH)))
+      while self.over_water(config.WORK_PATH, self.low_water_pct):
+         candidates = store.JobContext.get_finished(self.batch_size)
+         if len(candidates) == 0:
+            logging.warning('Autoclean has no finished jobs left to evict')
+            return
+         for uid, size in candidates:
+            self.remove_job(uid, size)
+            if not self.over_water(config.WORK_PATH, self.low_water_pct): return
+
+   # removes stale downloads, and cached tarballs least recently used first
+   # while TEMP_PATH is over water
+   def clean_temp(self):
+      now = time.time()
+      cached = []
+      for name in os.listdir(config.TEMP_PATH):
+         match = _targz_pattern.match(name)
+         if match == None: continue
+         path = os.path.join(config.TEMP_PATH, name)
+         try: st = os.stat(path)
+         except OSError: continue
+         if match.group('part') != None or match.group('remote') != None:
+            if now - st.st_mtime >= _temp_grace_sec: self.remove_temp(path)
+         elif store.Resource.exists(match.group('uid')):
+            cached.append((max(st.st_atime, st.st_mtime), path))
+      if self.high_water_pct == 0: return
+      if not self.over_water(config.TEMP_PATH, self.high_water_pct): return
+      for accessed, path in sorted(cached):
+         if not self.over_water(config.TEMP_PATH, self.low_water_pct): return
+         self.remove_temp(path)
+
+   def remove_temp(self, path):
+      try:
+         size = os.path.getsize(path)
+         os.remove(path)
+      except OSError:
+         return
+      self.files_removed += 1
+      self.bytes_reclaimed += size
 
+   def get_statistics(self):
+      with self.lock:
+         statistics = dict(self.statistics)
+      statistics['work_path_usage_pct'] = round(disk_usage_pct(config.WORK_PATH), 1)
+      statistics['temp_path_usage_pct'] = round(disk_usage_pct(config.TEMP_PATH), 1)
+      return statistics
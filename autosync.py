@@ -3,6 +3,8 @@ import time
 import logging
 
 import store
+import jobqueue
+import warmup
 
 class AutosyncThread(Thread):
    
@@ -19,7 +21,11 @@ class AutosyncThread(Thread):
    def run(self):
       logging.info('Setting up Autosync [%s] with %s for %s models' % (self.name, self.url, str.join(', ', self.sync_model_types)))
       while True:
-         self.sync()
+         # sync once across all processes sharing classr.db
+         if jobqueue.lead('autosync:%s' % self.name, 2*self.interval_sec):
+            self.sync()
+         else:
+            logging.info('Autosync [%s] is run by another process' % self.name)
          logging.info('Autosync [%s] scheduled next sync in %d hours' % (self.name, self.interval_sec/3600))
          time.sleep(self.interval_sec)
 
@@ -51,6 +57,7 @@ class AutosyncThread(Thread):
             for remote_classifier in to_fetch:
                logging.info('Autosync [%s] starts to fetch classifier %s' % (self.name, remote_classifier.uid))
                self.remote.fetch_classifier(remote_classifier.uid)
+               warmup.request(remote_classifier.uid)
       except Exception as e:
          logging.exception('Autosync [%s] encountered an error, exits syncing' % self.name)
 
@@ -0,0 +1,74 @@
+"""Load test for a running Classr API.
+
+Fires concurrent JSON-RPC calls (and optionally resource/job downloads) at a
+server and reports throughput and latency percentiles. Run it once against a
+server started with HTTP_SERVER = werkzeug and once with HTTP_SERVER = waitress
+to compare the two, e.g.
+
+   python benchmarks/loadtest.py --url http://localhost:8080/api \\
+      --concurrency 50 --requests 2000 --method job.get_all
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+
+import requests
+
+def percentile(values, p):
+   if len(values) == 0: return 0.0
+   values = sorted(values)
+   return values[min(len(values)-1, int(round(p/100.0*(len(values)-1))))]
+
+def worker(args, count, latencies, errors, lock):
+   session = requests.Session()
+   auth = ('api', args.key) if args.key != '' else None
+   for i in xrange(count):
+      start = time.time()
+      try:
+         if args.download != '':
+            r = session.get('%s/%s' % (args.url, args.download), stream=True, auth=auth)
+            for chunk in r.iter_content(chunk_size=65536): pass
+         else:
+            payload = {'method': args.method, 'params': json.loads(args.params),
+               'jsonrpc': '2.0', 'id': str(uuid.uuid1())}
+            r = session.post(args.url, data=json.dumps(payload), auth=auth,
+               headers={'content-type': 'application/json'})
+         ok = r.status_code == 200
+      except Exception:
+         ok = False
+      elapsed = time.time() - start
+      with lock:
+         if ok: latencies.append(elapsed)
+         else: errors[0] += 1
+
+def main():
+   parser = argparse.ArgumentParser(description='Classr API load test')
+   parser.add_argument('--url', default='http://localhost:8080/api')
+   parser.add_argument('--key', default='')
+   parser.add_argument('--method', default='classifier.get_all')
+   parser.add_argument('--params', default='[]', help='JSON list of params')
+   parser.add_argument('--download', default='', 
+      help='GET <url>/<download> instead, e.g. resource.download/<uid>')
+   parser.add_argument('--concurrency', type=int, default=20)
+   parser.add_argument('--requests', type=int, default=1000)
+   args = parser.parse_args()
+   latencies = []
+   errors = [0]
+   lock = threading.Lock()
+   per_worker = max(1, args.requests / args.concurrency)
+   threads = [threading.Thread(target=worker, args=(args, per_worker, latencies, errors, lock))
+      for i in xrange(args.concurrency)]
+   start = time.time()
+   for t in threads: t.start()
+   for t in threads: t.join()
+   elapsed = time.time() - start
+   print('requests     : %d ok, %d failed' % (len(latencies), errors[0]))
+   print('elapsed      : %.2f s' % elapsed)
+   print('throughput   : %.1f req/s' % (len(latencies) / elapsed))
+   for p in [50, 95, 99]:
+      print('latency p%-3d : %.1f ms' % (p, percentile(latencies, p)*1000))
+
+if __name__ == '__main__':
+   main()
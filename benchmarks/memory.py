@@ -0,0 +1,114 @@
+"""Memory benchmark for loading PV weights and vocabularies.
+
+Starts a number of worker-like processes that each load the same resource
+files, either parsing the text files into their own memory or opening the
+binary format written by pvformat.convert() through mmap, and reports their
+resident and proportional set sizes while all of them are up, e.g.
+
+   python benchmarks/memory.py --workers 4 resources/pv/weights.txt resources/vocab/vocab.txt
+
+Files are converted first if they haven't been yet. The proportional set
+size (Linux only) splits pages shared through the page cache among the
+processes mapping them, which is where mmap saves memory. With --precision
+int8 or float16 the compact variants of the weights are loaded as well.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# runs in each child interpreter, loads the files, touches every page and
+# waits for stdin to be closed
+probe = """
+import os, sys
+import pvformat
+import numpy as np
+held = []
+for path in %(paths)r:
+   is_vocabulary = os.path.basename(path) == 'vocab.txt'
+   if %(mmap)s:
+      if is_vocabulary:
+         vocabulary = pvformat.open_vocabulary(path)
+         held.append(vocabulary)
+         int(vocabulary.tokens.sum()) + int(vocabulary.offsets.sum()) + int(vocabulary.sorted.sum())
+      else:
+         weights = pvformat.open_weights(path, %(precision)r)
+         held.append(weights)
+         # the int8 values as mapped, not dequantized
+         float(getattr(weights, 'values', weights).sum())
+   else:
+      if is_vocabulary:
+         held.append(dict((line.split()[0], i) for i, line in enumerate(open(path, 'rb')) if line.strip()))
+      else:
+         rows = {}
+         for line in open(path, 'rb'):
+            fields = line.replace(',', ' ').split()
+            if len(fields) > 2: rows[fields[0]] = np.array(fields[1:], dtype=np.float32)
+         held.append(rows)
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+def memory_kb(pid):
+   result = {'rss': None, 'pss': None}
+   with open('/proc/%d/status' % pid) as f:
+      for line in f:
+         if line.startswith('VmRSS:'): result['rss'] = int(line.split()[1])
+   try:
+      with open('/proc/%d/smaps_rollup' % pid) as f:
+         for line in f:
+            if line.startswith('Pss:'): result['pss'] = int(line.split()[1])
+   except IOError:
+      pass
+   return result
+
+def run(paths, workers, mmap, precision='float32'):
+   code = probe % {'paths': paths, 'mmap': mmap, 'precision': precision}
+   processes = [subprocess.Popen([sys.executable, '-c', code], cwd=repo_dir,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE) for i in range(workers)]
+   try:
+      for process in processes:
+         if process.stdout.readline().strip() != 'ready':
+            raise Exception('worker %d failed to load the files' % process.pid)
+      return [memory_kb(process.pid) for process in processes]
+   finally:
+      for process in processes:
+         process.stdin.close()
+         process.wait()
+
+def report(name, results):
+   rss = sum([result['rss'] for result in results])
+   line = '%s: RSS %d MB per worker, %d MB total' % (name, rss/1024/len(results), rss/1024)
+   if all([result['pss'] != None for result in results]):
+      line += ', PSS %d MB total' % (sum([result['pss'] for result in results])/1024)
+   print(line)
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument('paths', nargs='+', help='text weights files or vocab.txt files')
+   parser.add_argument('--workers', type=int, default=4)
+   parser.add_argument('--precision', action='append', default=[],
+      help='also load a compact variant of the weights, float16 or int8')
+   args = parser.parse_args()
+   sys.path.insert(0, repo_dir)
+   import pvformat
+   paths = [os.path.realpath(path) for path in args.paths]
+   for path in paths:
+      if pvformat.has_binary(path): continue
+      if os.path.basename(path) == 'vocab.txt': pvformat.convert_vocabulary(path)
+      else: pvformat.convert_weights(path)
+   for precision in args.precision:
+      for path in paths:
+         if os.path.basename(path) != 'vocab.txt' and not pvformat.has_variant(path, precision):
+            pvformat.quantize(path, precision)
+   report('text', run(paths, args.workers, False))
+   report('mmap', run(paths, args.workers, True))
+   for precision in args.precision:
+      report('mmap %s' % precision, run(paths, args.workers, True, precision))
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,94 @@
+"""Serialization benchmark for JSON-RPC results.
+
+Encodes and decodes a job.get_all listing of 10k jobs the way the server and
+clients do in the legacy format (a JSON string inside the JSON-RPC response,
+decoded twice) and in the structured format (projected fields, encoded once),
+e.g.
+
+   python benchmarks/serialization.py --jobs 10000 --rounds 5
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import store
+import serialization
+
+class BenchJobContext(store.JobContext):
+   # skips creating work dirs and log files
+   def __init__(self, **attrs):
+      self.__dict__.update(attrs)
+
+def make_jobs(count):
+   jobs = []
+   for i in range(count):
+      uid = str(uuid.uuid1())
+      jobs.append(BenchJobContext(
+         uid = uid,
+         dir_name = '%s-%s' % (datetime.datetime.now().strftime('%Y%m%d%H%M%S'), uid),
+         created_on = str(datetime.datetime.now()),
+         classifier_uid = str(uuid.uuid1()),
+         status = 'Done',
+         progress_percentage = 100,
+         progress_text = 'Done',
+         aux_progress_callback = None,
+         work_dir = os.path.join('data/work', uid),
+         logger = logging.Logger('bench-%d' % i)))
+   return jobs
+
+def envelope(result):
+   return {'jsonrpc': '2.0', 'id': str(uuid.uuid1()), 'result': result}
+
+def legacy_original(jobs):
+   return json.dumps(envelope(json.dumps(jobs, cls=store.StoreJsonEncoder)))
+
+def legacy_fast(jobs):
+   return json.dumps(envelope(serialization.result(jobs, 'legacy')))
+
+def structured(jobs):
+   return json.dumps(envelope(serialization.result(jobs, 'structured')))
+
+def decode_legacy(body):
+   return json.loads(json.loads(body)['result'])
+
+def decode_structured(body):
+   return json.loads(body)['result']
+
+def measure(func, arg, rounds):
+   best = None
+   for i in range(rounds):
+      start = time.time()
+      result = func(arg)
+      elapsed = time.time() - start
+      if best == None or elapsed < best: best = elapsed
+   return best, result
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument('--jobs', type=int, default=10000)
+   parser.add_argument('--rounds', type=int, default=5)
+   args = parser.parse_args()
+   jobs = make_jobs(args.jobs)
+   print('%d jobs, best of %d rounds, fast backend: %s' %
+      (args.jobs, args.rounds, serialization.backend))
+   print('%-22s %12s %12s %12s' % ('format', 'encode (ms)', 'decode (ms)', 'bytes'))
+   for name, encode, decode in [
+      ('legacy (encoder)', legacy_original, decode_legacy),
+      ('legacy (projected)', legacy_fast, decode_legacy),
+      ('structured', structured, decode_structured)]:
+      encode_time, body = measure(encode, jobs, args.rounds)
+      decode_time, result = measure(decode, body, args.rounds)
+      assert len(result) == args.jobs
+      print('%-22s %12.1f %12.1f %12d' %
+         (name, encode_time*1000, decode_time*1000, len(body)))
+
+if __name__ == '__main__':
+   main()
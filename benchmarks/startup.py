@@ -0,0 +1,83 @@
+"""Startup time benchmark for the Classr API.
+
+Measures, each in a fresh interpreter, how long importing the server's
+modules takes and how much memory they take up, then how long initializing
+the PASIR DB2 subsystem (JVM, JDBC driver, first connection) takes on top,
+e.g.
+
+   python benchmarks/startup.py --rounds 5
+
+With --launch it starts server.py itself and measures the time until the
+HTTP listener answers.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# runs in the child interpreter, prints its timings as JSON
+probe = """
+import json, resource, time
+start = time.time()
+import config, store, pasir
+imported = time.time() - start
+rss_imported = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+init = None
+if %(init)s:
+   start = time.time()
+   pasir.init()
+   pasir.pasir_db()
+   init = time.time() - start
+print(json.dumps({'import': imported, 'init': init, 'rss_kb': rss_imported,
+   'rss_init_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+def run_probe(init):
+   output = subprocess.check_output([sys.executable, '-c', probe % {'init': init}],
+      cwd=repo_dir)
+   return json.loads(output.strip().splitlines()[-1])
+
+def launch(url, timeout_sec):
+   start = time.time()
+   process = subprocess.Popen([sys.executable, 'server.py'], cwd=repo_dir)
+   try:
+      while time.time() - start < timeout_sec:
+         try:
+            requests.get(url, timeout=1)
+            return time.time() - start
+         except requests.exceptions.RequestException:
+            time.sleep(0.1)
+      return None
+   finally:
+      process.terminate()
+      process.wait()
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument('--rounds', type=int, default=3)
+   parser.add_argument('--init', action='store_true',
+      help='also initialize the PASIR DB2 subsystem (needs DB2 access)')
+   parser.add_argument('--launch', action='store_true')
+   parser.add_argument('--url', default='http://localhost:8080/')
+   parser.add_argument('--timeout', type=int, default=300)
+   args = parser.parse_args()
+   for i in range(args.rounds):
+      result = run_probe(args.init)
+      line = 'round %d: imports %.2f s, max RSS %d MB' % (i+1, result['import'], result['rss_kb']/1024)
+      if result['init'] != None:
+         line += ', PASIR init %.2f s, max RSS %d MB' % (result['init'], result['rss_init_kb']/1024)
+      print(line)
+   if args.launch:
+      elapsed = launch(args.url, args.timeout)
+      if elapsed == None: print('server did not answer within %d s' % args.timeout)
+      else: print('server answered after %.2f s' % elapsed)
+
+if __name__ == '__main__':
+   main()
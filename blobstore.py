@@ -0,0 +1,164 @@
+import os
+import re
+import errno
+import uuid
+import time
+import hashlib
+import logging
+
+import config
+
+# content-addressed storage of resource files: each distinct file content is
+# kept once under RESOURCES_PATH/blobs/<hash[:2]>/<hash>, named by its
+# SHA-256, and the files in resource dirs are hardlinks to it; resource
+# files never change once added, so resources share blobs safely
+
+BLOBS_PATH = os.path.join(config.RESOURCES_PATH, 'blobs')
+if not os.path.exists(BLOBS_PATH): os.makedirs(BLOBS_PATH)
+
+_chunk_size = 1024*1024
+_hash_pattern = re.compile(r'^[0-9a-f]{64}$')
+
+# blobs received or linked this recently are never collected, resources
+# being added may not have been recorded yet
+_grace_sec = 60*60
+
+def valid_hash(blob_hash):
+   return _hash_pattern.match(blob_hash) != None
+
+def blob_path(blob_hash):
+   if not valid_hash(blob_hash): raise Exception('Invalid blob hash %s' % blob_hash)
+   return os.path.join(BLOBS_PATH, blob_hash[:2], blob_hash)
+
+def has(blob_hash):
+   return os.path.exists(blob_path(blob_hash))
+
+def hash_file(path):
+   sha = hashlib.sha256()
+   with open(path, 'rb') as f:
+      while True:
+         chunk = f.read(_chunk_size)
+         if not chunk: break
+         sha.update(chunk)
+   return sha.hexdigest()
+
+# a path relative to a resource dir, refusing absolute paths and paths
+# leading out of it
+def safe_relpath(path):
+   norm = os.path.normpath(path)
+   if os.path.isabs(norm) or norm == '..' or norm.startswith('..' + os.sep) or norm == '.':
+      raise Exception('Unsafe path %s' % path)
+   return norm
+
+def _makedirs(path):
+   try: os.makedirs(path)
+   except OSError as e:
+      if e.errno != errno.EEXIST: raise
+
+# replaces path with a hardlink to src
+def _replace_with_link(src, path):
+   tmp_path = '%s.%s.link' % (path, uuid.uuid1())
+   os.link(src, tmp_path)
+   os.rename(tmp_path, path)
+
+# copies the content of the file object f to path, returns (hash, size)
+def write(path, f):
+   _makedirs(os.path.dirname(path))
+   sha = hashlib.sha256()
+   size = 0
+   with open(path, 'wb') as out:
+      while True:
+         chunk = f.read(_chunk_size)
+         if not chunk: break
+         sha.update(chunk)
+         size += len(chunk)
+         out.write(chunk)
+   return sha.hexdigest(), size
+
+# stores the content of the file at path as a blob, the file becoming a link
+# to it, returns (hash, size); file systems without hardlinks keep the file
+def intern(path, blob_hash=None):
+   if blob_hash == None: blob_hash = hash_file(path)
+   size = os.path.getsize(path)
+   target = blob_path(blob_hash)
+   _makedirs(os.path.dirname(target))
+   try:
+      try:
+         os.link(path, target)
+      except OSError as e:
+         if e.errno != errno.EEXIST: raise
+         if not os.path.samefile(path, target): _replace_with_link(target, path)
+   except OSError as e:
+      logging.warning('Cannot link %s to blob %s: %s' % (path, blob_hash, e))
+   return blob_hash, size
+
+# interns the files under a resource dir but those exclude(path) is true
+# for, returns its manifest, a list of (path relative to it, hash, size)
+def intern_dir(dir_path, exclude=None):
+   manifest = []
+   for root, dirs, files in os.walk(dir_path):
+      for name in sorted(files):
+         path = os.path.join(root, name)
+         if exclude != None and exclude(path): continue
+         blob_hash, size = intern(path)
+         manifest.append((os.path.relpath(path, dir_path), blob_hash, size))
+   return manifest
+
+# links a blob to path, creating its dirs
+def link(blob_hash, path):
+   _makedirs(os.path.dirname(path))
+   os.link(blob_path(blob_hash), path)
+
+# stores the content iterated over by chunks as a blob, verifying its hash,
+# returns its size
+def receive(blob_hash, chunks):
+   target = blob_path(blob_hash)
+   _makedirs(os.path.dirname(target))
+   part_path = '%s.%s.part' % (target, uuid.uuid1())
+   sha = hashlib.sha256()
+   size = 0
+   try:
+      with open(part_path, 'wb') as f:
+         for chunk in chunks:
+            if not chunk: continue
+            sha.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+      if sha.hexdigest() != blob_hash:
+         raise Exception('Blob %s received corrupt' % blob_hash)
+      os.rename(part_path, target)
+   finally:
+      if os.path.exists(part_path): os.remove(part_path)
+   return size
+
+# removes blobs not referenced by any manifest nor linked from anywhere
+# else, only_hashes limiting the ones looked at, along with unfinished
+# downloads; returns (blobs removed, bytes reclaimed)
+def collect(referenced, only_hashes=None, grace_sec=_grace_sec):
+   removed = 0
+   reclaimed = 0
+   now = time.time()
+   if only_hashes == None:
+      candidates = []
+      for root, dirs, files in os.walk(BLOBS_PATH):
+         for name in files:
+            if valid_hash(name): candidates.append(name)
+            elif name.endswith('.part'):
+               path = os.path.join(root, name)
+               try:
+                  if now - os.path.getmtime(path) >= grace_sec: os.remove(path)
+               except OSError: pass
+   else:
+      candidates = only_hashes
+   for blob_hash in candidates:
+      if blob_hash in referenced: continue
+      path = blob_path(blob_hash)
+      try:
+         st = os.stat(path)
+         if st.st_nlink > 1 or now - st.st_ctime < grace_sec: continue
+         os.remove(path)
+      except OSError:
+         continue
+      removed += 1
+      reclaimed += st.st_size
+   return removed, reclaimed
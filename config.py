@@ -6,6 +6,8 @@ import logging.handlers
 import re
 import sys
 
+import logpipe
+
 parser = SafeConfigParser()
 config_files = parser.read(['config/defaults.cfg', 'config/%s.cfg' % socket.getfqdn()])
 
@@ -45,6 +47,140 @@ if SSL_ENABLED and (SSL_CERT == '' or SSL_PRIVATE_KEY == ''):
 try: CLEAN_JOBS_AFTER_DAYS = parser.getint('server','CLEAN_JOBS_AFTER_DAYS')
 except: CLEAN_JOBS_AFTER_DAYS = 0
 
+# once the file system of WORK_PATH or TEMP_PATH is more than
+# DISK_HIGH_WATER_PCT percent full, autoclean removes cached tarballs and
+# the least recently used finished jobs until it is at most DISK_LOW_WATER_PCT
+# percent full; evicted jobs take their results with them, so it is off (0)
+# unless set, e.g. to 90 along with DISK_LOW_WATER_PCT = 80
+try: DISK_HIGH_WATER_PCT = parser.getint('server','DISK_HIGH_WATER_PCT')
+except: DISK_HIGH_WATER_PCT = 0
+
+try: DISK_LOW_WATER_PCT = parser.getint('server','DISK_LOW_WATER_PCT')
+except: DISK_LOW_WATER_PCT = 80
+
+try: AUTOCLEAN_INTERVAL_SEC = parser.getint('server','AUTOCLEAN_INTERVAL_SEC')
+except: AUTOCLEAN_INTERVAL_SEC = 300
+
+# 'waitress': buffers requests and streams responses on an async I/O loop,
+#             handing complete requests over to HTTP_THREADS worker threads,
+#             progress streams and long-polls holding one each while open
+# 'werkzeug': Flask's development server, one thread per connection
+try: HTTP_SERVER = parser.get('server','HTTP_SERVER')
+except: HTTP_SERVER = 'waitress'
+
+try: HTTP_THREADS = parser.getint('server','HTTP_THREADS')
+except: HTTP_THREADS = 32
+
+try: HTTP_CONNECTION_LIMIT = parser.getint('server','HTTP_CONNECTION_LIMIT')
+except: HTTP_CONNECTION_LIMIT = 100
+
+# seconds an idle (keep-alive) connection is kept open
+try: HTTP_CHANNEL_TIMEOUT = parser.getint('server','HTTP_CHANNEL_TIMEOUT')
+except: HTTP_CHANNEL_TIMEOUT = 120
+
+try: HTTP_BACKLOG = parser.getint('server','HTTP_BACKLOG')
+except: HTTP_BACKLOG = 1024
+
+try: HTTP_MAX_REQUEST_BODY_MB = parser.getint('server','HTTP_MAX_REQUEST_BODY_MB')
+except: HTTP_MAX_REQUEST_BODY_MB = 16384
+
+# unfinished jobs admitted per priority, further ones are rejected with a
+# hint to retry after RETRY_AFTER_SEC (0 admits any number); job.place and
+# pasir.classify are interactive, pasir.classify_batch and autoclassify batch
+try: MAX_JOBS_INTERACTIVE = parser.getint('server','MAX_JOBS_INTERACTIVE')
+except: MAX_JOBS_INTERACTIVE = 100
+
+try: MAX_JOBS_BATCH = parser.getint('server','MAX_JOBS_BATCH')
+except: MAX_JOBS_BATCH = 20
+
+try: RETRY_AFTER_SEC = parser.getint('server','RETRY_AFTER_SEC')
+except: RETRY_AFTER_SEC = 30
+
+# PASIR ticket fetches running at the same time per priority, others wait
+try: MAX_FETCHES_INTERACTIVE = parser.getint('server','MAX_FETCHES_INTERACTIVE')
+except: MAX_FETCHES_INTERACTIVE = 4
+
+try: MAX_FETCHES_BATCH = parser.getint('server','MAX_FETCHES_BATCH')
+except: MAX_FETCHES_BATCH = 2
+
+# comma-separated model types to import at startup rather than on first use
+try: PRELOAD_MODEL_TYPES = [t for t in parser.get('server','PRELOAD_MODEL_TYPES').split(',') if t != '']
+except: PRELOAD_MODEL_TYPES = []
+
+# the models of enabled classifiers are warmed up in the background at
+# startup, used most in the last PREWARM_USAGE_DAYS first, and as classifiers
+# are fetched or enabled, keeping up to MODEL_WARM_BUDGET_MB of them warm;
+# off by default, as no model type in this tree can load() a model yet, for
+# XGBM only the resource files are pre-read into the page cache
+try: PREWARM_MODELS = parser.getboolean('server','PREWARM_MODELS')
+except: PREWARM_MODELS = False
+
+try: MODEL_WARM_BUDGET_MB = parser.getint('server','MODEL_WARM_BUDGET_MB')
+except: MODEL_WARM_BUDGET_MB = 2048
+
+try: PREWARM_USAGE_DAYS = parser.getint('server','PREWARM_USAGE_DAYS')
+except: PREWARM_USAGE_DAYS = 7
+
+# jobs are queued in classr.db and run by this many worker processes, each
+# running up to PARALLEL_JOBS of them (0 runs jobs within the server process)
+try: WORKER_PROCESSES = parser.getint('server','WORKER_PROCESSES')
+except: WORKER_PROCESSES = 0
+
+# how often idle workers look for queued jobs
+try: QUEUE_POLL_INTERVAL_SEC = parser.getfloat('server','QUEUE_POLL_INTERVAL_SEC')
+except: QUEUE_POLL_INTERVAL_SEC = 1.0
+
+# workers not heard of for 6 heartbeats are considered dead, their jobs are
+# either queued again or failed
+try: WORKER_HEARTBEAT_SEC = parser.getint('server','WORKER_HEARTBEAT_SEC')
+except: WORKER_HEARTBEAT_SEC = 10
+
+# offload jobs to the [autosync:*] remotes while more jobs are unfinished
+# than run at a time, see federation; their load is polled this often
+try: FEDERATION = parser.getboolean('server','FEDERATION')
+except: FEDERATION = False
+
+try: FEDERATION_POLL_SEC = parser.getint('server','FEDERATION_POLL_SEC')
+except: FEDERATION_POLL_SEC = 10
+
+try: FEDERATION_TIMEOUT_SEC = parser.getint('server','FEDERATION_TIMEOUT_SEC')
+except: FEDERATION_TIMEOUT_SEC = 60
+
+# job progress streams buffer the latest update of up to this many jobs per
+# subscriber, sending a heartbeat when idle; each stream holds an HTTP thread
+try: PROGRESS_STREAM_BUFFER = parser.getint('server','PROGRESS_STREAM_BUFFER')
+except: PROGRESS_STREAM_BUFFER = 100
+
+try: PROGRESS_HEARTBEAT_SEC = parser.getint('server','PROGRESS_HEARTBEAT_SEC')
+except: PROGRESS_HEARTBEAT_SEC = 15
+
+# progress of jobs run by worker processes is read from classr.db this often
+try: PROGRESS_POLL_INTERVAL_SEC = parser.getfloat('server','PROGRESS_POLL_INTERVAL_SEC')
+except: PROGRESS_POLL_INTERVAL_SEC = 1.0
+
+# longest job.wait_status call
+try: PROGRESS_WAIT_MAX_SEC = parser.getint('server','PROGRESS_WAIT_MAX_SEC')
+except: PROGRESS_WAIT_MAX_SEC = 60
+
+# progress streams and job.wait_status calls open at the same time, further
+# ones are rejected with a hint to retry after RETRY_AFTER_SEC, so they never
+# take up all HTTP_THREADS
+try: MAX_PROGRESS_SUBSCRIPTIONS = parser.getint('server','MAX_PROGRESS_SUBSCRIPTIONS')
+except: MAX_PROGRESS_SUBSCRIPTIONS = max(1, HTTP_THREADS / 4)
+
+if HTTP_SERVER not in ['waitress', 'werkzeug']:
+	raise Exception('HTTP_SERVER must be either "waitress" or "werkzeug", got "%s"' % HTTP_SERVER)
+if MAX_FETCHES_INTERACTIVE < 1 or MAX_FETCHES_BATCH < 1:
+	raise Exception('MAX_FETCHES_INTERACTIVE and MAX_FETCHES_BATCH must be at least 1')
+if WORKER_PROCESSES < 0:
+	raise Exception('WORKER_PROCESSES must not be negative')
+if MAX_PROGRESS_SUBSCRIPTIONS < 1 or (HTTP_SERVER == 'waitress' and MAX_PROGRESS_SUBSCRIPTIONS >= HTTP_THREADS):
+	raise Exception('MAX_PROGRESS_SUBSCRIPTIONS must be at least 1 and below HTTP_THREADS')
+if DISK_HIGH_WATER_PCT > 0 and not 0 <= DISK_LOW_WATER_PCT < DISK_HIGH_WATER_PCT <= 100:
+	raise Exception('DISK_LOW_WATER_PCT must be below DISK_HIGH_WATER_PCT, which must be at most 100')
+if AUTOCLEAN_INTERVAL_SEC < 1:
+	raise Exception('AUTOCLEAN_INTERVAL_SEC must be at least 1')
+
 # [data]
 try: LOG_PATH = parser.get('data','LOG_PATH')
 except: LOG_PATH = 'logs'
@@ -62,6 +198,21 @@ try: WORK_PATH = parser.get('data','WORK_PATH')
 except: WORK_PATH = 'data/work'
 if not os.path.exists(WORK_PATH): os.makedirs(WORK_PATH)
 
+# what is kept of a job's work dir once the job is done
+# 'compact': intermediates the model type declares are deleted, the input
+#            and output CSVs are gzipped in place
+# 'keep'   : everything is kept as is
+try: ARTIFACT_RETENTION = parser.get('data','ARTIFACT_RETENTION')
+except: ARTIFACT_RETENTION = 'compact'
+if ARTIFACT_RETENTION not in ['compact', 'keep']:
+	raise Exception('ARTIFACT_RETENTION must be either "compact" or "keep", got "%s"' % ARTIFACT_RETENTION)
+
+# whether text files of pv and vocab resources are converted to the binary
+# format of pvformat as resources are added; no model type in this tree
+# reads it yet (XGBM parses the text files), so it only takes up disk space
+try: CONVERT_RESOURCES = parser.getboolean('data','CONVERT_RESOURCES')
+except: CONVERT_RESOURCES = False
+
 # [pasir]
 try: DB2_URL = parser.get('pasir','DB2_URL')
 except: DB2_URL = ''
@@ -93,9 +244,25 @@ except: SQL_UPDATE_TICKET_COUNT = 'sql/update-classifier-ticket_count.sql'
 try: SQL_UPDATE_PROGRESS = parser.get('pasir','SQL_UPDATE_PROGRESS')
 except: SQL_UPDATE_PROGRESS = 'sql/update-classifier-progress.sql'
 
+# same as SQL_TICKETS_TO_CLASSIFY for many clients at once: takes the from and
+# to timestamps, the /*CLIENTS*/ marker is expanded into a (?,?) row of
+# (data_source, client_id) per client, must return CLIENT_ID and DATA_SOURCE
+try: SQL_TICKETS_TO_CLASSIFY_BATCH = parser.get('pasir','SQL_TICKETS_TO_CLASSIFY_BATCH')
+except: SQL_TICKETS_TO_CLASSIFY_BATCH = 'sql/select-tickets-to-classify-batch.sql'
+
+# takes the same params as SQL_TICKETS_TO_CLASSIFY, returns the number of
+# tickets per day in TICKET_DAY and TICKET_COUNT
+try: SQL_COUNT_TICKETS_BY_DAY = parser.get('pasir','SQL_COUNT_TICKETS_BY_DAY')
+except: SQL_COUNT_TICKETS_BY_DAY = 'sql/count-tickets-to-classify-by-day.sql'
+
 try: SQL_INSERT_CLASSIFIED_TICKETS = parser.get('pasir','SQL_INSERT_CLASSIFIED_TICKETS')
 except: SQL_INSERT_CLASSIFIED_TICKETS = 'sql/insert-classified-tickets.sql'
 
+# same as SQL_TICKETS_TO_CLASSIFY, taking the classifier uid as a 5th parameter
+# to leave out tickets that classifier has classified already
+try: SQL_UNCLASSIFIED_TICKETS_TO_CLASSIFY = parser.get('pasir','SQL_UNCLASSIFIED_TICKETS_TO_CLASSIFY')
+except: SQL_UNCLASSIFIED_TICKETS_TO_CLASSIFY = 'sql/select-unclassified-tickets-to-classify.sql'
+
 try: SQL_TRAINING_DATA = parser.get('pasir','SQL_TRAINING_DATA')
 except: SQL_TRAINING_DATA = 'sql/select-training-tickets.sql'
 
@@ -105,17 +272,70 @@ except: SQL_TEST_DATA = 'sql/select-test-tickets.sql'
 try: BATCH_SIZE = parser.getint('pasir','BATCH_SIZE')
 except: BATCH_SIZE = 1000
 
+# 'serial': one insert at a time server-wide over the shared connection
+# 'concurrent': up to PARALLEL_INSERTS jobs insert at the same time, each over
+#               its own connection and in its own transaction
+# shards of a sharded job insert in their own transaction in either mode
+try: INSERT_MODE = parser.get('pasir','INSERT_MODE')
+except: INSERT_MODE = 'serial'
+
+try: PARALLEL_INSERTS = parser.getint('pasir','PARALLEL_INSERTS')
+except: PARALLEL_INSERTS = 4
+
+# intermediate progress of PASIR classifications is written to DB2 at most
+# once per interval per record (0 writes every single update synchronously)
+try: PROGRESS_INTERVAL_SEC = parser.getfloat('pasir','PROGRESS_INTERVAL_SEC')
+except: PROGRESS_INTERVAL_SEC = 5.0
+
+# write the data quality tagged results back to classified-tickets.csv, the
+# job's download; turning it off leaves the plain classifier output there and
+# reads only the columns inserted
+try: REWRITE_CLASSIFIED_CSV = parser.getboolean('pasir','REWRITE_CLASSIFIED_CSV')
+except: REWRITE_CLASSIFIED_CSV = True
+
+# pasir.classify windows of more than a day are split into shards of about
+# this many tickets, each classified as a child job (0 turns sharding off)
+try: SHARD_TARGET_TICKETS = parser.getint('pasir','SHARD_TARGET_TICKETS')
+except: SHARD_TARGET_TICKETS = 0
+
+try: SHARD_MAX_RETRIES = parser.getint('pasir','SHARD_MAX_RETRIES')
+except: SHARD_MAX_RETRIES = 2
+
+# start the JVM and connect DB2 in the background once the HTTP listener is
+# up, instead of on the first PASIR call
+try: PREWARM = parser.getboolean('pasir','PREWARM')
+except: PREWARM = False
+
+# incremental classifications take tickets more than this many days behind
+# the watermark as classified, only those within it are checked against the
+# classified tickets for ones that reached DB2 late
+try: WATERMARK_LOOKBACK_DAYS = parser.getint('pasir','WATERMARK_LOOKBACK_DAYS')
+except: WATERMARK_LOOKBACK_DAYS = 1
+
+if INSERT_MODE not in ['serial', 'concurrent']:
+	raise Exception('INSERT_MODE must be either "serial" or "concurrent", got "%s"' % INSERT_MODE)
+if PARALLEL_INSERTS < 1:
+	raise Exception('PARALLEL_INSERTS must be at least 1')
+if WATERMARK_LOOKBACK_DAYS < 0:
+	raise Exception('WATERMARK_LOOKBACK_DAYS must not be negative')
+
 
 # set up console logging
-logging.basicConfig(format='%(message)s', level=logging.DEBUG)
-# set up rotating log file
+console_handler = logging.StreamHandler(sys.stderr)
+console_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.getLogger('').setLevel(logging.DEBUG)
+# set up rotating log file, worker processes log to files of their own as
+# rotation of a shared file is not process-safe
+if os.environ.get('CLASSR_WORKER', '') == '': log_file_name = 'classr.log'
+else: log_file_name = 'classr-worker-%s.log' % os.environ['CLASSR_WORKER']
 rotated_handler = logging.handlers.RotatingFileHandler(
-   filename=os.path.join(LOG_PATH, 'classr.log'), 
+   filename=os.path.join(LOG_PATH, log_file_name), 
    mode='a', maxBytes=104857600, backupCount=10000) # 104857600==100MB
 rotated_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
 rotated_handler.setFormatter(formatter)
-logging.getLogger('').addHandler(rotated_handler)
+# both are written to by a single thread, callers only queue their records
+logpipe.start([console_handler, rotated_handler])
 
 # set up stderr logging
 class LoggerWriter:
@@ -130,11 +350,8 @@ class LoggerWriter:
       if message != '\n': self.level(re.sub('(\\n)+$','',message))
    
    def flush(self):
-      # create a flush method so things can be flushed when
-      # the system wants to. Not sure if simply 'printing'
-      # sys.stderr is the correct way to do it, but it seemed
-      # to work properly for me.
-      self.level(sys.stderr)
+      # records are written by the log writer thread, nothing to flush here
+      pass
 sys.stderr = LoggerWriter(logging.getLogger('').error)
 
 logging.info('Reading configuration from: %s ' % config_files)
@@ -154,4 +371,22 @@ try:
          autosync_remote['SYNC_INTERVAL_HOURS'] = parser.getint(section,'SYNC_INTERVAL_HOURS') #*3600
          AUTOSYNC[name] = autosync_remote
 except Exception as e:
-   logging.error(e)
\ No newline at end of file
+   logging.error(e)
+
+# [autoclassify:*]
+AUTOCLASSIFY = {}
+# collect autoclassify config
+try:
+   for section in parser.sections():
+      m = re.match('autoclassify:(\w+)', section)
+      if not m == None:
+         name = m.group(1)
+         autoclassify_client = {}
+         autoclassify_client['CLIENT_ID'] = parser.get(section,'CLIENT_ID')
+         autoclassify_client['DATA_SOURCE'] = parser.get(section,'DATA_SOURCE')
+         autoclassify_client['POLL_INTERVAL_SEC'] = parser.getint(section,'POLL_INTERVAL_SEC')
+         try: autoclassify_client['LOOKBACK_DAYS'] = parser.getint(section,'LOOKBACK_DAYS')
+         except: autoclassify_client['LOOKBACK_DAYS'] = 1
+         AUTOCLASSIFY[name] = autoclassify_client
+except Exception as e:
+   logging.error(e)
@@ -0,0 +1,206 @@
+from threading import Thread, Lock
+import time
+import logging
+
+import config
+import persistence
+import admission
+import jobqueue
+import artifacts
+import store
+
+# offloads jobs to peers, the [autosync:*] remotes, while this server has
+# more unfinished jobs than it runs at a time and a peer that has the job's
+# classifier has a slot free: the input CSV is placed with the peer as a job
+# of its own, whose progress is relayed to the local job and whose output is
+# downloaded in place of the local output, the local job then finishing as if
+# it ran here; jobs run locally after all if the peer fails them or fails
+#
+# servers report their load with server.get_load, under 'federation'
+
+class Peer:
+
+   def __init__(self, name, url, key):
+      self.name = name
+      self.remote = store.Remote(url, key)
+      # last load reported, None while unknown or failing
+      self.load = None
+      self.classifiers = set()
+      # jobs offloaded since the load was reported
+      self.offloaded = 0
+
+   def refresh(self):
+      try:
+         load = self.remote.invoke_jsonrpc('server.get_load',
+            timeout=config.FEDERATION_TIMEOUT_SEC).get('federation')
+      except Exception as e:
+         if self.load != None: logging.warning('Federation peer %s is unavailable: %s' % (self.name, e))
+         load = None
+      with _lock:
+         self.load = load
+         self.classifiers = set(load['classifiers']) if load != None else set()
+         self.offloaded = 0
+
+   def failed(self):
+      with _lock:
+         self.load = None
+         self.classifiers = set()
+
+   # fraction of the peer's slots in use, None if it takes no jobs
+   def utilization(self, classifier_uid):
+      if self.load == None or not classifier_uid in self.classifiers: return None
+      jobs = self.load['jobs'] + self.offloaded
+      if jobs >= self.load['slots']: return None
+      return float(jobs) / self.load['slots']
+
+   def to_dict(self):
+      return {'name': self.name,
+         'url': self.remote.url,
+         'available': self.load != None,
+         'jobs': self.load['jobs'] if self.load != None else None,
+         'slots': self.load['slots'] if self.load != None else None,
+         'offloaded': self.offloaded}
+
+
+class FederationThread(Thread):
+# polls the load of the peers
+
+   def __init__(self, interval_sec):
+      Thread.__init__(self)
+      self.setDaemon(True)
+      self.interval_sec = interval_sec
+
+   def run(self):
+      logging.info('Setting up Federation with %s' %
+         str.join(', ', [peer.name for peer in _peers]))
+      while True:
+         for peer in _peers: peer.refresh()
+         time.sleep(self.interval_sec)
+
+_lock = Lock()
+# set up by start()
+_peers = []
+_in_flight = 0
+_statistics = {'offloaded': 0, 'completed': 0, 'fallbacks': 0}
+
+# jobs this server runs at a time
+def _slots():
+   return config.PARALLEL_JOBS * max(1, config.WORKER_PROCESSES)
+
+# load reported to peers: unfinished jobs but those offloaded, slots and the
+# uids of the classifiers ready to run
+def local_load():
+   jobs = sum([load['jobs'] for load in admission.get_load().values()])
+   c = persistence.cursor()
+   c.execute("""SELECT uid FROM CLASSIFIER
+                WHERE enabled=1 AND finished_on IS NOT NULL""")
+   with _lock:
+      return {'jobs': max(0, jobs - _in_flight),
+         'slots': _slots(),
+         'classifiers': [row[0] for row in c.fetchall()],
+         'in_flight': _in_flight,
+         'statistics': dict(_statistics),
+         'peers': [peer.to_dict() for peer in _peers]}
+
+# the least utilized peer to offload a job of classifier_uid to, if this
+# server is saturated, counting the job as offloaded to it
+def _choose(classifier_uid):
+   load = local_load()
+   if load['jobs'] <= load['slots']: return None
+   with _lock:
+      best = None
+      for peer in _peers:
+         utilization = peer.utilization(classifier_uid)
+         if utilization == None: continue
+         if best == None or utilization < best[0]: best = (utilization, peer)
+      if best == None: return None
+      best[1].offloaded += 1
+      return best[1]
+
+# offloads the job to a peer, running it on a thread of its own, returns
+# whether it did; invoked by Classifier.classify
+def offload(classifier, job_context, in_csv, in_desc_col, in_res_col, out_csv, out_class_col):
+   if jobqueue.in_worker(): return False
+   peer = _choose(classifier.uid)
+   if peer == None: return False
+   Thread(target = _run_offloaded, args = (peer, classifier, job_context,
+      in_csv, in_desc_col, in_res_col, out_csv, out_class_col)).start()
+   return True
+
+def _run_offloaded(peer, classifier, job_context, in_csv, in_desc_col, in_res_col, out_csv, out_class_col):
+   global _in_flight
+   with _lock:
+      _in_flight += 1
+      _statistics['offloaded'] += 1
+   peer_uid = None
+   status = None
+   try:
+      peer_uid = peer.remote.place_job(classifier.uid, in_csv,
+         in_desc_col, in_res_col, out_class_col, timeout=config.FEDERATION_TIMEOUT_SEC)
+      job_context.logger.info('Offloaded to %s as job %s' % (peer.name, peer_uid))
+      status = _relay(peer, peer_uid, job_context)
+      if status == 'Done':
+         peer.remote.download_job(peer_uid, out_csv, timeout=config.FEDERATION_TIMEOUT_SEC)
+   except store.JobCancelled as e:
+      status = 'Cancelled'
+      try: peer.remote.invoke_jsonrpc('job.cancel', [peer_uid], timeout=config.FEDERATION_TIMEOUT_SEC)
+      except Exception as e: pass
+   except Exception as e:
+      job_context.logger.warning('Offloading to %s failed: %s' % (peer.name, e))
+      peer.failed()
+      status = None
+   finally:
+      with _lock: _in_flight -= 1
+      # the output has been pulled back or is no longer needed
+      if peer_uid != None:
+         try: peer.remote.invoke_jsonrpc('job.delete', [peer_uid], timeout=config.FEDERATION_TIMEOUT_SEC)
+         except Exception as e: pass
+   try:
+      if status == 'Done':
+         with _lock: _statistics['completed'] += 1
+         job_context.mark_done()
+         if job_context.status == 'Done': artifacts.compact(job_context, [], [in_csv, out_csv])
+      elif status == 'Cancelled':
+         job_context.update_progress(100, 'Cancelled', 'Error')
+      else:
+         with _lock: _statistics['fallbacks'] += 1
+         job_context.logger.info('Running job locally')
+         classifier.classify(job_context, in_csv, in_desc_col, in_res_col,
+            out_csv, out_class_col, offload=False)
+   except Exception as e:
+      job_context.update_progress(100, str(e), 'Error')
+
+# relays the progress of the peer's job to the local one until it has
+# finished, returns its terminal status
+def _relay(peer, peer_uid, job_context):
+   known = {}
+   while True:
+      if job_context.cancel_requested():
+         raise store.JobCancelled('Job %s was cancelled' % job_context.uid)
+      try:
+         events = peer.remote.invoke_jsonrpc('job.wait_status',
+            [[peer_uid], known, config.FEDERATION_POLL_SEC],
+            timeout=config.FEDERATION_POLL_SEC + config.FEDERATION_TIMEOUT_SEC)
+      except Exception as e:
+         # peers limit long-polls, polling the status does as well
+         status = peer.remote.invoke_jsonrpc('job.get_status', [peer_uid], timeout=config.FEDERATION_TIMEOUT_SEC)
+         events = [{'status': status['status'], 
+            'progress_percentage': status['progress_percentage'], 
+            'progress_text': status['progress_text']}]
+         if known.get(peer_uid) == [status['status'], status['progress_percentage']]:
+            time.sleep(config.FEDERATION_POLL_SEC)
+            continue
+      if len(events) == 0:
+         # fails once the peer has lost the job
+         peer.remote.invoke_jsonrpc('job.get_status', [peer_uid], timeout=config.FEDERATION_TIMEOUT_SEC)
+         continue
+      for event in events:
+         known[peer_uid] = [event['status'], event['progress_percentage']]
+         if event['status'] in ['Done', 'Error', 'Cancelled']: return event['status']
+         job_context.update_progress(event['progress_percentage'],
+            '%s (on %s)' % (event['progress_text'], peer.name))
+
+def start():
+   for name, remote in sorted(config.AUTOSYNC.iteritems()):
+      _peers.append(Peer(name, remote['URL'], remote['KEY']))
+   if len(_peers) > 0: FederationThread(config.FEDERATION_POLL_SEC).start()
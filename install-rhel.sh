@@ -35,6 +35,8 @@ sudo -s /usr/local/bin/pip2.7 install Flask-HTTPAuth==3.1.2
 sudo -s /usr/local/bin/pip2.7 install sklearn
 sudo -s /usr/local/bin/pip2.7 install --pre xgboost==0.4a30
 sudo -s /usr/local/bin/pip2.7 install requests==2.2.1
+sudo -s /usr/local/bin/pip2.7 install waitress==1.4.4
+sudo -s /usr/local/bin/pip2.7 install ujson==2.0.3
 
 # dependencies for enabling IBM DB2 connection
 sudo -s yum -y install java-1.7.1-ibm
@@ -15,6 +15,8 @@ sudo -s pip install Flask-HTTPAuth==3.1.2
 sudo -s pip install sklearn
 sudo -s pip install --pre xgboost==0.4a30
 sudo -s pip install requests==2.2.1
+sudo -s pip install waitress==1.4.4
+sudo -s pip install ujson==2.0.3
 
 # dependencies for enabling IBM DB2 connection
 sudo -s apt-get -y install openjdk-7-jre
@@ -0,0 +1,235 @@
+import json
+import os
+import socket
+import time
+import datetime
+import logging
+
+import persistence
+import config
+
+db = persistence.db()
+c = db.cursor()
+
+# let readers carry on while a worker process writes
+if config.WORKER_PROCESSES > 0: c.execute('PRAGMA journal_mode=WAL')
+sql = """CREATE TABLE IF NOT EXISTS JOB_QUEUE (
+      job_uid TEXT PRIMARY KEY NOT NULL,
+      kind TEXT,
+      payload TEXT,
+      retryable INT,
+      state TEXT,
+      worker TEXT,
+      attempts INT,
+      queued_on TIMESTAMP,
+      claimed_on TIMESTAMP,
+      finished_on TIMESTAMP
+      );"""
+c.execute(sql)
+sql = """CREATE INDEX IF NOT EXISTS JOB_QUEUE_STATE_IDX
+      ON JOB_QUEUE (state, queued_on);"""
+c.execute(sql)
+sql = """CREATE TABLE IF NOT EXISTS WORKER (
+      worker TEXT PRIMARY KEY NOT NULL,
+      started_on TIMESTAMP,
+      heartbeat_on REAL
+      );"""
+c.execute(sql)
+sql = """CREATE TABLE IF NOT EXISTS LEADER (
+      name TEXT PRIMARY KEY NOT NULL,
+      holder TEXT,
+      expires_on REAL
+      );"""
+c.execute(sql)
+db.commit()
+
+# set in worker processes, which run the jobs they claim themselves
+_in_worker = False
+
+def become_worker():
+   global _in_worker
+   _in_worker = True
+
+def in_worker():
+   return _in_worker
+
+# whether jobs are handed over to worker processes through the queue
+def dispatching():
+   return config.WORKER_PROCESSES > 0 and not _in_worker
+
+def worker_id(pid=None):
+   if pid == None: pid = os.getpid()
+   return '%s:%d' % (socket.getfqdn(), pid)
+
+# runs func(c) in a transaction holding the write lock from the start, so
+# concurrent processes can't claim or take over the same rows
+def _transaction(func):
+   db = persistence.db()
+   db.isolation_level = None
+   c = db.cursor()
+   try:
+      c.execute('BEGIN IMMEDIATE')
+      result = func(c)
+      c.execute('COMMIT')
+      return result
+   except:
+      try: c.execute('ROLLBACK')
+      except: pass
+      raise
+
+# queues a job for the workers, retryable jobs are queued again if their
+# worker dies, others fail
+def put(job_uid, kind, payload, retryable=False):
+   db = persistence.db()
+   c = db.cursor()
+   try:
+      c.execute("""INSERT INTO JOB_QUEUE (
+         job_uid,
+         kind,
+         payload,
+         retryable,
+         state,
+         attempts,
+         queued_on)
+         VALUES (?,?,?,?,?,?,?)""",
+         [job_uid, kind, json.dumps(payload), int(retryable),
+         'Queued', 0, str(datetime.datetime.now())])
+      db.commit()
+   except:
+      db.rollback()
+      raise Exception('Failed to queue job %s' % job_uid)
+   logging.info('Queued %s job %s' % (kind, job_uid))
+
+# claims the oldest queued job for worker, returns (job_uid, kind, payload)
+# or None if there is nothing to do
+def claim(worker):
+   def claim_oldest(c):
+      c.execute("""SELECT job_uid, kind, payload FROM JOB_QUEUE
+         WHERE state='Queued' ORDER BY queued_on LIMIT 1""")
+      row = c.fetchone()
+      if row == None: return None
+      c.execute("""UPDATE JOB_QUEUE SET
+         state='Claimed',
+         worker=?,
+         attempts=attempts+1,
+         claimed_on=?
+         WHERE job_uid=?""",
+         [worker, str(datetime.datetime.now()), row[0]])
+      return (row[0], row[1], json.loads(row[2]))
+   return _transaction(claim_oldest)
+
+# marks a job finished, by worker only as long as it holds its claim
+def finish(job_uid, worker=None):
+   db = persistence.db()
+   c = db.cursor()
+   if worker == None:
+      c.execute("""UPDATE JOB_QUEUE SET state='Finished', finished_on=?
+         WHERE job_uid=?""", [str(datetime.datetime.now()), job_uid])
+   else:
+      c.execute("""UPDATE JOB_QUEUE SET state='Finished', finished_on=?
+         WHERE job_uid=? AND worker=? AND state='Claimed'""", 
+         [str(datetime.datetime.now()), job_uid, worker])
+   db.commit()
+
+# whether worker still holds its claim on a job, which it loses once its
+# jobs are released as those of a dead worker
+def holds(job_uid, worker):
+   c = persistence.cursor()
+   c.execute("""SELECT 1 FROM JOB_QUEUE 
+      WHERE job_uid=? AND worker=? AND state='Claimed'""", [job_uid, worker])
+   return c.fetchone() != None
+
+# takes a job off the queue if no worker has claimed it yet, returns its
+# (kind, payload) or None
+def withdraw(job_uid):
+   def withdraw_queued(c):
+      c.execute("""SELECT kind, payload FROM JOB_QUEUE
+         WHERE job_uid=? AND state='Queued'""", [job_uid])
+      row = c.fetchone()
+      if row == None: return None
+      c.execute("""UPDATE JOB_QUEUE SET state='Cancelled', finished_on=?
+         WHERE job_uid=?""", [str(datetime.datetime.now()), job_uid])
+      return (row[0], json.loads(row[1]))
+   return _transaction(withdraw_queued)
+
+# waits up to timeout_sec for a queued job to finish, returns whether it did
+def wait(job_uid, timeout_sec):
+   deadline = time.time() + timeout_sec
+   while time.time() < deadline:
+      c = persistence.cursor()
+      c.execute('SELECT state FROM JOB_QUEUE WHERE job_uid=?', [job_uid])
+      row = c.fetchone()
+      if row == None or row[0] in ['Finished', 'Cancelled']: return True
+      time.sleep(config.QUEUE_POLL_INTERVAL_SEC)
+   return False
+
+def heartbeat(worker):
+   db = persistence.db()
+   c = db.cursor()
+   c.execute("""INSERT OR IGNORE INTO WORKER (worker, started_on, heartbeat_on)
+      VALUES (?,?,?)""", [worker, str(datetime.datetime.now()), time.time()])
+   c.execute('UPDATE WORKER SET heartbeat_on=? WHERE worker=?', [time.time(), worker])
+   db.commit()
+
+# workers that haven't sent a heartbeat for stale_sec
+def stale_workers(stale_sec):
+   c = persistence.cursor()
+   c.execute('SELECT worker FROM WORKER WHERE heartbeat_on<?', [time.time() - stale_sec])
+   return [row[0] for row in c.fetchall()]
+
+# releases the jobs claimed by workers that exited or haven't sent a
+# heartbeat for stale_sec, queueing retryable jobs again; returns the
+# (job_uid, kind, payload) of the others, which the caller has to fail
+def release(workers=[], stale_sec=None):
+   def release_jobs(c):
+      dead = list(workers)
+      if stale_sec != None:
+         c.execute('SELECT worker FROM WORKER WHERE heartbeat_on<?',
+            [time.time() - stale_sec])
+         dead += [row[0] for row in c.fetchall()]
+      # stale workers that are still running are fenced off, see holds()
+      failed = []
+      for worker in set(dead):
+         c.execute("""SELECT job_uid, kind, payload, retryable FROM JOB_QUEUE
+            WHERE state='Claimed' AND worker=?""", [worker])
+         for job_uid, kind, payload, retryable in c.fetchall():
+            if retryable:
+               c.execute("""UPDATE JOB_QUEUE SET state='Queued', worker=NULL
+                  WHERE job_uid=?""", [job_uid])
+               logging.warning('Queued job %s of dead worker %s again' % (job_uid, worker))
+            else:
+               c.execute("""UPDATE JOB_QUEUE SET state='Failed', finished_on=?
+                  WHERE job_uid=?""", [str(datetime.datetime.now()), job_uid])
+               failed.append((job_uid, kind, json.loads(payload)))
+         c.execute('DELETE FROM WORKER WHERE worker=?', [worker])
+      return failed
+   return _transaction(release_jobs)
+
+# takes or renews the lease on name for lease_sec, returns whether this
+# process holds it, so background tasks run only once across processes
+def lead(name, lease_sec):
+   holder = worker_id()
+   def take_lease(c):
+      now = time.time()
+      c.execute('SELECT holder, expires_on FROM LEADER WHERE name=?', [name])
+      row = c.fetchone()
+      if row != None and row[0] != holder and row[1] > now: return False
+      c.execute("""INSERT OR REPLACE INTO LEADER (name, holder, expires_on)
+         VALUES (?,?,?)""", [name, holder, now + lease_sec])
+      return True
+   try:
+      return _transaction(take_lease)
+   except Exception as e:
+      logging.exception('Failed to take the lease on %s' % name)
+      return False
+
+def get_statistics():
+   c = persistence.cursor()
+   c.execute('SELECT state, COUNT(*) FROM JOB_QUEUE GROUP BY state')
+   jobs = dict((state, count) for state, count in c.fetchall())
+   c.execute('SELECT worker, started_on, heartbeat_on FROM WORKER')
+   workers = [{'worker': worker,
+      'started_on': started_on,
+      'heartbeat_age': time.time() - heartbeat_on}
+      for worker, started_on, heartbeat_on in c.fetchall()]
+   return {'jobs': jobs, 'workers': workers}
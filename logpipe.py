@@ -0,0 +1,134 @@
+from threading import Thread, current_thread
+from collections import OrderedDict
+import Queue
+import logging
+import atexit
+import codecs
+
+# asynchronous logging: handlers only queue records, which a single writer
+# thread formats and writes, to the server's log handlers or to the log files
+# of jobs; job log files are opened on demand and closed when released, or
+# when more than max_open_files are open
+
+_max_queued_records = 100000
+
+def _prepare(record):
+   # freeze the message, args and traceback may change or go away before
+   # the writer gets to them
+   record.msg = record.getMessage()
+   record.args = None
+   if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+   return record
+
+
+class _LogWriterThread(Thread):
+
+   def __init__(self, max_open_files=64):
+      Thread.__init__(self)
+      self.setDaemon(True)
+      self.queue = Queue.Queue(_max_queued_records)
+      self.handlers = []
+      self.files = OrderedDict()
+      self.dirty = set()
+      self.max_open_files = max_open_files
+      self.job_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+
+   def run(self):
+      while True:
+         item = self.queue.get()
+         if item == None: break
+         kind, path, record = item
+         try:
+            if kind == 'server':
+               for handler in self.handlers:
+                  if record.levelno >= handler.level: handler.handle(record)
+            elif kind == 'job':
+               self.write(path, self.job_formatter.format(record))
+            elif kind == 'release':
+               self.close(path)
+         except Exception:
+            pass
+         if self.queue.empty(): self.flush()
+      self.flush()
+      for path in self.files.keys(): self.close(path)
+
+   def write(self, path, line):
+      f = self.files.pop(path, None)
+      if f == None:
+         f = codecs.open(path, 'a', 'utf-8')
+         while len(self.files) >= self.max_open_files:
+            self.close(self.files.keys()[0])
+      # most recently used last
+      self.files[path] = f
+      f.write(line + '\n')
+      self.dirty.add(path)
+
+   def flush(self):
+      for path in self.dirty:
+         if path in self.files: self.files[path].flush()
+      self.dirty = set()
+      for handler in self.handlers:
+         try: handler.flush()
+         except Exception: pass
+
+   def close(self, path):
+      f = self.files.pop(path, None)
+      if f != None: f.close()
+      self.dirty.discard(path)
+
+_writer = _LogWriterThread()
+
+
+class QueueHandler(logging.Handler):
+# hands records over to the writer thread's handlers
+
+   def emit(self, record):
+      # errors of the writer's own handlers would loop back to them
+      if current_thread() is _writer: return
+      try:
+         _writer.queue.put(('server', None, _prepare(record)))
+      except Exception:
+         self.handleError(record)
+
+
+class JobLogHandler(logging.Handler):
+# hands records over to the writer thread to append to a job's log file
+
+   def __init__(self, path):
+      logging.Handler.__init__(self)
+      self.path = path
+
+   def emit(self, record):
+      try:
+         _writer.queue.put(('job', self.path, _prepare(record)))
+      except Exception:
+         self.handleError(record)
+
+
+# routes the root logger's records through the writer thread to handlers
+def start(handlers):
+   _writer.handlers = handlers
+   root = logging.getLogger('')
+   root.addHandler(QueueHandler())
+   _writer.start()
+   atexit.register(stop)
+
+# writes what has been queued and stops the writer thread
+def stop(timeout_sec=5):
+   if _writer.is_alive():
+      _writer.queue.put(None)
+      _writer.join(timeout_sec)
+
+# a logger writing to a job's log file and passing records on to the root
+# logger; it is not registered with logging, so it goes away with the job
+def job_logger(name, path):
+   logger = logging.Logger(name)
+   logger.parent = logging.getLogger('')
+   logger.addHandler(JobLogHandler(path))
+   return logger
+
+# closes the log file of a job once what has been queued for it is written
+def release(path):
+   _writer.queue.put(('release', path, None))
@@ -1,8 +1,114 @@
 import os
 import time
+import logging
+import datetime
+import importlib
+from threading import Lock
+from collections import OrderedDict
 
-import xgbm.trainer
-import xgbm.classifier
+import artifacts
+import pvformat
+
+class ModelType:
+# a model type plugin: a module implementing 
+#   classify(job_context, meta, resources, in_csv, in_desc_col, in_res_col,
+#            out_csv, out_class_col, capabilities)
+# and optionally train(...) with the params of train() below, init() run once
+# on import, load(meta, resources) returning a warm in-memory model, which
+# classify() is then passed as model (None while cold), and
+# predict_in_memory(model, tickets, desc_col, res_col, class_col)
+# returning the tickets labeled; the module is imported on first use
+   
+   def __init__(self, name, module_name, capabilities):
+      self.name = name
+      self.module_name = module_name
+      self.capabilities = capabilities
+      self.module = None
+      self.import_time = None
+      self.init_time = None
+      self.lock = Lock()
+   
+   def get_module(self):
+      if self.module != None: return self.module
+      with self.lock:
+         if self.module == None:
+            start = time.time()
+            module = importlib.import_module(self.module_name)
+            self.import_time = time.time() - start
+            start = time.time()
+            if hasattr(module, 'init'): module.init()
+            self.init_time = time.time() - start
+            logging.info('Model type %s loaded from %s: import %f s, init %f s' % 
+               (self.name, self.module_name, self.import_time, self.init_time))
+            self.module = module
+      return self.module
+   
+   def to_dict(self):
+      return {'name': self.name,
+         'module': self.module_name,
+         'capabilities': self.capabilities,
+         'loaded': self.module != None,
+         'import_time': self.import_time,
+         'init_time': self.init_time}
+
+_model_types = {}
+
+# registers a model type plugin, capabilities being
+#   max_batch_size    : most tickets a single classify() call should be given
+#                       (None for no limit)
+#   threads           : threads a single classify() call keeps busy
+#   thread_scaling    : whether classify() speeds up with more threads
+#   supports_warm     : whether the module can load() a model to keep in memory
+#   predict_in_memory : whether the module can classify tickets in memory
+#   intermediates     : work dir files classify() leaves behind, deleted
+#                       once the job is done, see artifacts
+def register(name, module_name, 
+             max_batch_size=None, 
+             threads=1, 
+             thread_scaling=False, 
+             supports_warm=False, 
+             predict_in_memory=False, 
+             intermediates=[]):
+   _model_types[name] = ModelType(name, module_name, {
+      'max_batch_size': max_batch_size,
+      'threads': threads,
+      'thread_scaling': thread_scaling,
+      'supports_warm': supports_warm,
+      'predict_in_memory': predict_in_memory,
+      'intermediates': intermediates})
+
+register('XGBM', 'xgbm_model',
+   threads = 4,
+   thread_scaling = True,
+   intermediates = [
+      'vec-desc-dm.csv', 
+      'vec-desc-dbow.csv', 
+      'vec-res-dm.csv', 
+      'vec-res-dbow.csv', 
+      'desc.txt', 
+      'res.txt'])
+
+def get_model_type(model_type):
+   if not model_type in _model_types:
+      raise Exception('Model type %s is not supported by this server' % model_type)
+   return _model_types[model_type]
+
+def get_model_types():
+   return [_model_types[name] for name in sorted(_model_types.keys())]
+
+def capabilities(model_type):
+   return get_model_type(model_type).capabilities
+
+# imports the plugins of the model types given, returns their descriptions
+def preload(model_types):
+   loaded = []
+   for model_type in model_types:
+      try:
+         get_model_type(model_type).get_module()
+         loaded.append(model_type)
+      except Exception as e:
+         logging.exception('Failed to load model type %s' % model_type)
+   return loaded
 
 def train(job_context, 
           model_type, 
@@ -11,7 +117,113 @@ def train(job_context,
           in_csv, 
           in_desc_col, 
           in_res_col, 
-          in_class_col): None
+          in_class_col):
+   module = get_model_type(model_type).get_module()
+   if hasattr(module, 'train'):
+      module.train(job_context, meta, resources, in_csv, 
+         in_desc_col, in_res_col, in_class_col)
+
+# loads a model to keep in memory, for model types supporting it
+def load(model_type, meta, resources):
+   plugin = get_model_type(model_type)
+   if not plugin.capabilities['supports_warm']:
+      raise Exception('Model type %s does not support warm models' % model_type)
+   return plugin.get_module().load(meta, resources)
+
+class WarmModel:
+# a classifier's model kept warm: loaded into memory by model types that
+# support it, otherwise only its resource files pre-read into the page
+# cache, where all processes share them and which the kernel may drop again
+# at will, the budget merely bounding how much is pre-read; size is that of
+# the files read, see read_size()
+   
+   def __init__(self, classifier_uid, model_type, size):
+      self.classifier_uid = classifier_uid
+      self.model_type = model_type
+      self.size = size
+      self.state = 'Warming'
+      self.model = None
+      self.warmed_on = None
+      self.load_time = None
+
+# warm models by classifier uid, least recently used first
+_warm = OrderedDict()
+_warm_lock = Lock()
+
+# the files of a resource dir plugins read, those derived by pvformat left
+# out
+def _read_files(path):
+   for root, dirs, files in os.walk(path):
+      for name in files:
+         file_path = os.path.join(root, name)
+         if not pvformat.is_derived(file_path): yield file_path
+
+def read_size(resources):
+   return sum([os.path.getsize(file_path) for path in resources.values() 
+      for file_path in _read_files(path)])
+
+def _read_through(path, chunk_size=1024*1024):
+   for file_path in _read_files(path):
+      with open(file_path, 'rb') as f:
+         while f.read(chunk_size): pass
+
+# keeps the model of a classifier warm within budget bytes, evicting the
+# least recently used ones to make room if evict, returns its WarmModel or
+# None if it doesn't fit
+def warm(classifier_uid, model_type, meta, resources, size, budget, evict=True):
+   with _warm_lock:
+      entry = _warm.pop(classifier_uid, None)
+      if entry != None:
+         _warm[classifier_uid] = entry
+         return entry
+      used = sum([e.size for e in _warm.values()])
+      while evict and used + size > budget and len(_warm) > 0:
+         uid, evicted = _warm.popitem(last=False)
+         used -= evicted.size
+         logging.info('Classifier %s is no longer kept warm' % uid)
+      if used + size > budget: return None
+      entry = WarmModel(classifier_uid, model_type, size)
+      _warm[classifier_uid] = entry
+   start = time.time()
+   try:
+      plugin = get_model_type(model_type)
+      module = plugin.get_module()
+      if plugin.capabilities['supports_warm']:
+         entry.model = module.load(meta, resources)
+      else:
+         for path in resources.values(): _read_through(path)
+      entry.load_time = time.time() - start
+      entry.warmed_on = str(datetime.datetime.now())
+      entry.state = 'Warm'
+      logging.info('Classifier %s warmed up in %f s' % (classifier_uid, entry.load_time))
+      return entry
+   except Exception as e:
+      logging.exception('Failed to warm up classifier %s' % classifier_uid)
+      with _warm_lock: _warm.pop(classifier_uid, None)
+      return None
+
+# marks a classifier's model as just used
+def touch(classifier_uid):
+   with _warm_lock:
+      entry = _warm.pop(classifier_uid, None)
+      if entry != None: _warm[classifier_uid] = entry
+
+# stops keeping a classifier's model warm
+def cool(classifier_uid):
+   with _warm_lock: _warm.pop(classifier_uid, None)
+
+# the in-memory model of a classifier if warm, else None
+def get_warm_model(classifier_uid):
+   entry = _warm.get(classifier_uid)
+   if entry == None or entry.state != 'Warm': return None
+   return entry.model
+
+# classifies a data frame of tickets with a model returned by load()
+def predict_in_memory(model_type, model, tickets, desc_col, res_col, class_col):
+   plugin = get_model_type(model_type)
+   if not plugin.capabilities['predict_in_memory']:
+      raise Exception('Model type %s does not support in-memory prediction' % model_type)
+   return plugin.get_module().predict_in_memory(model, tickets, desc_col, res_col, class_col)
 
 def classify(job_context, 
              model_type, 
@@ -27,7 +239,7 @@ def classify(job_context,
    This function receives all parameters you need to know about how the classification 
    should be performed.
 
-   Use the model_type parameter to switch which algorithm to call.
+   The model_type parameter selects the plugin to call, see register().
 
      * in_csv       : full path of the input file that contains the records to be
                       classified. Params in_desc_col and in_res_col define the input CSV
@@ -61,48 +273,33 @@ def classify(job_context,
                       progress of your classification job, e.g.
                       job_context.update_progress(5, 'Verifying input')
 
+   Once the job is done, the intermediates declared with register() are deleted
+   and in_csv and out_csv are gzipped in place, see artifacts.compact().
+
    """
    try:
-      if model_type == 'XGBM':
-         # parametrize call for the XGBM (pv+bow) classifier
-         xgbm.classifier.run(
-            in_csv                 = in_csv,
-            in_voc                 = os.path.join(resources['vocab'], 'vocab.txt'),
-            out_csv                = out_csv,
-            in_model               = os.path.join(resources['model'], 'model.dat'),
-            pv_weights_dir         = resources['pv'],
-            vec_desc_dm            = os.path.join(job_context.work_dir, 'vec-desc-dm.csv'),
-            vec_desc_dbow          = os.path.join(job_context.work_dir, 'vec-desc-dbow.csv'),
-            vec_res_dm             = os.path.join(job_context.work_dir, 'vec-res-dm.csv'),
-            vec_res_dbow           = os.path.join(job_context.work_dir, 'vec-res-dbow.csv'),
-            pv_desc_txt            = os.path.join(job_context.work_dir, 'desc.txt'),
-            pv_res_txt             = os.path.join(job_context.work_dir, 'res.txt'),
-            desc_col               = in_desc_col,
-            res_col                = in_res_col,
-            clean_desc_out_col     = 'clean.description',
-            clean_res_out_col      = 'clean.resolution',
-            clean_combined_out_col = 'clean.combined',
-            ticketclass_out_col    = out_class_col,
-            dm_dim                 = 200,
-            dm_objective           = 'negative',
-            dm_negative_samples    = 10,
-            dm_window              = 4,
-            dm_subsample           = 0.1,
-            dm_iters               = 30,
-            dbow_dim               = 200,
-            dbow_objective         = 'negative',
-            dbow_negative_samples  = 5,
-            dbow_window            = 6,
-            dbow_subsample         = 0,
-            dbow_iters             = 30,
-            threads                = 4,
-            max_ngram              = 1,
-            orig_input             = '',
-            job_context            = job_context)
-      else:
-         raise Exception('Model type %s is not supported by this server' % model_type)
+      plugin = get_model_type(model_type)
+      warm_model = {}
+      if plugin.capabilities['supports_warm']:
+         warm_model['model'] = get_warm_model(job_context.classifier_uid)
+      plugin.get_module().classify(
+         job_context   = job_context,
+         meta          = meta,
+         resources     = resources,
+         in_csv        = in_csv,
+         in_desc_col   = in_desc_col,
+         in_res_col    = in_res_col,
+         out_csv       = out_csv,
+         out_class_col = out_class_col,
+         capabilities  = plugin.capabilities,
+         **warm_model)
       job_context.mark_done()
-      return
    except Exception as e:
       job_context.update_progress(100, str(e), 'Error')
-
+      return
+   # results have been handed over to the progress hooks, failed jobs are
+   # kept as they are for inspection
+   if job_context.status == 'Done':
+      artifacts.compact(job_context, 
+         plugin.capabilities['intermediates'], 
+         [in_csv, out_csv])
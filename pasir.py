@@ -1,21 +1,27 @@
 import pandas as pd
 import numpy as np
-import jaydebeapi as jdbc #LGPL :(
-import jpype
 import datetime
 import time
 import logging
 import os
-from threading import Thread, Condition, Semaphore
+from threading import Thread, Condition, Semaphore, Lock, Event
 import time
-import math
 import csv
+import re
+import weakref
 
 import config
 import store
+import persistence
+import jobqueue
+import admission
 
 _keep_alive_sql = 'SELECT CURRENT DATE FROM SYSIBM.SYSDUMMY1'
-_ticket_insert_semaphore = Semaphore(1)
+# bounds the number of jobs writing classified tickets at the same time
+if config.INSERT_MODE == 'concurrent':
+   _ticket_insert_semaphore = Semaphore(config.PARALLEL_INSERTS)
+else:
+   _ticket_insert_semaphore = Semaphore(1)
 
 class _DB2ConnectionFactoryThread(Thread):
 # this helper class is required to work around an issue in jaydebeapi
@@ -33,6 +39,7 @@ class _DB2ConnectionFactoryThread(Thread):
       Thread.__init__(self)
       self.setDaemon(True)
       self.condition = Condition()
+      self.request_lock = Lock()
       self.conn = None
       self.exception = None
       self.jvm_path = jvm_path
@@ -65,37 +72,71 @@ class _DB2ConnectionFactoryThread(Thread):
    
    # invokeable by any thread, returns a new connection instance correctly
    def get_new_connection(self):
-      self.exception = None
-      self.conn = None
-      self.condition.acquire()
-      self.condition.notify()
-      self.condition.release()
-      while self.conn == None and self.exception == None: 
-         time.sleep(0.3) # we could in fact use another Condition instead of this...
-      if not self.exception == None: raise self.exception 
-      return self.conn
+      # serialize requests, otherwise concurrent callers could be handed
+      # the very same connection instance
+      with self.request_lock:
+         self.exception = None
+         self.conn = None
+         self.condition.acquire()
+         self.condition.notify()
+         self.condition.release()
+         while self.conn == None and self.exception == None: 
+            time.sleep(0.3) # we could in fact use another Condition instead of this...
+         if not self.exception == None: raise self.exception 
+         return self.conn
 
-if config.JVM_PATH == '':
-   _JVM_PATH = jpype.getDefaultJVMPath()
-else:
-   _JVM_PATH = config.JVM_PATH
-
-# instantiate connection factory at module load
-_db2_connection_factory = _DB2ConnectionFactoryThread(
-   _JVM_PATH,
-   config.JVM_ARGS,
-   config.JDBC_CLASS,
-   config.DB2_URL,
-   config.DB2_USER,
-   config.DB2_PASS)
-_db2_connection_factory.start()
+# the JVM, JDBC driver and connection factory are set up on first use (or
+# by prewarm()), so nodes not serving PASIR calls never pay for them
+jdbc = None
+jpype = None
+_db2_connection_factory = None
+_init_lock = Lock()
+_init_time = None
 _conn = None
 
+def init():
+   global jdbc, jpype, _db2_connection_factory, _init_time
+   if _db2_connection_factory != None: return
+   with _init_lock:
+      if _db2_connection_factory != None: return
+      start = time.time()
+      import jaydebeapi as jdbc #LGPL :(
+      import jpype
+      if config.JVM_PATH == '':
+         jvm_path = jpype.getDefaultJVMPath()
+      else:
+         jvm_path = config.JVM_PATH
+      factory = _DB2ConnectionFactoryThread(
+         jvm_path,
+         config.JVM_ARGS,
+         config.JDBC_CLASS,
+         config.DB2_URL,
+         config.DB2_USER,
+         config.DB2_PASS)
+      factory.start()
+      _db2_connection_factory = factory
+      _init_time = time.time() - start
+      logging.info('PASIR DB2 subsystem initialized in %f s' % _init_time)
+
+# initializes the subsystem and opens the first connection, so the first
+# PASIR call doesn't have to wait for the JVM
+def prewarm():
+   start = time.time()
+   try:
+      pasir_db()
+      logging.info('PASIR DB2 connection prewarmed in %f s' % (time.time() - start))
+   except Exception as e:
+      logging.exception('Prewarming the PASIR DB2 connection failed')
+
+def _attach_thread_to_jvm():
+   init()
+   if jpype.isJVMStarted() and not jpype.isThreadAttachedToJVM():
+      jpype.attachThreadToJVM()
+
 # returns an alive, thread-safe connection instance to the PASIR DB2 database anytime
 def pasir_db():
    global _conn, _db2_connection_factory
-   if jpype.isJVMStarted() and not jpype.isThreadAttachedToJVM():
-      jpype.attachThreadToJVM()
+   _attach_thread_to_jvm()
    # check if existing connection is alive
    if not _conn == None:
       try:
@@ -109,6 +150,188 @@ def pasir_db():
       _conn = _db2_connection_factory.get_new_connection()
    return _conn
 
+# returns a new connection owned by the caller with autocommit turned off,
+# the caller is responsible for committing and closing it
+def dedicated_pasir_db():
+   _attach_thread_to_jvm()
+   conn = _db2_connection_factory.get_new_connection()
+   conn.jconn.setAutoCommit(False)
+   return conn
+
+# SQL files used by this module along with the number of parameters they take
+_sql_files = {
+   'TICKETS_TO_CLASSIFY'         : (config.SQL_TICKETS_TO_CLASSIFY, 4),
+   'UNCLASSIFIED_TICKETS_TO_CLASSIFY' : (config.SQL_UNCLASSIFIED_TICKETS_TO_CLASSIFY, 5),
+   'TICKETS_TO_CLASSIFY_BATCH'   : (config.SQL_TICKETS_TO_CLASSIFY_BATCH, 2),
+   'COUNT_TICKETS_BY_DAY'        : (config.SQL_COUNT_TICKETS_BY_DAY, 4),
+   'INSERT_TICKETCLASSIFICATION' : (config.SQL_INSERT_TICKETCLASSIFICATION, 8),
+   'UPDATE_TICKET_COUNT'         : (config.SQL_UPDATE_TICKET_COUNT, 2),
+   'UPDATE_PROGRESS'             : (config.SQL_UPDATE_PROGRESS, 4),
+   'INSERT_CLASSIFIED_TICKETS'   : (config.SQL_INSERT_CLASSIFIED_TICKETS, None)}
+_sql_texts = {}
+_sql_errors = {}
+
+# counts the ? placeholders of a statement, ignoring literals and comments
+def _count_sql_params(sql):
+   sql = re.sub(r"'(?:[^']|'')*'", '', sql)
+   sql = re.sub(r'--[^\n]*', '', sql)
+   sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.DOTALL)
+   return sql.count('?')
+
+# expands the /*CLIENTS*/ marker of a batch SQL into one (?,?) row per
+# (data_source, client_id) pair, returns the SQL with its full param list
+def _expand_clients(sql, clients, params):
+   if not '/*CLIENTS*/' in sql:
+      raise Exception('Batch SQL has no /*CLIENTS*/ marker')
+   before, after = sql.split('/*CLIENTS*/', 1)
+   position = _count_sql_params(before)
+   client_params = []
+   for client_id, data_source in clients:
+      client_params += [data_source, client_id]
+   return (before + ', '.join(['(?,?)'] * len(clients)) + after, 
+      params[:position] + client_params + params[position:])
+
+# (re)loads and validates all SQL files, returns the errors found
+def load_sql():
+   global _sql_texts, _sql_errors
+   texts = {}
+   errors = {}
+   for key, (path, param_count) in _sql_files.iteritems():
+      try:
+         with open(path) as f: text = f.read()
+         if text.strip() == '':
+            raise Exception('file is empty')
+         # param_count is None when it depends on the classifier
+         if param_count != None and _count_sql_params(text) != param_count:
+            raise Exception('expected %d parameters, found %d' % 
+               (param_count, _count_sql_params(text)))
+         texts[key] = text
+      except Exception as e:
+         errors[key] = '%s: %s' % (path, e)
+         logging.error('Invalid PASIR SQL %s (%s)' % (key, errors[key]))
+   # swap all at once, so callers never see a half-reloaded set
+   _sql_texts, _sql_errors = texts, errors
+   logging.info('Loaded %d PASIR SQL statement(s)' % len(texts))
+   return errors
+
+# returns the cached text of the SQL registered as key
+def sql_text(key):
+   try: return _sql_texts[key]
+   except KeyError:
+      raise Exception('PASIR SQL %s is not available: %s' % 
+         (key, _sql_errors.get(key, 'unknown statement')))
+
+load_sql()
+
+# keeps the prepared statements of a single connection, keyed by SQL text
+class _StatementCache:
+   
+   def __init__(self, conn):
+      self.conn = conn
+      self.statements = {}
+      self.lock = Lock()
+   
+   # returns a prepared statement for sql along with the lock guarding it
+   def prepare(self, sql):
+      with self.lock:
+         if sql in self.statements:
+            _count_statement_cache('hits')
+            return self.statements[sql]
+         start = time.time()
+         entry = (self.conn.jconn.prepareStatement(sql), Lock())
+         self.statements[sql] = entry
+         _count_statement_cache('misses', time.time()-start)
+         return entry
+
+_statement_caches = weakref.WeakKeyDictionary()
+_statement_caches_lock = Lock()
+_statement_cache_stats = {'hits': 0, 'misses': 0, 'prepare_time': 0.0}
+
+def _count_statement_cache(counter, prepare_time=0.0):
+   with _statement_caches_lock:
+      _statement_cache_stats[counter] += 1
+      _statement_cache_stats['prepare_time'] += prepare_time
+
+# returns the cached prepared statement for sql on conn and its lock
+def _prepared_statement(conn, sql):
+   with _statement_caches_lock:
+      cache = _statement_caches.get(conn)
+      if cache == None:
+         cache = _StatementCache(conn)
+         _statement_caches[conn] = cache
+   return cache.prepare(sql)
+
+def _bind_params(statement, params):
+   statement.clearParameters()
+   for i in xrange(len(params)):
+      statement.setObject(i+1, params[i])
+
+# reloads the SQL files and drops all prepared statements
+def reload_sql():
+   errors = load_sql()
+   with _statement_caches_lock:
+      _statement_caches.clear()
+   return errors
+
+def get_statistics():
+   with _statement_caches_lock:
+      statement_cache = dict(_statement_cache_stats)
+      statement_cache['connections'] = len(_statement_caches)
+   return {
+      'sql_files': dict((key, path) for key, (path, _) in _sql_files.iteritems()),
+      'sql_errors': dict(_sql_errors),
+      'statement_cache': statement_cache,
+      'initialized': _db2_connection_factory != None,
+      'init_time': _init_time}
+
+class _ProgressPropagatorThread(Thread):
+# writes the intermediate progress of PASIR classifications asynchronously,
+# coalescing the updates of each record to at most one write per interval
+   
+   def __init__(self, interval_sec):
+      Thread.__init__(self)
+      self.setDaemon(True)
+      self.interval_sec = interval_sec
+      self.condition = Condition()
+      self.pending = {}
+   
+   # queues params as the latest progress of instance, replacing older ones
+   def submit(self, instance, params):
+      self.condition.acquire()
+      self.pending[instance] = params
+      self.condition.notify()
+      self.condition.release()
+   
+   # drops the queued progress of instance, if any
+   def discard(self, instance):
+      self.condition.acquire()
+      self.pending.pop(instance, None)
+      self.condition.release()
+   
+   def run(self):
+      while True:
+         self.condition.acquire()
+         now = time.time()
+         due = [(instance, params) for instance, params in self.pending.items() 
+            if now - instance.progress_written_on >= self.interval_sec]
+         for instance, params in due: del self.pending[instance]
+         if len(due) == 0:
+            # sleep until the first pending record is due or new progress arrives
+            wait = self.interval_sec
+            for instance in self.pending.keys():
+               wait = min(wait, instance.progress_written_on + self.interval_sec - now)
+            self.condition.wait(max(wait, 0.05))
+         self.condition.release()
+         for instance, params in due:
+            try:
+               instance._write_progress(params, terminal=False)
+            except Exception as e:
+               logging.exception('Failed to propagate progress of CLASSR_TICKETCLASSIFICATION %s' %
+                  instance.classr_ticketclassification_id)
+
+_progress_propagator = _ProgressPropagatorThread(config.PROGRESS_INTERVAL_SEC)
+if config.PROGRESS_INTERVAL_SEC > 0: _progress_propagator.start()
+
 # use for selects, or inserts when you need the inserted ids
 def sql_to_data_frame(sql, 
    params=[], 
@@ -126,7 +349,10 @@ def sql_execute(sql,
    logger=logging, 
    verbose=False):
    start = time.time()
-   df = pasir_db().cursor().execute(sql, params)
+   statement, lock = _prepared_statement(pasir_db(), sql)
+   with lock:
+      _bind_params(statement, params)
+      statement.executeUpdate()
    if verbose:
       if not logging == None: logger.info('SQL execution time: %f s' % (time.time()-start))   
 
@@ -138,25 +364,237 @@ def sql_using_data_frame(sql,
    field_order, 
    batch_size=1000, 
    logger=logging,
-   verbose=True):
+   verbose=True,
+   conn=None):
    start = time.time()
    # keep the inserted columns only
    data_frame = data_frame[field_order]
+   # convert all values at once, also convert any NaNs to None
+   data_frame = data_frame.astype(object)
+   rows = data_frame.where(pd.notnull(data_frame), None).values.tolist()
    # loop thru all valid batches
-   for x in xrange(int(math.ceil(data_frame.shape[0]/batch_size)+1)): 
+   for first in xrange(0, len(rows), batch_size): 
       # extract batch
-      batch = data_frame[x*batch_size:(x+1)*batch_size]
+      batch = rows[first:first+batch_size]
       if verbose:
-         if not logging == None: logger.info('Processing records %d - %d' % (x*batch_size+1, min((x+1)*batch_size, data_frame.shape[0])))   
-      # convert data_frame into array of tuples, also convert any NaNs to None
-      tuples = [tuple(row) for row in [[(None if pd.isnull(x) else x) for x in row] \
-         for row in batch.values]]
-      # execute
-      pasir_db().cursor().executemany(sql, tuples)
+         if not logging == None: logger.info('Processing records %d - %d' % (first+1, first+len(batch)))   
+      # execute (over the shared connection, unless one was handed over)
+      statement, lock = _prepared_statement(
+         pasir_db() if conn == None else conn, sql)
+      with lock:
+         for row in batch:
+            _bind_params(statement, row)
+            statement.addBatch()
+         statement.executeBatch()
    if verbose:
       if not logging == None: logger.info('Batch SQL execution time: %f s' % (time.time()-start))   
 
 
+# class probability columns of PASIR classifiers without a 'classes' meta
+_default_classes = ['Disk', 'Nonactionable', 'Other', 'Performance', 'Process', 'Server unavailable']
+
+# data quality issues, lowest precedence first (a later one overrides)
+_quality_issues = [
+   ('clean.description', 'Empty description after cleansing'),
+   ('clean.resolution', 'Empty resolution after cleansing'),
+   ('RESOLUTION', 'Empty resolution'),
+   ('DESCRIPTION', 'Empty description')]
+
+def _csv_header(path):
+   with open(path, 'rb') as f:
+      return next(csv.reader(f))
+
+# returns the class probability columns of a classifier output, taken from the
+# comma separated 'classes' meta of the classifier if set, otherwise the ones
+# PASIR classifiers have always had
+def class_columns(classifier, out_columns):
+   if 'classes' in classifier.meta:
+      classes = [c.strip() for c in classifier.meta['classes'].split(',') if c.strip() != '']
+   else:
+      classes = _default_classes
+   missing = [c for c in classes if not c in out_columns]
+   if len(missing) > 0:
+      raise Exception('Class column(s) missing from the classifier output: %s' % ', '.join(missing))
+   return classes
+
+# flags data quality issues of classified tickets in a single pass and nulls
+# out the class and probabilities of the affected tickets (NaN for floats)
+def tag_data_quality(tickets, class_columns):
+   empty = dict((column, pd.isnull(tickets[column]).values) 
+      for column, _ in _quality_issues)
+   both_empty = empty['DESCRIPTION'] & empty['RESOLUTION']
+   issues = np.empty(tickets.shape[0], dtype=object)
+   issues[:] = None
+   for column, issue in _quality_issues:
+      issues[empty[column]] = issue
+   issues[both_empty] = 'Empty description and resolution'
+   dirty = pd.notnull(issues)
+   tickets['CLEAN'] = np.where(dirty, 'N', 'Y')
+   tickets['QUALITY_ISSUE'] = issues
+   if dirty.any():
+      tickets.loc[dirty, ['TICKETCLASS'] + class_columns] = np.NaN
+   return tickets
+
+
+class PasirWatermark:
+# keeps track of the ticket time range [covered_from, watermark) a classifier
+# has already classified successfully for a client and data source
+   
+   def __init__(self, client_id, data_source, classifier_uid, 
+      covered_from, watermark, updated_on):
+      self.client_id = client_id
+      self.data_source = data_source
+      self.classifier_uid = classifier_uid
+      self.covered_from = covered_from
+      self.watermark = watermark
+      self.updated_on = updated_on
+   
+   @classmethod
+   def get(cls, client_id, data_source, classifier_uid, c=None):
+      if c == None: c = persistence.cursor()
+      c.execute("""SELECT 
+         covered_from,
+         watermark,
+         updated_on
+         FROM PASIR_WATERMARK
+         WHERE client_id=? AND data_source=? AND classifier_uid=?""",
+         [client_id, data_source, classifier_uid])
+      row = c.fetchone()
+      if row == None: return None
+      return PasirWatermark(client_id, data_source, classifier_uid,
+         _parse_timestamp(row[0]), _parse_timestamp(row[1]), row[2])
+   
+   # merges [covered_from, watermark) into the covered range in one transaction,
+   # a range not overlapping or touching the covered one is ignored, as that
+   # would leave a gap behind the watermark
+   @classmethod
+   def advance(cls, client_id, data_source, classifier_uid, covered_from, watermark):
+      db = persistence.db()
+      # manage the transaction explicitly, the write lock is taken upfront
+      db.isolation_level = None
+      c = db.cursor()
+      try:
+         c.execute('BEGIN IMMEDIATE')
+         current = PasirWatermark.get(client_id, data_source, classifier_uid, c)
+         if current == None:
+            c.execute("""INSERT INTO PASIR_WATERMARK (
+               client_id,
+               data_source,
+               classifier_uid,
+               covered_from,
+               watermark,
+               updated_on) VALUES (?,?,?,?,?,?)""",
+               [client_id, data_source, classifier_uid, 
+               str(covered_from), str(watermark), str(datetime.datetime.now())])
+         elif covered_from <= current.watermark and watermark >= current.covered_from:
+            c.execute("""UPDATE PASIR_WATERMARK SET
+               covered_from=?,
+               watermark=?,
+               updated_on=?
+               WHERE client_id=? AND data_source=? AND classifier_uid=?""",
+               [str(min(covered_from, current.covered_from)), 
+               str(max(watermark, current.watermark)), 
+               str(datetime.datetime.now()),
+               client_id, data_source, classifier_uid])
+         else:
+            c.execute('ROLLBACK')
+            return False
+         c.execute('COMMIT')
+         return True
+      except:
+         try: c.execute('ROLLBACK')
+         except: pass
+         raise Exception('Failed to advance PASIR watermark of %s/%s/%s' % 
+            (client_id, data_source, classifier_uid))
+
+def _parse_timestamp(value):
+   if value == None: return None
+   for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
+      try: return datetime.datetime.strptime(value, fmt)
+      except ValueError: pass
+   raise Exception('Invalid timestamp: %s' % value)
+
+
+# reads the classifier output of a job and tags its data quality issues,
+# returns the tickets along with the fields to insert in order
+def load_classified_tickets(job_context, classifier, extra_columns=[]):
+   out_csv = os.path.join(job_context.work_dir, 
+      'classified-tickets.csv')
+   if not os.path.exists(out_csv):
+      raise Exception('Classified tickets not found under %s' % out_csv)
+   classes = class_columns(classifier, _csv_header(out_csv))
+   field_order = ['CLASSR_TICKETCLASSIFICATION_ID', 'ID', 'TICKETCLASS'] + \
+      classes + ['CLEAN', 'QUALITY_ISSUE']
+   # read just what's needed, unless the whole CSV is to be rewritten
+   if config.REWRITE_CLASSIFIED_CSV:
+      out_tickets = pd.read_csv(out_csv)
+   else:
+      out_tickets = pd.read_csv(out_csv, usecols = ['ID', 'TICKETCLASS'] + 
+         classes + [column for column, _ in _quality_issues] + extra_columns,
+         dtype = dict((column, object) for column in extra_columns))
+   job_context.logger.info('Checking data quality')
+   tag_data_quality(out_tickets, classes)
+   if config.REWRITE_CLASSIFIED_CSV:
+      out_tickets.to_csv(out_csv, quoting=csv.QUOTE_NONNUMERIC, encoding='utf-8')
+   sql = sql_text('INSERT_CLASSIFIED_TICKETS')
+   if _count_sql_params(sql) != len(field_order):
+      raise Exception('%s expects %d parameters, classifier output has %d fields (%d classes)' % 
+         (config.SQL_INSERT_CLASSIFIED_TICKETS, _count_sql_params(sql), len(field_order), len(classes)))
+   return out_tickets, field_order
+
+# fetches the tickets of a client and data source to classify, in incremental
+# mode only the ones the classifier hasn't classified yet, which are those
+# past the watermark and those that arrived late within
+# WATERMARK_LOOKBACK_DAYS behind it; returns the tickets along with the
+# effective from and fetch timestamps
+def fetch_tickets(classifier, 
+   client_id, 
+   data_source, 
+   from_timestamp, 
+   to_timestamp, 
+   incremental=False, 
+   logger=logging):
+   fetched_on = datetime.datetime.now()
+   fetch_from = from_timestamp
+   if incremental:
+      # skip the part of the window covered by the watermark already, but
+      # for the lookback where tickets may still land in DB2 late, the
+      # anti-join skipping the classified ones
+      watermark = PasirWatermark.get(client_id, data_source, classifier.uid)
+      if (not watermark == None and 
+         watermark.covered_from <= from_timestamp < watermark.watermark):
+         fetch_from = max(from_timestamp, watermark.watermark - 
+            datetime.timedelta(days=config.WATERMARK_LOOKBACK_DAYS))
+      logger.info('Fetching unclassified tickets from %s on' % str(fetch_from))
+   if fetch_from > to_timestamp + datetime.timedelta(days=1):
+      in_tickets = pd.DataFrame()
+   elif incremental:
+      in_tickets = sql_to_data_frame(
+         sql = sql_text('UNCLASSIFIED_TICKETS_TO_CLASSIFY'),
+         params = [data_source,
+            client_id,
+            str(fetch_from),
+            str(to_timestamp),
+            classifier.uid],
+         logger = logger)
+   else:
+      in_tickets = sql_to_data_frame(
+         sql = sql_text('TICKETS_TO_CLASSIFY'),
+         params = [data_source,
+            client_id,
+            str(from_timestamp),
+            str(to_timestamp)],
+         logger = logger)
+   return in_tickets, fetch_from, fetched_on
+
+def _check_create_params(classifier, from_timestamp, to_timestamp):
+   if not type(from_timestamp) == datetime.datetime: raise Exception('Cannot create new PasirTicketClassification, from_timestamp must be of type datetime')
+   if not type(to_timestamp) == datetime.datetime: raise Exception('Cannot create new PasirTicketClassification, to_timestamp must be of type datetime')
+   if classifier == None: raise Exception('Cannot create new PasirTicketClassification without specifying the classifier')
+   if not classifier.enabled: raise Exception('Cannot create new PasirTicketClassification, classifier is not enabled: %s' % classifier.uid)
+   if not classifier.title == 'PASIR': raise Exception('Cannot create new PasirTicketClassification, classifier title is "%s", expected "PASIR": %s' % (classifier.title, classifier.uid))
+
+
 class PasirTicketClassification:
    
    def __init__(self, 
@@ -168,7 +606,9 @@ class PasirTicketClassification:
       from_timestamp, 
       to_timestamp,
       created_on = str(datetime.datetime.now()),
-      ticket_count = None):
+      ticket_count = None,
+      incremental = False,
+      priority = 'interactive'):
       self.job_context = job_context
       self.classr_ticketclassification_id = classr_ticketclassification_id
       self.created_on = created_on
@@ -178,6 +618,26 @@ class PasirTicketClassification:
       self.from_timestamp = from_timestamp
       self.to_timestamp = to_timestamp
       self.ticket_count = ticket_count
+      # in incremental mode only tickets past the watermark, or late ones
+      # within WATERMARK_LOOKBACK_DAYS behind it, are fetched, leaving out
+      # any the classifier has classified already
+      self.incremental = incremental
+      # fetches wait for a slot of their admission priority
+      self.priority = priority
+      self.fetch_from = from_timestamp
+      self.fetched_on = None
+      # shards report their progress and ticket count to the parent
+      # instead of writing the CLASSR_TICKETCLASSIFICATION record
+      self.parent = None
+      # time spent waiting for and holding the ticket insert slot
+      self.insert_wait_time = None
+      self.insert_hold_time = None
+      # guards the progress writes of the CLASSR_TICKETCLASSIFICATION record
+      self.progress_lock = Lock()
+      self.progress_written_on = 0
+      self.progress_closed = False
+      # set once the terminal state has been written
+      self.finished = Event()
    
    # pass ts args as dt objects: datetime.datetime.strptime('2013-01-01','%Y-%m-%d')
    @classmethod
@@ -186,19 +646,42 @@ class PasirTicketClassification:
       client_id, 
       data_source, 
       from_timestamp, 
-      to_timestamp):
+      to_timestamp,
+      incremental=False,
+      priority='interactive'):
       # check params
-      if not type(from_timestamp) == datetime.datetime: raise Exception('Cannot create new PasirTicketClassification, from_timestamp must be of type datetime')
-      if not type(to_timestamp) == datetime.datetime: raise Exception('Cannot create new PasirTicketClassification, to_timestamp must be of type datetime')
-      if classifier == None: raise Exception('Cannot create new PasirTicketClassification without specifying the classifier')
-      if not classifier.enabled: raise Exception('Cannot create new PasirTicketClassification, classifier is not enabled: %s' % classifier.uid)
-      if not classifier.title == 'PASIR': raise Exception('Cannot create new PasirTicketClassification, classifier title is "%s", expected "PASIR": %s' % [classifier.title, classifier.uid])
+      _check_create_params(classifier, from_timestamp, to_timestamp)
       # create job context
       job = store.JobContext.create(classifier.uid)
+      instance = PasirTicketClassification.create_record(
+         job = job,
+         classifier = classifier,
+         client_id = client_id, 
+         data_source = data_source, 
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp,
+         incremental = incremental,
+         priority = priority)
+      # hook progress callback
+      job.aux_progress_callback = instance._update_progress
+      job.logger.info('Ready to fetch')
+      return instance
+   
+   # inserts the CLASSR_TICKETCLASSIFICATION record of a job, returns the instance
+   @classmethod
+   def create_record(cls, 
+      job,
+      classifier,
+      client_id, 
+      data_source, 
+      from_timestamp, 
+      to_timestamp,
+      incremental=False,
+      priority='interactive'):
       # insert into CLASSR_TICKETCLASSIFICATION
       job.logger.info('Inserting CLASSR_TICKETCLASSIFICATION...')
       result = sql_to_data_frame(
-         open(config.SQL_INSERT_TICKETCLASSIFICATION).read(),
+         sql_text('INSERT_TICKETCLASSIFICATION'),
          [classifier.uid,
             job.uid,
             client_id,
@@ -217,16 +700,16 @@ class PasirTicketClassification:
          client_id = client_id, 
          data_source = data_source, 
          from_timestamp = from_timestamp, 
-         to_timestamp = to_timestamp)
-      # hook progress callback
-      job.aux_progress_callback = instance._update_progress
+         to_timestamp = to_timestamp,
+         incremental = incremental,
+         priority = priority)
       # log some info
       job.logger.info('CLASSR_TICKETCLASSIFICATION.ID : %d' % db_id)
       job.logger.info('Client      : %s' % (instance.client_id))
       job.logger.info('Data source : %s' % (instance.data_source))
       job.logger.info('Date from   : %s' % (str(instance.from_timestamp)))
       job.logger.info('Date to     : %s (entire calendar day inclusive)' % (str(instance.to_timestamp)))
-      job.logger.info('Ready to fetch')
+      job.logger.info('Incremental : %s' % (instance.incremental))
       return instance
    
    # invokeable by external caller, returns asynchronously
@@ -234,12 +717,50 @@ class PasirTicketClassification:
       # fetch tickets from DB
       self.job_context.logger.info('Fetching tickets...')
       self._update_progress(1, 'Fetching tickets', 'Progress')
-      in_tickets = sql_to_data_frame(
-         sql = open(config.SQL_TICKETS_TO_CLASSIFY).read(),
-         params = [self.data_source,
-            self.client_id,
-            str(self.from_timestamp),
-            str(self.to_timestamp)])
+      with admission.fetch_slot(self.priority):
+         in_tickets, self.fetch_from, self.fetched_on = fetch_tickets(
+            classifier = self.classifier,
+            client_id = self.client_id,
+            data_source = self.data_source,
+            from_timestamp = self.from_timestamp,
+            to_timestamp = self.to_timestamp,
+            incremental = self.incremental,
+            logger = self.job_context.logger)
+      self.classify_tickets(in_tickets)
+   
+   # blocks until the terminal state of the record has been written
+   def wait(self, timeout=None):
+      return self.finished.wait(timeout)
+   
+   # what it takes to restore the record in a worker process
+   def to_payload(self):
+      return {'type': 'single', 'record': self._record_payload()}
+   
+   def _record_payload(self):
+      return {'id': int(self.classr_ticketclassification_id),
+         'classifier_uid': self.classifier.uid,
+         'client_id': self.client_id,
+         'data_source': self.data_source,
+         'from_timestamp': str(self.from_timestamp),
+         'to_timestamp': str(self.to_timestamp),
+         'incremental': self.incremental,
+         'priority': self.priority}
+   
+   @classmethod
+   def from_record_payload(cls, job, classifier, record):
+      return PasirTicketClassification(
+         job_context = job,
+         classr_ticketclassification_id = record['id'],
+         classifier = classifier,
+         client_id = record['client_id'], 
+         data_source = record['data_source'], 
+         from_timestamp = _parse_timestamp(record['from_timestamp']), 
+         to_timestamp = _parse_timestamp(record['to_timestamp']),
+         incremental = record['incremental'],
+         priority = record.get('priority', 'interactive'))
+   
+   # classifies tickets fetched already, returns asynchronously
+   def classify_tickets(self, in_tickets):
       self.ticket_count = in_tickets.shape[0]
       self.job_context.logger.info('Fetched tickets:  %d' % self.ticket_count)
       # save tickets to CSV
@@ -247,17 +768,20 @@ class PasirTicketClassification:
       in_tickets.to_csv(in_csv, quoting=csv.QUOTE_NONNUMERIC, encoding='utf-8')
       self.job_context.logger.info('Tickets saved to %s' % in_csv)
       # update ticket count in the CLASSR_TICKETCLASSIFICATION record
-      sql_execute(
-         sql = open(config.SQL_UPDATE_TICKET_COUNT).read(),
-         params = [self.ticket_count, 
-            self.classr_ticketclassification_id], 
-         logger = self.job_context.logger,
-         verbose = False)
+      if self.parent == None:
+         sql_execute(
+            sql = sql_text('UPDATE_TICKET_COUNT'),
+            params = [self.ticket_count, 
+               self.classr_ticketclassification_id], 
+            logger = self.job_context.logger,
+            verbose = False)
+      else:
+         self.parent._shard_ticket_count(self)
       # check if any tickets were pulled
       if self.ticket_count == 0:
          self.job_context.logger.info('No tickets to classify')
-         self.job_context.mark_done()
-         self._update_progress(100, 'No tickets to classify', 'Done')
+         # marks the job done, the hook writes the terminal record state
+         self.job_context.update_progress(100, 'No tickets to classify', 'Done')
       else:
          # invoke classifier
          self.classifier.classify(self.job_context, 
@@ -267,8 +791,11 @@ class PasirTicketClassification:
                os.path.join(self.job_context.work_dir, 'classified-tickets.csv'), 
                'TICKETCLASS')
    
-   # invoked by the job_context's callback hook
-   def _update_progress(self, percentage, text, state):
+   # invoked by the job_context's callback hook, results are handed over
+   # when the classified tickets have been loaded by the caller already;
+   # returns the (status, text) the job fails with if inserting them fails
+   def _update_progress(self, percentage, text, state, results=None):
+      failed = None
       if state == 'Progress': state = 'Running'
       
       if percentage == 100 and \
@@ -277,100 +804,532 @@ class PasirTicketClassification:
          state = 'Done'
          self.job_context.logger.info('Classifier finished successfully, processing results...')
          # insert classified tickets
-         self._insert_classified_tickets()
+         if not self._insert_classified_tickets(results):
+            state = 'Error'
+            text = 'Failed inserting tickets'
+            # reflect the failure on the job too, before it is published
+            failed = (state, text)
       
+      if state == 'Done' and self.parent == None: self._advance_watermark()
+      
+      if self.parent == None:
+         self._propagate_progress(percentage, text, state)
+      else:
+         self.parent._shard_progress(self, percentage, text, state)
+      return failed
+   
+   # writes progress to the CLASSR_TICKETCLASSIFICATION record, throttled
+   # for intermediate states
+   def _propagate_progress(self, percentage, text, state):
+      if state == 'Progress': state = 'Running'
       # update progress in CLASSR_TICKETCLASSIFICATION record
-      sql_execute(
-         sql = open(config.SQL_UPDATE_PROGRESS).read(),
-         params = [state, 
-            text,
-            percentage,
-            self.classr_ticketclassification_id], 
-         logger = self.job_context.logger,
-         verbose = False)
+      params = [state, 
+         text,
+         percentage,
+         self.classr_ticketclassification_id]
+      if state in ['Done', 'Error']:
+         # terminal states are written synchronously, superseding any
+         # intermediate progress that is still queued
+         _progress_propagator.discard(self)
+         self._write_progress(params, terminal=True)
+      elif config.PROGRESS_INTERVAL_SEC <= 0:
+         self._write_progress(params, terminal=False)
+      else:
+         _progress_propagator.submit(self, params)
    
-   # invoked by self._update_progress() when progress reaches 100%
-   def _insert_classified_tickets(self):
-      out_csv = os.path.join(self.job_context.work_dir, 
-         'classified-tickets.csv')
-      if not os.path.exists(out_csv):
-         raise Exception('Classified tickets not found under %s' % out_csv)
-      out_tickets = pd.read_csv(out_csv)
+   # records the fetched window as classified, up to the time of the fetch
+   # as tickets may still arrive for the rest of it
+   def _advance_watermark(self):
+      if self.fetched_on == None: return
+      watermark = min(self.to_timestamp + datetime.timedelta(days=1), self.fetched_on)
+      try:
+         if PasirWatermark.advance(self.client_id, self.data_source, 
+            self.classifier.uid, self.from_timestamp, watermark):
+            self.job_context.logger.info('Advanced watermark to %s' % str(watermark))
+         else:
+            self.job_context.logger.info('Watermark left as is, classified window is not adjacent to it')
+      except Exception as e:
+         self.job_context.logger.exception('Failed to advance watermark')
+   
+   # writes progress params to the CLASSR_TICKETCLASSIFICATION record
+   def _write_progress(self, params, terminal):
+      with self.progress_lock:
+         # nothing may overwrite a terminal state
+         if self.progress_closed: return
+         if terminal: self.progress_closed = True
+         self.progress_written_on = time.time()
+         try:
+            sql_execute(
+               sql = sql_text('UPDATE_PROGRESS'),
+               params = params, 
+               logger = self.job_context.logger,
+               verbose = False)
+         finally:
+            if terminal: self.finished.set()
+   
+   # invoked by self._update_progress() when progress reaches 100%, results
+   # are the (out_tickets, field_order) returned by load_classified_tickets(),
+   # returns whether the classified tickets were inserted successfully
+   def _insert_classified_tickets(self, results=None):
+      if results == None:
+         results = load_classified_tickets(self.job_context, self.classifier)
+      out_tickets, field_order = results
       # add missing DB columns
       out_tickets['CLASSR_TICKETCLASSIFICATION_ID'] = self.classr_ticketclassification_id
-      out_tickets['CLEAN'] = 'Y'
-      out_tickets['QUALITY_ISSUE'] = None
-      self.job_context.logger.info('Checking data quality')
-      # identify and mark data quality issues
-      # empty clean.description
-      out_tickets.loc[pd.isnull(out_tickets['clean.description']),'CLEAN'] = 'N'
-      out_tickets.loc[pd.isnull(out_tickets['clean.description']),'QUALITY_ISSUE'] = \
-         'Empty description after cleansing'
-      # empty clean.resolution
-      out_tickets.loc[pd.isnull(out_tickets['clean.resolution']),'CLEAN'] = 'N'
-      out_tickets.loc[pd.isnull(out_tickets['clean.resolution']),'QUALITY_ISSUE'] = \
-         'Empty resolution after cleansing'
-      # empty resolution
-      out_tickets.loc[pd.isnull(out_tickets['RESOLUTION']),'CLEAN'] = 'N'
-      out_tickets.loc[pd.isnull(out_tickets['RESOLUTION']),'QUALITY_ISSUE'] = \
-         'Empty resolution'
-      # empty description
-      out_tickets.loc[pd.isnull(out_tickets['DESCRIPTION']),'CLEAN'] = 'N'
-      out_tickets.loc[pd.isnull(out_tickets['DESCRIPTION']),'QUALITY_ISSUE'] = \
-         'Empty description'
-      # empty description and resolution
-      out_tickets.loc[(pd.isnull(out_tickets['DESCRIPTION'])) & 
-      (pd.isnull(out_tickets['RESOLUTION'])),'CLEAN'] = 'N'
-      out_tickets.loc[(pd.isnull(out_tickets['DESCRIPTION'])) & 
-      (pd.isnull(out_tickets['RESOLUTION'])),'QUALITY_ISSUE'] = \
-         'Empty description and resolution'
-      # null out fields where data issue was identified (must use NaN for floats)
-      out_tickets.loc[out_tickets['CLEAN']=='N','TICKETCLASS'] = None
-      out_tickets.loc[out_tickets['CLEAN']=='N','Disk'] = np.NaN
-      out_tickets.loc[out_tickets['CLEAN']=='N','Nonactionable'] = np.NaN
-      out_tickets.loc[out_tickets['CLEAN']=='N','Other'] = np.NaN
-      out_tickets.loc[out_tickets['CLEAN']=='N','Performance'] = np.NaN
-      out_tickets.loc[out_tickets['CLEAN']=='N','Process'] = np.NaN
-      out_tickets.loc[out_tickets['CLEAN']=='N','Server unavailable'] = np.NaN
-      out_tickets.to_csv(out_csv, quoting=csv.QUOTE_NONNUMERIC, encoding='utf-8')
+      sql = sql_text('INSERT_CLASSIFIED_TICKETS')
       # insert classified tickets
       self.job_context.logger.info('Inserting classified tickets')
+      wait_start = time.time()
       _ticket_insert_semaphore.acquire()
+      hold_start = time.time()
+      self.insert_wait_time = hold_start - wait_start
+      conn = None
       try:
+         # in concurrent mode every job writes over its own connection
+         # within a single transaction, so jobs can't see or break each
+         # other's partial results; shards always do, a failed shard is
+         # retried under the parent's record and must leave no rows behind
+         if config.INSERT_MODE == 'concurrent' or self.parent != None:
+            conn = dedicated_pasir_db()
          sql_using_data_frame(
-            sql = open(config.SQL_INSERT_CLASSIFIED_TICKETS).read(),
+            sql = sql,
             data_frame = out_tickets,
-            field_order = [
-               'CLASSR_TICKETCLASSIFICATION_ID',
-               'ID',
-               'TICKETCLASS',
-               'Disk',
-               'Nonactionable',
-               'Other',
-               'Performance',
-               'Process',
-               'Server unavailable',
-               'CLEAN',
-               'QUALITY_ISSUE'],
+            field_order = field_order,
             batch_size = config.BATCH_SIZE,
             logger = self.job_context.logger,
-            verbose = True)
+            verbose = True,
+            conn = conn)
+         if conn != None: conn.commit()
          self.job_context.logger.info('Classified tickets inserted successfully')
+         return True
       except Exception as e:
          self.job_context.logger.exception('An exception occured while classified tickets were tried to be insterted.')
-         self._update_progress(100, 'Failed inserting tickets', 'Error')
+         if conn != None:
+            try: conn.rollback()
+            except: self.job_context.logger.exception('Rolling back the inserted tickets failed')
+         return False
       finally:
+         if conn != None:
+            try: conn.close()
+            except: pass
          _ticket_insert_semaphore.release()
+         self.insert_hold_time = time.time() - hold_start
+         self.job_context.logger.info(
+            'Insert slot (%s mode): waited %f s, held %f s' % 
+            (config.INSERT_MODE, self.insert_wait_time, self.insert_hold_time))
 
 
+# (client_id, data_source) keys of tickets, compared as text
+def _client_keys(tickets):
+   return [tickets['CLIENT_ID'].map(unicode), tickets['DATA_SOURCE'].map(unicode)]
 
 
+class PasirBatchTicketClassification:
+# classifies the tickets of several clients and data sources with a single
+# fetch and classifier run, then splits the results back into one
+# CLASSR_TICKETCLASSIFICATION record per client and data source
+   
+   def __init__(self, 
+      job_context,
+      classifier,
+      members,
+      from_timestamp, 
+      to_timestamp):
+      self.job_context = job_context
+      self.classifier = classifier
+      self.members = members
+      self.from_timestamp = from_timestamp
+      self.to_timestamp = to_timestamp
+      self.ticket_count = None
+   
+   # clients is a list of (client_id, data_source) pairs
+   @classmethod
+   def create(cls, 
+      classifier,
+      clients,
+      from_timestamp, 
+      to_timestamp):
+      _check_create_params(classifier, from_timestamp, to_timestamp)
+      clients = [(client_id, data_source) for client_id, data_source in clients]
+      if len(clients) == 0: raise Exception('Cannot create new PasirBatchTicketClassification without clients')
+      if len(set(clients)) < len(clients): raise Exception('Cannot create new PasirBatchTicketClassification, clients contain duplicates')
+      # one job for the whole batch, one record per client and data source
+      job = store.JobContext.create(classifier.uid)
+      members = []
+      for client_id, data_source in clients:
+         members.append(PasirTicketClassification.create_record(
+            job = job,
+            classifier = classifier,
+            client_id = client_id, 
+            data_source = data_source, 
+            from_timestamp = from_timestamp, 
+            to_timestamp = to_timestamp,
+            priority = 'batch'))
+      instance = PasirBatchTicketClassification(
+         job_context = job,
+         classifier = classifier,
+         members = members,
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp)
+      job.aux_progress_callback = instance._update_progress
+      job.logger.info('Batch of %d client(s) ready to fetch' % len(members))
+      return instance
+   
+   # invokeable by external caller, returns asynchronously
+   def fetch_and_classify(self):
+      self.job_context.logger.info('Fetching tickets...')
+      self._update_progress(1, 'Fetching tickets', 'Progress')
+      fetched_on = datetime.datetime.now()
+      sql, params = _expand_clients(sql_text('TICKETS_TO_CLASSIFY_BATCH'),
+         [(m.client_id, m.data_source) for m in self.members],
+         [str(self.from_timestamp), str(self.to_timestamp)])
+      with admission.fetch_slot('batch'):
+         in_tickets = sql_to_data_frame(sql = sql, params = params)
+      self.ticket_count = in_tickets.shape[0]
+      self.job_context.logger.info('Fetched tickets:  %d' % self.ticket_count)
+      # save tickets to CSV
+      in_csv = os.path.join(self.job_context.work_dir, 'tickets.csv')
+      in_tickets.to_csv(in_csv, quoting=csv.QUOTE_NONNUMERIC, encoding='utf-8')
+      self.job_context.logger.info('Tickets saved to %s' % in_csv)
+      # split ticket counts per record
+      if self.ticket_count > 0:
+         counts = in_tickets.groupby(_client_keys(in_tickets)).size()
+      for member in self.members:
+         member.fetched_on = fetched_on
+         key = (unicode(member.client_id), unicode(member.data_source))
+         member.ticket_count = int(counts[key]) if self.ticket_count > 0 and key in counts else 0
+         sql_execute(
+            sql = sql_text('UPDATE_TICKET_COUNT'),
+            params = [member.ticket_count, 
+               member.classr_ticketclassification_id], 
+            logger = self.job_context.logger,
+            verbose = False)
+         # clients without tickets are done right away
+         if member.ticket_count == 0:
+            member._update_progress(100, 'No tickets to classify', 'Done')
+      if self.ticket_count == 0:
+         self.job_context.logger.info('No tickets to classify')
+         self.job_context.update_progress(100, 'No tickets to classify', 'Done')
+      else:
+         # invoke classifier
+         self.classifier.classify(self.job_context, 
+               in_csv, 
+               'DESCRIPTION', 
+               'RESOLUTION', 
+               os.path.join(self.job_context.work_dir, 'classified-tickets.csv'), 
+               'TICKETCLASS')
+   
+   def wait(self, timeout=None):
+      return all([member.wait(timeout) for member in self.members])
+   
+   def to_payload(self):
+      return {'type': 'batch', 
+         'members': [member._record_payload() for member in self.members],
+         'from_timestamp': str(self.from_timestamp),
+         'to_timestamp': str(self.to_timestamp)}
+   
+   # invoked by the job_context's callback hook, passes progress on to the
+   # records still open, splitting the classified tickets between them;
+   # returns the (status, text) the job ends with if any record failed, Done
+   # listing the failed clients as long as some records were inserted
+   def _update_progress(self, percentage, text, state):
+      members = [member for member in self.members if not member.progress_closed]
+      if percentage == 100 and \
+         state != 'Error' and \
+         self.ticket_count > 0:
+         try:
+            out_tickets, field_order = load_classified_tickets(
+               self.job_context, self.classifier, ['CLIENT_ID', 'DATA_SOURCE'])
+            groups = out_tickets.groupby(_client_keys(out_tickets))
+         except Exception as e:
+            self.job_context.logger.exception('Failed to load classified tickets')
+            for member in members:
+               member._update_progress(100, 'Failed loading classified tickets', 'Error')
+            raise
+         failed = []
+         for member in members:
+            key = (unicode(member.client_id), unicode(member.data_source))
+            # copies, so the record's columns aren't assigned to a view
+            results = (groups.get_group(key).copy(), field_order) if key in groups.groups else \
+               (out_tickets[0:0].copy(), field_order)
+            if member._update_progress(percentage, text, state, results) != None:
+               self.job_context.logger.error('Failed inserting tickets of %s/%s' % 
+                  (member.client_id, member.data_source))
+               failed.append('%s/%s' % (member.client_id, member.data_source))
+         if len(failed) == len(members):
+            return ('Error', 'Failed inserting tickets of all %d client(s)' % len(failed))
+         if len(failed) > 0:
+            return ('Done', 'Failed inserting tickets of %d of %d client(s): %s' % 
+               (len(failed), len(members), ', '.join(failed)))
+      else:
+         for member in members:
+            member._update_progress(percentage, text, state)
+      return None
 
 
+class PasirShardedTicketClassification:
+# splits a large date window into shards sized by their estimated ticket
+# count and classifies each one as a child job, rolling progress and status
+# up to a single CLASSR_TICKETCLASSIFICATION record; failed shards are
+# retried on their own
+   
+   def __init__(self, 
+      record,
+      from_timestamp, 
+      to_timestamp,
+      incremental = False):
+      self.record = record
+      self.priority = record.priority
+      self.job_context = record.job_context
+      self.classr_ticketclassification_id = record.classr_ticketclassification_id
+      self.classifier = record.classifier
+      self.client_id = record.client_id
+      self.data_source = record.data_source
+      self.from_timestamp = from_timestamp
+      self.to_timestamp = to_timestamp
+      self.incremental = incremental
+      self.lock = Lock()
+      self.shards = []
+      self.estimates = {}
+      self.retries = 0
+      self.fetched_on = None
+   
+   # same params as PasirTicketClassification.create()
+   @classmethod
+   def create(cls, 
+      classifier,
+      client_id, 
+      data_source, 
+      from_timestamp, 
+      to_timestamp,
+      incremental=False,
+      priority='interactive'):
+      _check_create_params(classifier, from_timestamp, to_timestamp)
+      job = store.JobContext.create(classifier.uid)
+      record = PasirTicketClassification.create_record(
+         job = job,
+         classifier = classifier,
+         client_id = client_id, 
+         data_source = data_source, 
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp,
+         incremental = incremental,
+         priority = priority)
+      instance = PasirShardedTicketClassification(
+         record = record,
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp,
+         incremental = incremental)
+      # the parent job only reflects the rolled-up progress of its shards
+      job.aux_progress_callback = record._propagate_progress
+      job.logger.info('Ready to estimate shards')
+      return instance
+   
+   # invokeable by external caller, returns asynchronously
+   def fetch_and_classify(self):
+      self.job_context.update_progress(1, 'Estimating ticket counts')
+      self.fetched_on = datetime.datetime.now()
+      ranges = self._plan_shards()
+      self.job_context.logger.info('Classifying in %d shard(s)' % len(ranges))
+      for from_timestamp, to_timestamp, estimate in ranges:
+         self.job_context.logger.info('Shard %s - %s: ~%d tickets' % 
+            (from_timestamp.date(), to_timestamp.date(), estimate))
+      with self.lock:
+         shards = [self._create_shard(from_timestamp, to_timestamp, estimate) 
+            for from_timestamp, to_timestamp, estimate in ranges]
+      for shard in shards:
+         store.submit(_run_shard, [shard])
+   
+   # blocks until the rolled-up terminal state has been written
+   def wait(self, timeout=None):
+      return self.record.wait(timeout)
+   
+   def to_payload(self):
+      return {'type': 'sharded', 'record': self.record._record_payload()}
+   
+   # cuts the window into (from, to, estimate) ranges of whole days, each
+   # holding about config.SHARD_TARGET_TICKETS tickets
+   def _plan_shards(self):
+      try:
+         with admission.fetch_slot(self.priority):
+            counts = sql_to_data_frame(
+               sql = sql_text('COUNT_TICKETS_BY_DAY'),
+               params = [self.data_source,
+                  self.client_id,
+                  str(self.from_timestamp),
+                  str(self.to_timestamp)],
+               logger = self.job_context.logger)
+         per_day = dict((str(day)[:10], int(count)) for day, count in 
+            zip(counts['TICKET_DAY'], counts['TICKET_COUNT']))
+      except Exception as e:
+         self.job_context.logger.exception('Failed to estimate ticket counts, not sharding')
+         return [(self.from_timestamp, self.to_timestamp, 0)]
+      ranges = []
+      start = day = self.from_timestamp
+      estimate = 0
+      while day <= self.to_timestamp:
+         estimate += per_day.get(str(day.date()), 0)
+         if estimate >= config.SHARD_TARGET_TICKETS or day >= self.to_timestamp:
+            ranges.append((start, day, estimate))
+            start = day + datetime.timedelta(days=1)
+            estimate = 0
+         day += datetime.timedelta(days=1)
+      return ranges
+   
+   # needs self.lock held
+   # superseded are the failed attempts of a shard being retried
+   def _create_shard(self, from_timestamp, to_timestamp, estimate, superseded=[]):
+      shard = PasirTicketClassification(
+         job_context = store.JobContext.create(self.classifier.uid),
+         classr_ticketclassification_id = self.classr_ticketclassification_id,
+         classifier = self.classifier,
+         client_id = self.client_id, 
+         data_source = self.data_source, 
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp,
+         incremental = self.incremental,
+         priority = self.priority)
+      shard.parent = self
+      shard.progress = (0, 'Scheduled')
+      shard.superseded = superseded
+      shard.job_context.aux_progress_callback = shard._update_progress
+      shard.job_context.logger.info('Shard %s - %s of job %s' % 
+         (from_timestamp.date(), to_timestamp.date(), self.job_context.uid))
+      self.shards.append(shard)
+      self.estimates[shard] = estimate
+      return shard
+   
+   # invoked by a shard once it has fetched its tickets
+   def _shard_ticket_count(self, shard):
+      with self.lock:
+         ticket_count = sum([s.ticket_count for s in self.shards if s.ticket_count != None])
+      sql_execute(
+         sql = sql_text('UPDATE_TICKET_COUNT'),
+         params = [ticket_count, 
+            self.classr_ticketclassification_id], 
+         logger = self.job_context.logger,
+         verbose = False)
+   
+   # invoked by a shard instead of writing the record, rolls progress up
+   # to the parent job, retrying failed shards once all have finished
+   def _shard_progress(self, shard, percentage, text, state):
+      with self.lock:
+         shard.progress = (percentage, state)
+         # weigh shards by their estimated size
+         total = sum([max(self.estimates[s], 1) for s in self.shards])
+         overall = sum([max(self.estimates[s], 1) * s.progress[0] for s in self.shards]) / float(total)
+         running = [s for s in self.shards if not s.progress[1] in ['Done', 'Error']]
+         failed = [s for s in self.shards if s.progress[1] == 'Error']
+         retry = []
+         if len(running) == 0 and len(failed) > 0 and self.retries < config.SHARD_MAX_RETRIES:
+            self.retries += 1
+            for s in failed:
+               self.job_context.logger.info('Retrying shard %s - %s (attempt %d)' % 
+                  (s.from_timestamp.date(), s.to_timestamp.date(), self.retries+1))
+               self.shards.remove(s)
+               retry.append(self._create_shard(s.from_timestamp, s.to_timestamp, 
+                  self.estimates.pop(s), s.superseded + [s]))
+            running = retry
+      # the jobs of failed attempts are kept for inspection until a retry
+      # succeeds, those of shards failing for good along with the parent's
+      if state == 'Done':
+         for s in shard.superseded: self._remove_shard(s)
+         shard.superseded = []
+      if len(running) > 0:
+         done = len(self.shards) - len(running)
+         self.job_context.update_progress(min(overall, 99), 
+            '%d of %d shards done' % (done, len(self.shards)))
+         for s in retry: store.submit(_run_shard, [s])
+      elif len(failed) > 0:
+         self.job_context.update_progress(100, 
+            '%d of %d shards failed' % (len(failed), len(self.shards)), 'Error')
+      else:
+         self.record.fetched_on = self.fetched_on
+         self.record._advance_watermark()
+         self.job_context.update_progress(100, 'Done', 'Done')
+
+   def _remove_shard(self, shard):
+      try:
+         shard.job_context.remove()
+         self.job_context.logger.info('Removed job %s of a failed attempt of shard %s - %s' % 
+            (shard.job_context.uid, shard.from_timestamp.date(), shard.to_timestamp.date()))
+      except Exception as e:
+         self.job_context.logger.exception('Failed to remove job %s of a failed shard' % 
+            shard.job_context.uid)
 
+# runs a shard on the worker pool, reporting any failure as its progress
+def _run_shard(shard):
+   try:
+      shard.fetch_and_classify()
+   except Exception as e:
+      shard.job_context.logger.exception('Shard failed')
+      shard.job_context.update_progress(100, str(e), 'Error')
 
 
+# runs classification.fetch_and_classify(), reporting any failure as the
+# job's progress
+def _run_classification(classification):
+   try:
+      classification.fetch_and_classify()
+   except Exception as e:
+      classification.job_context.logger.exception('Classification failed')
+      classification.job_context.update_progress(100, str(e), 'Error')
 
+# runs classification.fetch_and_classify() in the background, on a worker
+# process if the server has any
+def launch(classification):
+   if jobqueue.dispatching():
+      jobqueue.put(classification.job_context.uid, 'pasir', 
+         classification.to_payload())
+   else:
+      Thread(target = _run_classification, args = (classification,)).start()
 
+# restores a classification from its payload, hooked up to its job
+def from_payload(job, payload):
+   classifier = store.Classifier.get(job.classifier_uid)
+   if classifier == None: raise Exception('Classifier %s not found' % job.classifier_uid)
+   if payload['type'] == 'single':
+      instance = PasirTicketClassification.from_record_payload(job, classifier, payload['record'])
+      job.aux_progress_callback = instance._update_progress
+   elif payload['type'] == 'batch':
+      instance = PasirBatchTicketClassification(
+         job_context = job,
+         classifier = classifier,
+         members = [PasirTicketClassification.from_record_payload(job, classifier, record) 
+            for record in payload['members']],
+         from_timestamp = _parse_timestamp(payload['from_timestamp']), 
+         to_timestamp = _parse_timestamp(payload['to_timestamp']))
+      job.aux_progress_callback = instance._update_progress
+   elif payload['type'] == 'sharded':
+      record = PasirTicketClassification.from_record_payload(job, classifier, payload['record'])
+      instance = PasirShardedTicketClassification(
+         record = record,
+         from_timestamp = record.from_timestamp, 
+         to_timestamp = record.to_timestamp,
+         incremental = record.incremental)
+      job.aux_progress_callback = record._propagate_progress
+   else:
+      raise Exception('Unknown PASIR classification type %s' % payload['type'])
+   return instance
 
+# job queue handler of 'pasir' jobs, returns once the classification has
+# finished
+def run_payload(job, payload):
+   classification = from_payload(job, payload)
+   try:
+      classification.fetch_and_classify()
+   except Exception as e:
+      job.logger.exception('Classification failed')
+      job.update_progress(100, str(e), 'Error')
+   classification.wait()
 
+# fails the records of a 'pasir' job that never finished, e.g. as it was
+# cancelled before it started or its worker died
+def abandon_payload(payload, text):
+   if payload['type'] == 'batch': records = payload['members']
+   else: records = [payload['record']]
+   for record in records:
+      sql_execute(
+         sql = sql_text('UPDATE_PROGRESS'),
+         params = ['Error', text, 100, record['id']], 
+         verbose = False)
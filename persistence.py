@@ -1,7 +1,8 @@
 import sqlite3
 
 def db():
-   return sqlite3.connect('classr.db')
+   # wait for the write lock of other threads and worker processes
+   return sqlite3.connect('classr.db', timeout=30)
 
 def cursor():
    return db().cursor()
@@ -0,0 +1,130 @@
+from threading import Thread, Lock, Condition
+from collections import OrderedDict
+import time
+import logging
+
+import persistence
+import config
+import jobqueue
+
+# pushes job progress to subscribers as it is reported: jobs running in this
+# process publish their updates directly, those of worker processes are
+# picked up by polling classr.db once for all subscribed jobs
+
+_terminal_statuses = ['Done', 'Error', 'Cancelled']
+
+def is_terminal(status):
+   return status in _terminal_statuses
+
+def _event(uid, status, progress_percentage, progress_text):
+   return {'uid': uid,
+      'status': status,
+      'progress_percentage': progress_percentage,
+      'progress_text': progress_text}
+
+# current status events of jobs, in the order of uids, unknown jobs left out
+def read_statuses(uids):
+   statuses = {}
+   c = persistence.cursor()
+   # stay within SQLite's limit of host parameters
+   for i in range(0, len(uids), 500):
+      chunk = uids[i:i+500]
+      c.execute("""SELECT uid, status, progress_percentage, progress_text
+         FROM JOB WHERE uid IN (%s)""" % ','.join(['?'] * len(chunk)), chunk)
+      for row in c.fetchall():
+         statuses[row[0]] = _event(*row)
+   return [statuses[uid] for uid in uids if uid in statuses]
+
+
+class Subscription:
+# buffers the events of a set of jobs for one subscriber; only the latest
+# event of a job is kept, and past buffer_size jobs the oldest are dropped
+
+   def __init__(self, uids, buffer_size):
+      self.uids = set(uids)
+      self.buffer_size = buffer_size
+      self.condition = Condition()
+      self.pending = OrderedDict()
+      self.dropped = 0
+
+   def push(self, event):
+      with self.condition:
+         self.pending.pop(event['uid'], None)
+         self.pending[event['uid']] = event
+         while len(self.pending) > self.buffer_size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+         self.condition.notify()
+
+   # returns the events buffered, waiting up to timeout_sec for one
+   def next(self, timeout_sec):
+      deadline = time.time() + timeout_sec
+      with self.condition:
+         while len(self.pending) == 0:
+            remaining = deadline - time.time()
+            if remaining <= 0: return []
+            self.condition.wait(remaining)
+         events = self.pending.values()
+         self.pending = OrderedDict()
+         return events
+
+
+class _ProgressBus:
+
+   def __init__(self):
+      self.lock = Lock()
+      self.subscriptions = []
+      self.poller = None
+      self.last_polled = {}
+
+   def subscribe(self, uids):
+      subscription = Subscription(uids, config.PROGRESS_STREAM_BUFFER)
+      with self.lock:
+         self.subscriptions.append(subscription)
+         if jobqueue.dispatching() and self.poller == None:
+            self.poller = Thread(target = self.poll)
+            self.poller.setDaemon(True)
+            self.poller.start()
+      return subscription
+
+   def unsubscribe(self, subscription):
+      with self.lock:
+         if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+   def publish(self, uid, status, progress_percentage, progress_text):
+      if len(self.subscriptions) == 0: return
+      with self.lock: subscriptions = list(self.subscriptions)
+      event = _event(uid, status, progress_percentage, progress_text)
+      for subscription in subscriptions:
+         if uid in subscription.uids: subscription.push(event)
+
+   # publishes the updates worker processes have written since the last poll
+   def poll(self):
+      while True:
+         time.sleep(config.PROGRESS_POLL_INTERVAL_SEC)
+         try:
+            with self.lock:
+               uids = set()
+               for subscription in self.subscriptions: uids |= subscription.uids
+            for uid in self.last_polled.keys():
+               if not uid in uids: del self.last_polled[uid]
+            if len(uids) == 0: continue
+            for event in read_statuses(list(uids)):
+               last = self.last_polled.get(event['uid'])
+               self.last_polled[event['uid']] = event
+               if last != event:
+                  self.publish(**event)
+         except Exception as e:
+            logging.exception('Failed to poll job progress')
+
+_bus = _ProgressBus()
+
+def subscribe(uids):
+   return _bus.subscribe(uids)
+
+def unsubscribe(subscription):
+   _bus.unsubscribe(subscription)
+
+def publish(uid, status, progress_percentage, progress_text):
+   _bus.publish(uid, status, progress_percentage, progress_text)
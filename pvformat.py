@@ -0,0 +1,203 @@
+import os
+import uuid
+import logging
+
+# binary format of PV weights and vocabularies, written next to the text
+# files they are converted from as a resource is added:
+#   <file>.npy          float32 matrix of a weights file
+#   <file>.float16.npy  its compact variants, written for the precisions
+#   <file>.int8.npy     given, int8 rows scaled to [-127, 127] by the
+#   <file>.int8.scale.npy  float32 scale of each row
+#   <file>.tokens.bin   UTF-8 tokens of a vocabulary, or of the rows of a
+#                       word2vec-style weights file, back to back
+#   <file>.offsets.npy  start offsets of the tokens, and their end, uint32
+#                       unless the tokens take up 4 GB or more
+#   <file>.sorted.npy   int32 token ids in the order of the tokens
+# opened read-only with mmap, their pages are shared by all processes
+# through the page cache instead of being parsed into each one's memory;
+# no model type in this tree reads the compact variants yet, quantize()
+# writes them on demand, see benchmarks/memory.py
+
+_weight_extensions = ['.txt', '.csv', '.vec']
+_vocabulary_file = 'vocab.txt'
+
+def _save(path, array):
+   import numpy as np
+   part_path = '%s.%s.part' % (path, uuid.uuid1())
+   try:
+      with open(part_path, 'wb') as f: np.save(f, array)
+      os.rename(part_path, path)
+   finally:
+      if os.path.exists(part_path): os.remove(part_path)
+
+def _write_tokens(path, tokens):
+   import numpy as np
+   encoded = [token.encode('utf-8') if isinstance(token, unicode) else token for token in tokens]
+   lengths = [len(token) for token in encoded]
+   offsets = np.zeros(len(encoded) + 1,
+      dtype=np.uint32 if sum(lengths) < 2**32 else np.int64)
+   offsets[1:] = np.cumsum(lengths)
+   with open(path + '.tokens.bin', 'wb') as f:
+      for token in encoded: f.write(token)
+   _save(path + '.offsets.npy', offsets)
+   order = sorted(range(len(encoded)), key=lambda i: encoded[i])
+   _save(path + '.sorted.npy', np.array(order, dtype=np.int32))
+   return [path + '.tokens.bin', path + '.offsets.npy', path + '.sorted.npy']
+
+def _is_float(value):
+   try:
+      float(value)
+      return True
+   except ValueError:
+      return False
+
+# iterates over the lines of a text weights file, rows of comma- or
+# whitespace-separated numbers, optionally led by a token and after a
+# '<rows> <columns>' header, as (line, token, fields), token and fields being
+# None for lines that aren't rows
+def _read_rows(f):
+   for i, line in enumerate(f):
+      fields = line.replace(',', ' ').split()
+      if len(fields) == 0 or (i == 0 and len(fields) == 2 and
+         all([field.isdigit() for field in fields])):
+         yield line, None, None
+      elif not _is_float(fields[0]):
+         yield line, fields[0], fields[1:]
+      else:
+         yield line, '', fields
+
+# parses in two passes, the shape first, then the values straight into the
+# memory-mapped output, so weights of any size take up little memory
+def convert_weights(path):
+   import numpy as np
+   rows = 0
+   columns = None
+   with open(path, 'rb') as f:
+      for line, token, fields in _read_rows(f):
+         if fields == None: continue
+         if columns == None: columns = len(fields)
+         elif len(fields) != columns:
+            raise Exception('Row %d of %s has %d values, expected %d' % (rows + 1, path, len(fields), columns))
+         rows += 1
+   if rows == 0: return []
+   tokens = []
+   part_path = '%s.npy.%s.part' % (path, uuid.uuid1())
+   try:
+      weights = np.lib.format.open_memmap(part_path, mode='w+', dtype=np.float32, shape=(rows, columns))
+      i = 0
+      with open(path, 'rb') as f:
+         for line, token, fields in _read_rows(f):
+            if fields == None: continue
+            if token != '': tokens.append(token.decode('utf-8'))
+            weights[i] = [float(field) for field in fields]
+            i += 1
+      weights.flush()
+      del weights
+      os.rename(part_path, path + '.npy')
+   finally:
+      if os.path.exists(part_path): os.remove(part_path)
+   written = [path + '.npy']
+   if len(tokens) == rows: written += _write_tokens(path, tokens)
+   return written
+
+def _variant_paths(path, precision):
+   if precision == 'float16': return [path + '.float16.npy']
+   if precision == 'int8': return [path + '.int8.npy', path + '.int8.scale.npy']
+   return [path + '.npy']
+
+def has_variant(path, precision):
+   return all([os.path.exists(p) for p in _variant_paths(path, precision)])
+
+# writes a compact variant of a converted weights file, returns the paths
+# written
+def quantize(path, precision):
+   import numpy as np
+   weights = np.load(path + '.npy', mmap_mode='r')
+   if precision == 'float16':
+      _save(path + '.float16.npy', weights.astype(np.float16))
+   elif precision == 'int8':
+      if weights.shape[1] > 0: scale = np.abs(weights).max(axis=1) / 127.0
+      else: scale = np.zeros(weights.shape[0])
+      scale = scale.astype(np.float32)
+      scale[scale == 0] = 1
+      _save(path + '.int8.npy', np.rint(weights / scale[:, None]).astype(np.int8))
+      _save(path + '.int8.scale.npy', scale)
+   else:
+      raise Exception('Cannot quantize to %s' % precision)
+   return _variant_paths(path, precision)
+
+# converts a vocabulary of a token per line, fields after it are ignored
+def convert_vocabulary(path):
+   tokens = []
+   with open(path, 'rb') as f:
+      for line in f:
+         fields = line.split()
+         if len(fields) > 0: tokens.append(fields[0].decode('utf-8'))
+   return _write_tokens(path, tokens)
+
+# writes the binary format of the text files of a resource dir that don't
+# have it yet, and the compact variants of the precisions given of weights
+# files, returns the paths written
+def convert(resource_type, dir_path, precisions=[]):
+   written = []
+   for root, dirs, files in os.walk(dir_path):
+      for name in sorted(files):
+         path = os.path.join(root, name)
+         try:
+            if resource_type == 'vocab' and name == _vocabulary_file:
+               if not os.path.exists(path + '.tokens.bin'): written += convert_vocabulary(path)
+            elif resource_type == 'pv' and os.path.splitext(name)[1] in _weight_extensions:
+               if not os.path.exists(path + '.npy'): written += convert_weights(path)
+               for precision in precisions:
+                  if os.path.exists(path + '.npy') and not has_variant(path, precision):
+                     written += quantize(path, precision)
+         except Exception as e:
+            logging.warning('Cannot convert %s to the binary format: %s' % (path, e))
+   return written
+
+_derived_suffixes = ['.int8.scale.npy', '.float16.npy', '.int8.npy', '.offsets.npy', 
+   '.sorted.npy', '.tokens.bin', '.npy']
+
+# whether a file was written by convert() from a text file next to it;
+# derived files are left out of resource manifests and archives, the
+# receiving server converting the text files itself
+def is_derived(path):
+   for suffix in _derived_suffixes:
+      if not path.endswith(suffix): continue
+      source = path[:-len(suffix)]
+      name = os.path.basename(source)
+      if ((name == _vocabulary_file or os.path.splitext(name)[1] in _weight_extensions) and 
+         os.path.isfile(source)):
+         return True
+   return False
+
+def has_binary(path):
+   return os.path.exists(path + '.npy') or os.path.exists(path + '.tokens.bin')
+
+# the weights matrix converted from a text file at a precision,
+# memory-mapped read-only
+def open_weights(path, precision='float32'):
+   import numpy as np
+   if not has_variant(path, precision):
+      raise Exception('Weights %s have no %s variant' % (path, precision))
+   if precision == 'int8': return QuantizedWeights(path)
+   return np.load(_variant_paths(path, precision)[0], mmap_mode='r')
+
+
+class QuantizedWeights:
+# int8 weights, memory-mapped read-only, indexed by rows, which come back
+# as float32
+
+   def __init__(self, path):
+      import numpy as np
+      self.values = np.load(path + '.int8.npy', mmap_mode='r')
+      self.scale = np.load(path + '.int8.scale.npy', mmap_mode='r')
+      self.shape = self.values.shape
+
+   def __len__(self):
+      return len(self.values)
+
+   def __getitem__(self, rows):
+      import numpy as np
+      scale = np.asarray(self.scale[rows], dtype=np.float32)
+      return self.values[rows].astype(np.float32) * scale.reshape(scale.shape + (1,))
@@ -0,0 +1,44 @@
+import json
+import logging
+
+# JSON-RPC results come in two formats, negotiated per request with the
+# RESULT_FORMAT_HEADER:
+#  'legacy'     : the result is a JSON string of the objects' attributes,
+#                 which clients decode once more (the default)
+#  'structured' : the result is the objects' API fields as JSON values,
+#                 the server echoes the header when it sends them
+RESULT_FORMAT_HEADER = 'X-Classr-Result-Format'
+
+# fastest JSON encoder available for plain data
+try:
+   import ujson
+   def dumps(data): return ujson.dumps(data, escape_forward_slashes=False)
+   backend = 'ujson'
+except ImportError:
+   try:
+      import simplejson
+      def dumps(data): return simplejson.dumps(data)
+      backend = 'simplejson'
+   except ImportError:
+      def dumps(data): return json.dumps(data)
+      backend = 'json'
+
+# plain data of the API fields of objects having a to_dict() method
+def project(obj):
+   if hasattr(obj, 'to_dict'): return obj.to_dict()
+   if isinstance(obj, (list, tuple)): return [project(item) for item in obj]
+   if isinstance(obj, dict): return dict((key, project(value)) for key, value in obj.iteritems())
+   return obj
+
+# plain data of all attributes of objects, loggers left blank, as the legacy
+# format has always returned them
+def legacy(obj):
+   if isinstance(obj, logging.Logger): return ''
+   if hasattr(obj, 'to_dict'): return legacy(obj.__dict__)
+   if isinstance(obj, (list, tuple)): return [legacy(item) for item in obj]
+   if isinstance(obj, dict): return dict((key, legacy(value)) for key, value in obj.iteritems())
+   return obj
+
+def result(obj, result_format):
+   if result_format == 'structured': return project(obj)
+   return dumps(legacy(obj))
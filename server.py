@@ -1,5 +1,7 @@
-from flask import Flask, render_template, request, send_file, abort
+from flask import Flask, render_template, request, send_file, abort, \
+   Response, stream_with_context, g
 from flask_jsonrpc import JSONRPC
+from flask_jsonrpc.exceptions import Error as JSONRPCError
 from flask_httpauth import HTTPBasicAuth
 import socket
 import ssl
@@ -10,13 +12,27 @@ import logging
 import uuid
 from functools import wraps
 import datetime
+import time
 from threading import Thread
 
 import config
 import store
+import jobqueue
+import progressbus
+import serialization
+import model_registry
+import admission
+import artifacts
+import blobstore
+import federation
+import warmup
 from autosync import AutosyncThread
 from autoclean import AutocleanThread
-from pasir import PasirTicketClassification
+from autoclassify import AutoclassifyThread
+from worker import WorkerSupervisorThread
+import pasir
+from pasir import PasirTicketClassification, PasirBatchTicketClassification, \
+   PasirShardedTicketClassification
 
 logging.info('========================================================')
 logging.info('IBM PASIR/Classr API')
@@ -36,6 +52,41 @@ def get_pw(username):
     else:
        return None
 
+class OverCapacityError(JSONRPCError):
+   code = -32001
+   message = 'Over capacity'
+   status = 503
+
+# turns admission.OverCapacity into a JSON-RPC error, answered with a 503 and
+# a Retry-After header
+def _over_capacity(e):
+   g.retry_after = e.retry_after
+   return OverCapacityError(str(e), data={'retry_after': e.retry_after})
+
+@app.after_request
+def add_retry_after(response):
+   if getattr(g, 'retry_after', None) != None:
+      response.headers['Retry-After'] = str(g.retry_after)
+   return response
+
+# confirms structured results, clients of older servers get a legacy JSON
+# string back without the header
+@app.after_request
+def echo_result_format(response):
+   if request.headers.get(serialization.RESULT_FORMAT_HEADER) == 'structured':
+      response.headers[serialization.RESULT_FORMAT_HEADER] = 'structured'
+   return response
+
+@app.errorhandler(admission.OverCapacity)
+def over_capacity(e):
+   g.retry_after = e.retry_after
+   return Response(json.dumps(str(e)), status=503, mimetype='application/json')
+
+# JSON-RPC result in the format the client asked for, see serialization
+def _result(obj):
+   return serialization.result(obj, 
+      request.headers.get(serialization.RESULT_FORMAT_HEADER, 'legacy'))
+
 @app.route('/',methods=['GET', 'POST'])
 def index():
    return render_template('index.html')
@@ -56,37 +107,54 @@ def upload_resource():
       logging.debug(request.files)
       file = request.files['file']
       filename = secure_filename(file.filename)
-      file.save(os.path.join(config.TEMP_PATH, filename))
       resource_type = request.form['resourceType']
       resource_title = request.form['resourceTitle']
       resource_uid = request.form['resourceUid']
       # create resource object
       if (filename.endswith('.tar.gz')):
-         resource = store.Resource.add_from_targz(
+         # extracted straight from the upload
+         resource = store.Resource.add_from_stream(
             uid = resource_uid, # specified optionally
             resource_type = resource_type,
             title = resource_title,
-            gz_path = os.path.join(config.TEMP_PATH, filename))
+            stream = file.stream)
       else:
+         file.save(os.path.join(config.TEMP_PATH, filename))
          resource = store.Resource.add_from_file(
             uid = resource_uid, # specified optionally
             resource_type = resource_type,
             title = resource_title,
             file_path = os.path.join(config.TEMP_PATH, filename))
+         os.remove(os.path.join(config.TEMP_PATH, filename))
       return render_template('upload.html', uid=resource.uid)
 
+# adds a resource from a tar.gz sent as the request body, extracting it while
+# it is received, e.g.
+#    curl -T vocab.tar.gz -u api:<key> \
+#       'http://<host>:<port>/api/resource.upload?resource_type=vocab&title=Vocab'
+# returns the uid of the resource
+@app.route('/api/resource.upload', methods=['PUT', 'POST'])
+@auth.login_required
+def upload_resource_stream():
+   resource = store.Resource.add_from_stream(
+      uid = request.args.get('uid', ''), # specified optionally
+      resource_type = request.args['resource_type'],
+      title = request.args.get('title', request.args['resource_type']),
+      stream = request.stream)
+   return json.dumps(resource.uid)
+
 @jsonrpc.method('classifier.get_all')
 @auth.login_required
 def get_classifiers():
    classifiers = store.Classifier.get_all()
-   return json.dumps(classifiers, cls=store.StoreJsonEncoder)
+   return _result(classifiers)
 
 @jsonrpc.method('classifier.get')
 @auth.login_required
 def get_classifier(uid):
    classifier = store.Classifier.get(uid)
    if classifier == None: raise Exception('Classifier %s not found' % uid)
-   return json.dumps(classifier, cls=store.StoreJsonEncoder)
+   return _result(classifier)
 
 @jsonrpc.method('classifier.delete')
 @auth.login_required
@@ -94,7 +162,7 @@ def delete_classifier(uid):
    classifier = store.Classifier.get(uid)
    if classifier == None: raise Exception('Classifier %s not found' % uid)
    classifier.remove()
-   return json.dumps('OK')
+   return _result('OK')
 
 @jsonrpc.method('classifier.enable')
 @auth.login_required
@@ -102,7 +170,8 @@ def enable_classifier(uid):
    classifier = store.Classifier.get(uid)
    if classifier == None: raise Exception('Classifier %s not found' % uid)
    classifier.set_enabled(True)
-   return json.dumps('OK')
+   warmup.request(uid)
+   return _result('OK')
 
 @jsonrpc.method('classifier.disable')
 @auth.login_required
@@ -110,7 +179,8 @@ def disable_classifier(uid):
    classifier = store.Classifier.get(uid)
    if classifier == None: raise Exception('Classifier %s not found' % uid)
    classifier.set_enabled(False)
-   return json.dumps('OK')
+   model_registry.cool(uid)
+   return _result('OK')
 
 @app.route('/api/job.place', methods=['POST', 'GET'])
 @auth.login_required
@@ -138,19 +208,22 @@ def classify_tickets():
          raise Exception('Method only accepts CSV file')
       # get classifier and cerate job context
       classifier = store.Classifier.get(classifier_uid)
-      job_context = store.JobContext.create(classifier_uid)
-      # save input file
-      in_csv = os.path.join(job_context.work_dir, filename)
-      file.save(in_csv)
-      # define output file name
-      out_csv = os.path.join(job_context.work_dir, 'autolabeled.tickets.csv')
-      # invoke classifier
-      classifier.classify(job_context, 
-         in_csv, 
-         in_desc_col, 
-         in_res_col, 
-         out_csv, 
-         out_class_col)
+      with admission.admitted(request.form.get('priority', 'interactive')) as slot:
+         job_context = store.JobContext.create(classifier_uid)
+         slot.bind(job_context.uid)
+         # save input file
+         in_csv = os.path.join(job_context.work_dir, filename)
+         file.save(in_csv)
+         # define output file name
+         out_csv = os.path.join(job_context.work_dir, 'autolabeled.tickets.csv')
+         # invoke classifier, jobs offloaded by peers stay here
+         classifier.classify(job_context, 
+            in_csv, 
+            in_desc_col, 
+            in_res_col, 
+            out_csv, 
+            out_class_col,
+            offload = (request.form.get('federated') != '1'))
       return json.dumps(job_context.uid)
 
 @app.route('/api/job.download/<uid>')
@@ -158,14 +231,30 @@ def classify_tickets():
 def get_classifier_result(uid):
    job_context = store.JobContext.get(uid)
    if job_context == None: raise Exception('Job %s not found' % uid)
-   file_path = os.path.join(
-      job_context.work_dir, 'autolabeled.tickets.csv')
-   if os.path.exists(file_path):
+   found = artifacts.find(os.path.join(
+      job_context.work_dir, 'autolabeled.tickets.csv'))
+   if found == None:
+      raise Exception('Output for job %s not found' % (uid))
+   file_path, compressed = found
+   job_context.record_usage(size=False)
+   if not compressed:
       return send_file(file_path, 
          as_attachment=True,
          attachment_filename='autolabeled.tickets.csv')
+   if request.accept_encodings['gzip'] > 0:
+      # compacted outputs go out as they are stored
+      response = send_file(file_path, 
+         mimetype='text/csv',
+         as_attachment=True,
+         attachment_filename='autolabeled.tickets.csv')
+      response.headers['Content-Encoding'] = 'gzip'
    else:
-      raise Exception('Output for job %s not found' % (uid))
+      response = Response(stream_with_context(
+         artifacts.open_output(file_path, compressed)), mimetype='text/csv')
+      response.headers['Content-Disposition'] = \
+         'attachment; filename=autolabeled.tickets.csv'
+   response.headers['Vary'] = 'Accept-Encoding'
+   return response
 
 @jsonrpc.method('job.get_status')
 @auth.login_required
@@ -175,37 +264,118 @@ def get_classifier_progress(uid):
    status = job_context.status
    progress_percentage = job_context.progress_percentage
    progress_text = job_context.progress_text
-   return json.dumps({
+   return _result({
       'status': status, 
       'progress_percentage': progress_percentage,
       'progress_text': progress_text})
 
+@jsonrpc.method('job.get_status_many')
+@auth.login_required
+def get_classifier_progress_many(uids):
+   return _result(progressbus.read_statuses(uids))
+
+# long-poll: returns the status of the jobs that differ from known, a dict of
+# uid to [status, progress_percentage], waiting up to timeout_sec for a change
+@jsonrpc.method('job.wait_status')
+@auth.login_required
+def wait_classifier_progress(uids, known={}, timeout_sec=30):
+   timeout_sec = min(timeout_sec, config.PROGRESS_WAIT_MAX_SEC)
+   try:
+      release = admission.subscribe()
+   except admission.OverCapacity as e:
+      raise _over_capacity(e)
+   try:
+      # subscribe before reading, so no update slips in between
+      subscription = progressbus.subscribe(uids)
+      try:
+         changed = [event for event in progressbus.read_statuses(uids) 
+            if known.get(event['uid']) != [event['status'], event['progress_percentage']]]
+         if len(changed) == 0: changed = subscription.next(timeout_sec)
+         return _result(changed)
+      finally:
+         progressbus.unsubscribe(subscription)
+   finally:
+      release()
+
+# server-sent events of the progress of one or more comma-separated jobs,
+# starting with their current status and ending once all have finished
+@app.route('/api/job.progress/<uids>')
+@auth.login_required
+def stream_classifier_progress(uids):
+   uids = [uid for uid in uids.split(',') if uid != '']
+   # held until the response is closed, whether the stream started or not
+   release = admission.subscribe()
+   def stream():
+      subscription = progressbus.subscribe(uids)
+      try:
+         open_uids = set(uids)
+         events = progressbus.read_statuses(uids)
+         if len(events) < len(uids): 
+            yield 'event: error\ndata: %s\n\n' % json.dumps('Job not found')
+            return
+         while True:
+            for event in events:
+               yield 'event: progress\ndata: %s\n\n' % json.dumps(event)
+               if progressbus.is_terminal(event['status']): open_uids.discard(event['uid'])
+            if len(open_uids) == 0: return
+            events = subscription.next(config.PROGRESS_HEARTBEAT_SEC)
+            # keeps proxies from timing out and detects gone clients
+            if len(events) == 0: yield ': heartbeat\n\n'
+      finally:
+         progressbus.unsubscribe(subscription)
+   try:
+      response = Response(stream_with_context(stream()), 
+         mimetype='text/event-stream',
+         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+   except:
+      release()
+      raise
+   response.call_on_close(release)
+   return response
+
 @jsonrpc.method('job.delete')
 @auth.login_required
 def delete_job(uid):
    job_context = store.JobContext.get(uid)
    if job_context == None: raise Exception('Job %s not found' % uid)
    job_context.remove()
-   return json.dumps('OK')
+   return _result('OK')
+
+@jsonrpc.method('job.cancel')
+@auth.login_required
+def cancel_job(uid):
+   job_context = store.JobContext.get(uid)
+   if job_context == None: raise Exception('Job %s not found' % uid)
+   # jobs still queued for a worker never start
+   withdrawn = jobqueue.withdraw(uid)
+   job_context.cancel(started = (withdrawn == None))
+   if withdrawn != None and withdrawn[0] == 'pasir':
+      pasir.abandon_payload(withdrawn[1], 'Cancelled')
+   return _result('OK')
+
+@jsonrpc.method('job.get_queue')
+@auth.login_required
+def get_job_queue():
+   return _result(jobqueue.get_statistics())
 
 @jsonrpc.method('job.get_all')
 @auth.login_required
 def get_jobs():
    job_contexts = store.JobContext.get_all()
-   return json.dumps(job_contexts, cls=store.StoreJsonEncoder)
+   return _result(job_contexts)
 
 @jsonrpc.method('resource.get_all')
 @auth.login_required
 def get_resources():
    resources = store.Resource.get_all()
-   return json.dumps(resources, cls=store.StoreJsonEncoder)
+   return _result(resources)
 
 @jsonrpc.method('resource.get')
 @auth.login_required
 def get_resource(uid):
    resource = store.Resource.get(uid)
    if resource == None: raise Exception('Resource %s not found' % uid)
-   return json.dumps(resource, cls=store.StoreJsonEncoder)
+   return _result(resource)
 
 @jsonrpc.method('resource.delete')
 @auth.login_required
@@ -213,7 +383,26 @@ def delete_resource(uid):
    resource = store.Resource.get(uid)
    if resource == None: raise Exception('Resource %s not found' % uid)
    resource.remove()
-   return json.dumps('OK')
+   return _result('OK')
+
+# the files of a resource and the blobs of their content, for peers to
+# download just the blobs they are missing
+@jsonrpc.method('resource.get_manifest')
+@auth.login_required
+def get_resource_manifest(uid):
+   resource = store.Resource.get(uid)
+   if resource == None: raise Exception('Resource %s not found' % uid)
+   return _result([{'path': path, 'hash': blob_hash, 'size': size} 
+      for path, blob_hash, size in resource.get_manifest()])
+
+@app.route('/api/resource.blob/<blob_hash>')
+@auth.login_required
+def download_blob(blob_hash):
+   if not config.ENABLE_RESOURCE_DOWNLOAD: raise Exception('Resource download not permitted on this API')
+   if not blobstore.valid_hash(blob_hash) or not blobstore.has(blob_hash):
+      abort(404)
+   return send_file(blobstore.blob_path(blob_hash), 
+      mimetype='application/octet-stream')
 
 @app.route('/api/resource.download/<uid>')
 @auth.login_required
@@ -224,35 +413,107 @@ def download_resource(uid):
    resource_targz_path = resource.to_targz()
    return send_file(resource_targz_path)
 
-@jsonrpc.method('pasir.classify')
-#@auth.login_required
-def pasir_classify(ticket_client_id, ticket_data_source, from_date, to_date):
-   freshest_classifier = None
-   classifiers = store.Classifier.get_all()
-   for c in classifiers:
-      if (c.enabled and c.title == 'PASIR' and c.trained):
-         if freshest_classifier == None or c.finished_on > freshest_classifier.finished_on:
-            freshest_classifier = c
+def _freshest_pasir_classifier():
+   freshest_classifier = store.Classifier.get_active('PASIR')
    if freshest_classifier == None:
       raise Exception('No suitable PASIR classifier is available on this API')
-   pasir_classification = PasirTicketClassification.create(
-      classifier = freshest_classifier,
-      client_id = ticket_client_id,
-      data_source = ticket_data_source,
-      from_timestamp = datetime.datetime.strptime(from_date,'%Y-%m-%d'), 
-      to_timestamp = datetime.datetime.strptime(to_date,'%Y-%m-%d'))
+   return freshest_classifier
+
+@jsonrpc.method('server.get_load')
+@auth.login_required
+def get_load():
+   load = {'admission': admission.get_load()}
+   load['progress'] = admission.get_subscriptions()
+   if config.WORKER_PROCESSES > 0: load['queue'] = jobqueue.get_statistics()
+   load['autoclean'] = autoclean_thread.get_statistics()
+   load['federation'] = federation.local_load()
+   return _result(load)
+
+@jsonrpc.method('server.get_model_types')
+@auth.login_required
+def get_model_types():
+   return _result([model_type.to_dict() for model_type in model_registry.get_model_types()])
+
+@jsonrpc.method('pasir.classify')
+#@auth.login_required
+def pasir_classify(ticket_client_id, ticket_data_source, from_date, to_date, incremental=False):
+   try:
+      return _pasir_classify(ticket_client_id, ticket_data_source, from_date, to_date, incremental)
+   except admission.OverCapacity as e:
+      raise _over_capacity(e)
+
+# raises admission.OverCapacity when too many interactive jobs are running
+def _pasir_classify(ticket_client_id, ticket_data_source, from_date, to_date, incremental):
+   from_timestamp = datetime.datetime.strptime(from_date,'%Y-%m-%d')
+   to_timestamp = datetime.datetime.strptime(to_date,'%Y-%m-%d')
+   # shard windows spanning multiple days, if enabled
+   if config.SHARD_TARGET_TICKETS > 0 and to_timestamp > from_timestamp:
+      classification_cls = PasirShardedTicketClassification
+   else:
+      classification_cls = PasirTicketClassification
+   classifier = _freshest_pasir_classifier()
+   with admission.admitted('interactive') as slot:
+      pasir_classification = classification_cls.create(
+         classifier = classifier,
+         client_id = ticket_client_id,
+         data_source = ticket_data_source,
+         from_timestamp = from_timestamp, 
+         to_timestamp = to_timestamp,
+         incremental = incremental)
+      slot.bind(pasir_classification.job_context.uid)
    # launch job asynchronously and return immediately
-   Thread(target = pasir_classification.fetch_and_classify).start()
-   return json.dumps({
+   pasir.launch(pasir_classification)
+   return _result({
       'classr_ticketclassification_id' : pasir_classification.classr_ticketclassification_id,
       'job_id' : pasir_classification.job_context.uid
       })
 
+# clients is a list of [client_id, data_source] pairs
+@jsonrpc.method('pasir.classify_batch')
+#@auth.login_required
+def pasir_classify_batch(clients, from_date, to_date):
+   classifier = _freshest_pasir_classifier()
+   try:
+      with admission.admitted('batch') as slot:
+         batch = PasirBatchTicketClassification.create(
+            classifier = classifier,
+            clients = clients,
+            from_timestamp = datetime.datetime.strptime(from_date,'%Y-%m-%d'), 
+            to_timestamp = datetime.datetime.strptime(to_date,'%Y-%m-%d'))
+         slot.bind(batch.job_context.uid)
+   except admission.OverCapacity as e:
+      raise _over_capacity(e)
+   # launch job asynchronously and return immediately
+   pasir.launch(batch)
+   return _result({
+      'job_id' : batch.job_context.uid,
+      'classifications' : [{
+         'client_id' : member.client_id,
+         'data_source' : member.data_source,
+         'classr_ticketclassification_id' : member.classr_ticketclassification_id
+         } for member in batch.members]
+      })
+
+@jsonrpc.method('pasir.reload_sql')
+@auth.login_required
+def pasir_reload_sql():
+   errors = pasir.reload_sql()
+   return _result({'errors': errors})
+
+@jsonrpc.method('pasir.get_statistics')
+@auth.login_required
+def pasir_get_statistics():
+   return _result(pasir.get_statistics())
+
 # REST-like interface for classification
 @app.route('/api/pasir.classify/<client_id>/<data_source>/<from_date>/<to_date>')
 @auth.login_required
 def pasir_classify_rest(client_id, data_source, from_date, to_date):
-   return pasir_classify(client_id, data_source, from_date, to_date)
+   incremental = request.args.get('incremental', 'false').lower() in ['1', 'true', 'yes']
+   result = _pasir_classify(client_id, data_source, from_date, to_date, incremental)
+   # plain HTTP responses are always JSON text
+   if not isinstance(result, basestring): result = serialization.dumps(result)
+   return result
 
 @app.route('/manual')
 @auth.login_required
@@ -263,6 +524,7 @@ def pasir_compatibility():
 ##############################################################
 
 logging.info('Setting up server on %s' % socket.getfqdn())
+logging.info('Encoding JSON results with %s' % serialization.backend)
 
 # log API-ket configuration
 if config.API_KEY == '':
@@ -277,6 +539,17 @@ if (config.SSL_ENABLED and
    ssl_context = (config.SSL_CERT, config.SSL_PRIVATE_KEY)
 else: ssl_context = None
 
+# load model types where jobs run, the others are imported on first use
+for model_type in model_registry.get_model_types():
+   logging.info('Model type %s: %s' % (model_type.name, model_type.capabilities))
+if not jobqueue.dispatching():
+   model_registry.preload(config.PRELOAD_MODEL_TYPES)
+
+# set up worker processes
+if config.WORKER_PROCESSES > 0:
+   worker_supervisor_thread = WorkerSupervisorThread(config.WORKER_PROCESSES)
+   worker_supervisor_thread.start()
+
 # set up autosync threads
 for name, autosync_config in config.AUTOSYNC.iteritems():
    autosync_thread = AutosyncThread(name, 
@@ -286,18 +559,73 @@ for name, autosync_config in config.AUTOSYNC.iteritems():
       autosync_config['SYNC_INTERVAL_HOURS']*3600)
    autosync_thread.start()
 
-# set up autoelan thread
-if config.CLEAN_JOBS_AFTER_DAYS > 0:
-   autoclean_thread = AutocleanThread(
-      config.CLEAN_JOBS_AFTER_DAYS)
-   autoclean_thread.start()
-
-# start HTTP listener
-if __name__ == '__main__':
+# set up autoclassify threads
+for name, autoclassify_config in config.AUTOCLASSIFY.iteritems():
+   autoclassify_thread = AutoclassifyThread(name, 
+      autoclassify_config['CLIENT_ID'], 
+      autoclassify_config['DATA_SOURCE'], 
+      autoclassify_config['POLL_INTERVAL_SEC'], 
+      autoclassify_config['LOOKBACK_DAYS'])
+   autoclassify_thread.start()
+
+# set up autoelan thread, which removes jobs only with CLEAN_JOBS_AFTER_DAYS
+# or DISK_HIGH_WATER_PCT set
+autoclean_thread = AutocleanThread(
+   config.CLEAN_JOBS_AFTER_DAYS)
+autoclean_thread.start()
+
+# warm up the models of enabled classifiers
+if config.PREWARM_MODELS: warmup.start()
+
+# poll the load of peers to offload jobs to
+if config.FEDERATION: federation.start()
+
+# runs func on a background thread once the HTTP listener accepts connections
+def _when_listening(func, timeout_sec=120):
+   def wait_and_run():
+      host = '127.0.0.1' if config.IP_MASK in ['', '0.0.0.0'] else config.IP_MASK
+      deadline = time.time() + timeout_sec
+      while time.time() < deadline:
+         try:
+            socket.create_connection((host, config.PORT), 1).close()
+            break
+         except socket.error:
+            time.sleep(0.2)
+      func()
+   thread = Thread(target = wait_and_run)
+   thread.setDaemon(True)
+   thread.start()
+
+def serve():
+   if config.PREWARM: _when_listening(pasir.prewarm)
+   if config.HTTP_SERVER == 'waitress' and ssl_context == None:
+      try:
+         import waitress
+         logging.info('Serving with waitress: %d threads, %d connections max' % 
+            (config.HTTP_THREADS, config.HTTP_CONNECTION_LIMIT))
+         waitress.serve(app, 
+            host=config.IP_MASK, 
+            port=config.PORT,
+            threads=config.HTTP_THREADS,
+            connection_limit=config.HTTP_CONNECTION_LIMIT,
+            channel_timeout=config.HTTP_CHANNEL_TIMEOUT,
+            backlog=config.HTTP_BACKLOG,
+            max_request_body_size=config.HTTP_MAX_REQUEST_BODY_MB*1024*1024,
+            asyncore_use_poll=True,
+            ident='classr')
+         return
+      except ImportError:
+         logging.warning('waitress is not installed, falling back to the werkzeug server')
+   elif config.HTTP_SERVER == 'waitress':
+      logging.warning('waitress does not terminate SSL, falling back to the werkzeug server')
    app.run(host=config.IP_MASK, 
       debug=False, 
       threaded=True, 
       port=config.PORT, 
       ssl_context=ssl_context)
 
+# start HTTP listener
+if __name__ == '__main__':
+   serve()
+
 
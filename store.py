@@ -5,10 +5,11 @@ import uuid
 import re
 import tarfile
 import datetime
+import time
 import json
 import logging
 import requests
-from threading import Thread
+from threading import Thread, Lock
 from werkzeug import secure_filename
 import logging.handlers
 import fnmatch
@@ -17,10 +18,20 @@ from multiprocessing.dummy import Pool as ThreadPool
 import persistence
 import config
 import model_registry
+import jobqueue
+import progressbus
+import serialization
+import admission
+import logpipe
+import blobstore
+import pvformat
+import federation
 
 db = persistence.db()
 c = db.cursor()
 _pool = ThreadPool(config.PARALLEL_JOBS)
+# seconds a progress tick may go without rechecking the claim and cancellation
+_cancel_check_sec = 1.0
 
 sql = """CREATE TABLE IF NOT EXISTS CLASSIFIER (
       uid TEXT PRIMARY KEY NOT NULL,
@@ -74,12 +85,108 @@ sql = """CREATE TABLE IF NOT EXISTS JOB (
       FOREIGN KEY(classifier_uid) REFERENCES CLASSIFIER(uid)
       );"""
 c.execute(sql)
+sql = """CREATE TABLE IF NOT EXISTS PASIR_WATERMARK (
+      client_id TEXT,
+      data_source TEXT,
+      classifier_uid TEXT,
+      covered_from TIMESTAMP,
+      watermark TIMESTAMP,
+      updated_on TIMESTAMP,
+      PRIMARY KEY (client_id, data_source, classifier_uid)
+      );"""
+c.execute(sql)
+sql = """CREATE INDEX IF NOT EXISTS CLASSIFIER_ROUTE_IDX 
+      ON CLASSIFIER (enabled, title, type, finished_on);"""
+c.execute(sql)
+# the files of a resource dir, each a link to the blob of its content
+sql = """CREATE TABLE IF NOT EXISTS RESOURCE_BLOB (
+      resource_uid TEXT,
+      path TEXT,
+      blob_hash TEXT,
+      size INTEGER,
+      PRIMARY KEY (resource_uid, path),
+      FOREIGN KEY(resource_uid) REFERENCES RESOURCE(uid)
+      );"""
+c.execute(sql)
+sql = """CREATE INDEX IF NOT EXISTS RESOURCE_BLOB_HASH_IDX 
+      ON RESOURCE_BLOB (blob_hash);"""
+c.execute(sql)
+
+def _add_column(c, table, column, column_type):
+   c.execute('PRAGMA table_info(%s)' % table)
+   if not column in [row[1] for row in c.fetchall()]:
+      c.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+
+_add_column(c, 'JOB', 'cancel_requested', 'INT DEFAULT 0')
+# bytes in the work dir as the job finished and when its output was last
+# used, for autoclean to evict the least recently used jobs first
+_add_column(c, 'JOB', 'work_dir_size', 'INTEGER')
+_add_column(c, 'JOB', 'last_accessed', 'TIMESTAMP')
+c.execute('UPDATE JOB SET last_accessed=created_on WHERE last_accessed IS NULL')
+sql = """CREATE INDEX IF NOT EXISTS JOB_STATUS_CREATED_IDX
+      ON JOB (status, created_on);"""
+c.execute(sql)
+sql = """CREATE INDEX IF NOT EXISTS JOB_STATUS_ACCESSED_IDX
+      ON JOB (status, last_accessed);"""
+c.execute(sql)
 db.commit()
 
+# bytes of the files under path
+def dir_size(path):
+   size = 0
+   for root, dirs, files in os.walk(path):
+      for name in files:
+         try: size += os.path.getsize(os.path.join(root, name))
+         except OSError: pass
+   return size
+
+# runs func(*args) on the job worker pool
+def submit(func, args=[]):
+   return _pool.apply_async(func = func, args = args)
+
 def sanitize_file_name(str) :
    valid_chars = '\'\-_\.\(\)\@\_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
    return re.sub('[^%s]' % valid_chars, '-', str)
 
+def _timestamp_key(value):
+   for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S']:
+      try: return datetime.datetime.strptime(str(value), fmt)
+      except ValueError: pass
+   return datetime.datetime.min
+
+class _ClassifierRoutes:
+# maps (title, model_type) to the uid of the enabled, trained classifier with
+# the latest finished_on, a model_type of None matching any type; the map is
+# rebuilt as a whole and swapped in at once, so lookups never see a
+# half-updated route
+   
+   def __init__(self):
+      self.lock = Lock()
+      self.routes = None
+   
+   def rebuild(self):
+      with self.lock:
+         c = persistence.cursor()
+         c.execute("""SELECT uid, type, title, finished_on 
+                      FROM CLASSIFIER 
+                      WHERE enabled=1 AND finished_on IS NOT NULL""")
+         latest = {}
+         for uid, model_type, title, finished_on in c.fetchall():
+            finished = _timestamp_key(finished_on)
+            for key in [(title, model_type), (title, None)]:
+               if not key in latest or finished > latest[key][1]:
+                  latest[key] = (uid, finished)
+         self.routes = dict((key, uid) for key, (uid, _) in latest.iteritems())
+   
+   def resolve(self, title, model_type=None):
+      routes = self.routes
+      if routes == None:
+         self.rebuild()
+         routes = self.routes
+      return routes.get((title, model_type))
+
+_routes = _ClassifierRoutes()
+
 class StoreJsonEncoder(json.JSONEncoder):
    def default(self, obj):
       if isinstance(obj, Resource): return obj.__dict__
@@ -94,8 +201,11 @@ class Remote:
       self.key = key
       # TODO: do some handshake to test connection and key
    
-   def invoke_jsonrpc(self, method, params=[]):
-      headers = {'content-type': 'application/json'}
+   # returns the decoded result, whether the remote sends structured or
+   # legacy string-wrapped results
+   def invoke_jsonrpc(self, method, params=[], timeout=None):
+      headers = {'content-type': 'application/json',
+         serialization.RESULT_FORMAT_HEADER: 'structured'}
       request_uid = str(uuid.uuid1())
       payload = {
          "method": method,
@@ -103,61 +213,143 @@ class Remote:
          "jsonrpc": "2.0",
          "id": request_uid,}
       if (self.key == ''):
-         response = requests.post(
-            self.url, data=json.dumps(payload), headers=headers).json()
+         http_response = requests.post(
+            self.url, data=json.dumps(payload), headers=headers, timeout=timeout)
       else:
-         response = requests.post(
-            self.url, data=json.dumps(payload), headers=headers, auth=('api', self.key)).json()
+         http_response = requests.post(
+            self.url, data=json.dumps(payload), headers=headers, auth=('api', self.key), 
+            timeout=timeout)
+      response = http_response.json()
       assert response["jsonrpc"]
       assert response["id"] == request_uid
-      return response["result"]
+      if response.get("error") != None:
+         raise Exception('%s failed on %s: %s' % 
+            (method, self.url, response["error"].get("message")))
+      result = response["result"]
+      # servers not supporting structured results send a JSON string and
+      # don't echo the format header, structured results may be plain strings
+      structured = http_response.headers.get(serialization.RESULT_FORMAT_HEADER) == 'structured'
+      if not structured and isinstance(result, basestring): result = json.loads(result)
+      return result
 
    def get_all_classifiers(self):
-      json_str = self.invoke_jsonrpc('classifier.get_all')
-      received_classifiers = json.loads(json_str)
+      received_classifiers = self.invoke_jsonrpc('classifier.get_all')
       classifiers = []
       for classifier_entries in received_classifiers:
          classifiers.append(Classifier(entries=classifier_entries))
       return classifiers
 
+   def get(self, path, timeout=None):
+      if (self.key == ''):
+         return requests.get('%s/%s' % (self.url, path), stream=True, timeout=timeout)
+      else:
+         return requests.get('%s/%s' % (self.url, path), stream=True, auth=('api', self.key), 
+            timeout=timeout)
+   
+   # places a job classifying in_csv with the remote, returns its uid;
+   # federated jobs aren't offloaded any further
+   def place_job(self, classifier_uid, in_csv, in_desc_col, in_res_col, out_class_col, 
+      timeout=None):
+      form = {'classifierUid': classifier_uid,
+         'inDescCol': in_desc_col,
+         'inResCol': in_res_col,
+         'outClassCol': out_class_col,
+         'federated': '1'}
+      auth = None if self.key == '' else ('api', self.key)
+      with open(in_csv, 'rb') as f:
+         r = requests.post('%s/job.place' % self.url, data=form, 
+            files={'file': (os.path.basename(in_csv), f, 'text/csv')}, 
+            auth=auth, timeout=timeout)
+      if r.status_code == 401:
+         raise Exception('API-key verification failed with %s using key="%s"' % (self.url, self.key))
+      elif r.status_code != 200:
+         raise Exception('Placing job with %s/job.place has failed with HTTP %d' % (self.url, r.status_code))
+      return r.json()
+   
+   # downloads the output of a remote job to out_path
+   def download_job(self, uid, out_path, timeout=None):
+      r = self.get('job.download/%s' % uid, timeout)
+      if r.status_code != 200:
+         raise Exception('Downloading job output from %s/job.download/%s has failed' % (self.url, uid))
+      part_path = '%s.%s.part' % (out_path, uuid.uuid1())
+      try:
+         with open(part_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024*1024): 
+               if chunk: f.write(chunk)
+         os.rename(part_path, out_path)
+      finally:
+         if os.path.exists(part_path): os.remove(part_path)
+   
    def fetch_resource(self, uid):
       if Resource.exists(uid): 
          raise Exception('Resource uid %s already exists locally' % uid)
       # fetch remote resource details
-      resource_json = self.invoke_jsonrpc('resource.get', [uid])
-      resource_dict = json.loads(resource_json)
-      # download remote resource data to a local temp file
-      local_filename = os.path.join(config.TEMP_PATH, 'remote-%s.tar.gz' % uid)
-      if (self.key == ''):
-         r = requests.get('%s/resource.download/%s' % (self.url, uid), stream=True)
-      else:
-         r = requests.get('%s/resource.download/%s' % (self.url, uid), stream=True, auth=('api', self.key))
+      resource_dict = self.invoke_jsonrpc('resource.get', [uid])
+      # fetch just the blobs missing locally from remotes storing blobs
+      try:
+         manifest = self.invoke_jsonrpc('resource.get_manifest', [uid])
+      except Exception as e:
+         manifest = None
+      if manifest != None: return self.fetch_resource_blobs(resource_dict, manifest)
+      # extract remote resource data while it is downloaded
+      r = self.get('resource.download/%s' % uid)
       if r.status_code == 200:
-         with open(local_filename, 'wb') as f:
-           for chunk in r.iter_content(chunk_size=1024): 
-              if chunk: f.write(chunk)
+         r.raw.decode_content = True
+         resource = Resource.add_from_stream(
+            resource_type = resource_dict['resource_type'], 
+            title = resource_dict['resource_type'], 
+            stream = r.raw, 
+            uid = uid, 
+            created_on = resource_dict['created_on'])
       elif r.status_code == 401:
          raise Exception('API-key verification failed with %s using key="%s"' % (self.url, self.key))
       else:
          raise Exception('Downloading remote resource from %s/resource.download/%s has failed' % (self.url, uid))
-      # add resource locally
-      resource = Resource.add_from_targz(
-         resource_type = resource_dict['resource_type'], 
-         title = resource_dict['resource_type'], 
-         gz_path = local_filename, 
-         uid = uid, 
-         created_on = resource_dict['created_on'])
-      # remove local temp file
-      os.remove(local_filename)
       # return new local resource
       return resource
    
+   # links the blobs of a remote resource into a staging dir, downloading
+   # those missing locally, and renames it into place
+   def fetch_resource_blobs(self, resource_dict, manifest):
+      uid = resource_dict['uid']
+      resource_dir = '%s-%s' % (sanitize_file_name(resource_dict['resource_type']), 
+         sanitize_file_name(uid))
+      staging_path = os.path.join(config.RESOURCES_PATH, '.staging-%s' % uuid.uuid1())
+      entries = []
+      fetched = 0
+      try:
+         for entry in manifest:
+            path = blobstore.safe_relpath(entry['path'])
+            blob_hash = entry['hash']
+            size = entry['size']
+            if not blobstore.has(blob_hash):
+               r = self.get('resource.blob/%s' % blob_hash)
+               if r.status_code == 401:
+                  raise Exception('API-key verification failed with %s using key="%s"' % (self.url, self.key))
+               elif r.status_code != 200:
+                  raise Exception('Downloading remote blob from %s/resource.blob/%s has failed' % (self.url, blob_hash))
+               blobstore.receive(blob_hash, r.iter_content(chunk_size=1024*1024))
+               fetched += size
+            blobstore.link(blob_hash, os.path.join(staging_path, path))
+            entries.append((path, blob_hash, size))
+         os.rename(staging_path, os.path.join(config.RESOURCES_PATH, resource_dir))
+      finally:
+         if os.path.exists(staging_path): shutil.rmtree(staging_path)
+      logging.info('Fetched resource %s, downloaded %d of %d bytes' % 
+         (uid, fetched, sum([size for path, blob_hash, size in entries])))
+      return Resource.add(uid=uid, 
+         resource_type=resource_dict['resource_type'], 
+         title=resource_dict['resource_type'], 
+         created_on=resource_dict['created_on'], 
+         local_created_on=str(datetime.datetime.now()), 
+         path=resource_dir,
+         manifest=entries)
+   
    def fetch_classifier(self, uid):
       if Classifier.exists(uid): 
          raise Exception('Classifier uid %s already exists locally' % uid)
       # fetch remote classifier object
-      json_str = self.invoke_jsonrpc('classifier.get', [uid])
-      received_classifier = json.loads(json_str)
+      received_classifier = self.invoke_jsonrpc('classifier.get', [uid])
       classifier = Classifier(entries=received_classifier)
       # check for resource dependencies
       for key, resource_uid in classifier.resources.iteritems():
@@ -175,8 +367,11 @@ class Resource:
    
    def __str__(self): return '<Resource %s>' % self.__dict__
 
+   # adds a resource whose files are in place under path, storing them as
+   # blobs unless the manifest of blobs linked there already is given
    @classmethod
-   def add(cls, uid, resource_type, title, created_on, local_created_on, path):
+   def add(cls, uid, resource_type, title, created_on, local_created_on, path,
+      manifest=None):
       db = persistence.db()
       c = db.cursor()
       # check existence
@@ -204,6 +399,17 @@ class Resource:
          db.commit()
       except:
          raise Exception('Failed to insert resource %s into DB' % uid)
+      try:
+         # binary formats for loading through mmap, derived locally and kept
+         # out of the manifest
+         dir_path = os.path.join(config.RESOURCES_PATH, path)
+         if config.CONVERT_RESOURCES: pvformat.convert(resource_type, dir_path)
+         if manifest == None: resource.intern()
+         else: resource.save_manifest([entry for entry in manifest 
+            if not pvformat.is_derived(os.path.join(dir_path, entry[0]))])
+      except Exception as e:
+         # resources are interned on demand later on
+         logging.exception('Failed to store resource %s as blobs' % uid)
       # return new object
       logging.info('Inserted new resource %s' % uid)
       return resource
@@ -261,37 +467,85 @@ class Resource:
       gz_path, 
       uid='', 
       created_on=str(datetime.datetime.now())):
-      # generate uid (if not specified)
       logging.info('Attempting to add new resource from tar.gz: %s' % gz_path)
-      if Resource.exists(uid): raise Exception('Resource uid %s already exists' % uid)
-      if uid == '': uid = str(uuid.uuid1())
-      # generate resource dir name
-      resource_dir = '%s-%s' % (sanitize_file_name(resource_type), sanitize_file_name(uid))
-      # open tar.gz
       try: 
-         archive = tarfile.open(gz_path, 'r:gz')
+         f = open(gz_path, 'rb')
       except: 
          raise Exception('Cannot add resource because specified gz_path %s is not accessible or corrupt' % gz_path)
-      # extract given tar.gz to temp or final location
-      tar_dir = archive.getnames()[0]
+      with f:
+         return Resource.add_from_stream(resource_type=resource_type, 
+            title=title, 
+            stream=f, 
+            uid=uid, 
+            created_on=created_on)
+   
+   # adds a resource from a tar.gz read sequentially from a file object, e.g.
+   # an upload being received, extracting it into a staging dir next to the
+   # resources that is renamed into place once complete; an archive of a
+   # single top-level dir becomes the resource dir
+   @classmethod
+   def add_from_stream(cls,
+      resource_type, 
+      title, 
+      stream, 
+      uid='', 
+      created_on=None):
+      # generate uid (if not specified)
+      if uid == '': uid = str(uuid.uuid1())
+      if Resource.exists(uid): raise Exception('Resource uid %s already exists' % uid)
+      if created_on == None: created_on = str(datetime.datetime.now())
+      # generate resource dir name
+      resource_dir = '%s-%s' % (sanitize_file_name(resource_type), sanitize_file_name(uid))
+      resource_dir_path = os.path.join(config.RESOURCES_PATH, resource_dir)
+      if os.path.exists(resource_dir_path): 
+         raise Exception('Resource destination %s exists already' % resource_dir_path)
+      staging_path = os.path.join(config.RESOURCES_PATH, '.staging-%s' % uuid.uuid1())
+      os.makedirs(staging_path)
       try:
-         if tar_dir == resource_dir: 
-            # extract files to final location
-            archive.extractall(config.RESOURCES_PATH)
-         else:
-            archive.extractall(config.TEMP_PATH)
-            # move extracted files from temp location
-            os.rename(os.path.join(config.TEMP_PATH, tar_dir), 
-               os.path.join(config.RESOURCES_PATH, resource_dir))
-      except:
-         raise Exception('Failed to extract resource archive %s' % gz_path)
+         # extract member by member, checking paths as they come
+         files = {}
+         try:
+            archive = tarfile.open(fileobj=stream, mode='r|gz')
+            for member in archive:
+               if os.path.normpath(member.name) == '.': continue
+               path = os.path.join(staging_path, blobstore.safe_relpath(member.name))
+               if member.isdir():
+                  if not os.path.isdir(path): os.makedirs(path)
+               elif member.isfile():
+                  files[path] = blobstore.write(path, archive.extractfile(member))
+               elif member.islnk():
+                  # files of the same content are hardlinks to the same blob,
+                  # archived as links to the first one
+                  target = os.path.join(staging_path, blobstore.safe_relpath(member.linkname))
+                  if not target in files: raise Exception('link %s to unknown file %s' % (member.name, member.linkname))
+                  os.link(target, path)
+                  files[path] = files[target]
+               else:
+                  raise Exception('unsupported member %s' % member.name)
+            archive.close()
+         except Exception as e:
+            raise Exception('Failed to extract resource archive: %s' % e)
+         names = os.listdir(staging_path)
+         root_path = staging_path
+         if len(names) == 1 and os.path.isdir(os.path.join(staging_path, names[0])):
+            root_path = os.path.join(staging_path, names[0])
+         os.rename(root_path, resource_dir_path)
+      finally:
+         if os.path.exists(staging_path): shutil.rmtree(staging_path)
+      # store files as blobs, hashed while extracted
+      manifest = []
+      for path, (blob_hash, size) in sorted(files.iteritems()):
+         relpath = os.path.relpath(path, root_path)
+         blobstore.intern(os.path.join(resource_dir_path, relpath), blob_hash)
+         manifest.append((relpath, blob_hash, size))
       # insert data and return object
       return Resource.add(uid=uid, 
             resource_type=resource_type, 
             title=title, 
             created_on=created_on, 
             local_created_on=str(datetime.datetime.now()), 
-            path=resource_dir)
+            path=resource_dir,
+            manifest=manifest)
       
    @classmethod
    def add_from_file(cls,
@@ -325,22 +579,103 @@ class Resource:
          shutil.rmtree(resource_dir_path)
          raise Exception('Failed to copy resource file %s to %s for resource %s' % (file_path, resource_dir_path, uid))        
    
+   # stores the files of the resource as blobs, saving its manifest
+   def intern(self):
+      manifest = blobstore.intern_dir(os.path.join(config.RESOURCES_PATH, self.path), 
+         pvformat.is_derived)
+      self.save_manifest(manifest)
+      return manifest
+   
+   def save_manifest(self, manifest):
+      db = persistence.db()
+      c = db.cursor()
+      try:
+         c.execute('DELETE FROM RESOURCE_BLOB WHERE resource_uid=?', [self.uid])
+         c.executemany("""INSERT INTO RESOURCE_BLOB (
+            resource_uid,
+            path,
+            blob_hash,
+            size) VALUES (?,?,?,?)""",
+            [[self.uid, path, blob_hash, size] for path, blob_hash, size in manifest])
+         db.commit()
+      except:
+         db.rollback()
+         raise Exception('Failed to save manifest of resource %s' % self.uid)
+   
+   # (path, hash, size) of the files of the resource, interning resources
+   # added before blobs were stored
+   def get_manifest(self):
+      c = persistence.cursor()
+      c.execute("""SELECT path, blob_hash, size FROM RESOURCE_BLOB 
+         WHERE resource_uid=? ORDER BY path""", [self.uid])
+      manifest = c.fetchall()
+      if len(manifest) == 0: manifest = self.intern()
+      return manifest
+   
    @classmethod
    def cleanup(cls):
-      """Remove unreferenced resource directories"""
-      # TODO
+      """Remove unreferenced resource directories and blobs, returns the
+      bytes reclaimed"""
+      reclaimed = 0
+      c = persistence.cursor()
+      # store the files of resources added before blobs were
+      c.execute("""SELECT uid FROM RESOURCE WHERE uid NOT IN 
+         (SELECT DISTINCT resource_uid FROM RESOURCE_BLOB)""")
+      for resource in [Resource.get(row[0]) for row in c.fetchall()]:
+         if resource == None: continue
+         try: resource.intern()
+         except Exception as e:
+            logging.exception('Failed to store resource %s as blobs' % resource.uid)
+      # resource dirs left behind, those being added may not be recorded yet
+      c.execute('SELECT path FROM RESOURCE')
+      paths = set([row[0] for row in c.fetchall()])
+      now = time.time()
+      for name in os.listdir(config.RESOURCES_PATH):
+         path = os.path.join(config.RESOURCES_PATH, name)
+         if name in paths or path == blobstore.BLOBS_PATH or not os.path.isdir(path): continue
+         if now - os.path.getmtime(path) < 60*60: continue
+         size = dir_size(path)
+         shutil.rmtree(path, ignore_errors=True)
+         reclaimed += size
+         logging.info('Removed unreferenced resource dir %s' % path)
+      # blobs no resource refers to anymore
+      c.execute('SELECT DISTINCT blob_hash FROM RESOURCE_BLOB')
+      blobs, blob_bytes = blobstore.collect(set([row[0] for row in c.fetchall()]))
+      if blobs > 0: logging.info('Removed %d unreferenced blobs' % blobs)
+      return reclaimed + blob_bytes
    
    def to_json(self):
       return json.dumps(self, default=lambda o: o.__dict__, indent=3)
    
+   # fields returned by the API
+   def to_dict(self):
+      return {'uid': self.uid,
+         'resource_type': self.resource_type,
+         'title': self.title,
+         'created_on': self.created_on,
+         'local_created_on': self.local_created_on,
+         'path': self.path}
+   
    def to_targz(self):
       """Takes an existing resource and prepares a <uid>.tar.gz from the directory
       content under a temp location"""
       resource_path = '%s/%s' % (config.RESOURCES_PATH, self.path)
       out_path = "%s/%s.tar.gz" % (config.TEMP_PATH, self.uid)
-      # TODO: check if tar.gz already exists and is consistent to speed up repeated calls
-      with tarfile.open(out_path, "w:gz") as tar:
-           tar.add(resource_path, arcname=os.path.basename(resource_path))
+      # resources don't change once added, so an existing tar.gz is reused
+      if os.path.exists(out_path): return out_path
+      # build under a private name and rename, so concurrent downloads
+      # never serve a half-written archive
+      part_path = '%s.%s.part' % (out_path, uuid.uuid1())
+      try:
+         # files derived by pvformat are converted again where received
+         parent_path = os.path.dirname(resource_path)
+         with tarfile.open(part_path, "w:gz") as tar:
+              tar.add(resource_path, arcname=os.path.basename(resource_path),
+                 filter=lambda info: None if pvformat.is_derived(
+                    os.path.join(parent_path, info.name)) else info)
+         os.rename(part_path, out_path)
+      finally:
+         if os.path.exists(part_path): os.remove(part_path)
       return out_path
    
    def remove(self):
@@ -350,8 +685,16 @@ class Resource:
       if c.fetchone() != None: raise Exception('Cannot delete resource %s because of existing dependencies' % (self.uid))
       try: shutil.rmtree(os.path.join(config.RESOURCES_PATH, self.path))
       except: pass
+      try: os.remove(os.path.join(config.TEMP_PATH, '%s.tar.gz' % self.uid))
+      except: pass
+      c.execute('SELECT blob_hash FROM RESOURCE_BLOB WHERE resource_uid=?', [self.uid])
+      blob_hashes = set([row[0] for row in c.fetchall()])
+      c.execute('DELETE FROM RESOURCE_BLOB WHERE resource_uid=?', [self.uid])
       c.execute('DELETE FROM RESOURCE WHERE UID=?', [self.uid])
       db.commit()
+      # drop the blobs that were only in use by this resource
+      c.execute('SELECT DISTINCT blob_hash FROM RESOURCE_BLOB')
+      blobstore.collect(set([row[0] for row in c.fetchall()]), blob_hashes, grace_sec=0)
       logging.info('Removed resource %s' % self.uid)
    
 
@@ -460,6 +803,14 @@ class Classifier:
       c = persistence.cursor()
       c.execute("""SELECT * FROM CLASSIFIER WHERE uid=?""", [uid])
       return (c.fetchone() != None)
+   
+   @classmethod
+   def get_active(cls, title, model_type=None):
+      """Returns the enabled, trained classifier of the given title (and model
+      type, if specified) that finished training last, or None"""
+      uid = _routes.resolve(title, model_type)
+      if uid == None: return None
+      return Classifier.get(uid)
 
    # @classmethod
    # def from_json(cls, json_str):
@@ -520,12 +871,37 @@ class Classifier:
          db.rollback()
          raise Exception('Failed to insert classifier %s into DB' % self.uid)
       self.saved = True
+      _routes.rebuild()
       logging.info('Inserted new classifier %s' % self.uid)
    
    def to_json(self):
       return json.dumps(self, default=lambda o: o.__dict__, indent=3)
    
+   # fields returned by the API
+   def to_dict(self):
+      return {'uid': self.uid,
+         'model_type': self.model_type,
+         'title': self.title,
+         'enabled': self.enabled,
+         'language': self.language,
+         'test_accuracy': self.test_accuracy,
+         'training_set_size': self.training_set_size,
+         'created_on': self.created_on,
+         'finished_on': self.finished_on,
+         'local_created_on': self.local_created_on,
+         'state': self.state,
+         'resources': self.resources,
+         'meta': self.meta,
+         'warm': model_registry.get_warm_model(self.uid) != None}
+   
    def trained(self): return (self.finished_on != None)
+   
+   # file system paths of the classifier's resources by key
+   def get_resource_paths(self):
+      resource_paths = {}
+      for key, resource_uid in self.resources.iteritems():
+         resource_paths[key] = os.path.join(config.RESOURCES_PATH, Resource.get(resource_uid).path)
+      return resource_paths
 
    def set_enabled(self, enabled=True):
       db = persistence.db()
@@ -538,6 +914,7 @@ class Classifier:
       except:
          db.rollback()
          raise Exception('Failed to update classifier %s as enabled=%s' % (self.uid, self.enabled))
+      _routes.rebuild()
       logging.info('Set classifier enabled=%s %s' % (enabled, self.uid))
 
    def remove(self):
@@ -547,6 +924,7 @@ class Classifier:
       c.execute('DELETE FROM CLASSIFIER_RESOURCE WHERE classifier_uid=?', [self.uid])
       c.execute('DELETE FROM CLASSIFIER WHERE uid=?', [self.uid])
       db.commit()
+      _routes.rebuild()
       logging.info('Removed classifier %s' % self.uid)
 
    def train(self, 
@@ -584,6 +962,7 @@ class Classifier:
       except:
          db.rollback()
          raise Exception('Failed to update classifier %s as training started' % self.uid)
+      _routes.rebuild()
       logging.info('Finished training classifier %s' % self.uid)
 
    def classify(self, 
@@ -592,7 +971,8 @@ class Classifier:
                 in_desc_col, 
                 in_res_col, 
                 out_csv, 
-                out_class_col):
+                out_class_col,
+                offload=True):
       # db = persistence.db()
       # c = db.cursor()
       if not self.saved: self.save()
@@ -601,9 +981,35 @@ class Classifier:
       if not self.enabled: 
          raise Exception('Model %s is not enabled' % self.uid)
       logging.info('Executing classifier %s' % self.uid)
-      resource_paths = {}
-      for key, resource_uid in self.resources.iteritems():
-         resource_paths[key] = os.path.join(config.RESOURCES_PATH, Resource.get(resource_uid).path)
+      # run by a less loaded peer if this server is saturated
+      if offload and federation.offload(self, job_context, 
+         in_csv, in_desc_col, in_res_col, out_csv, out_class_col):
+         return
+      if jobqueue.dispatching():
+         # hand over to a worker process, which comes back here to run it
+         jobqueue.put(job_context.uid, 'classify', {
+            'classifier_uid': self.uid,
+            'in_csv': in_csv,
+            'in_desc_col': in_desc_col,
+            'in_res_col': in_res_col,
+            'out_csv': out_csv,
+            'out_class_col': out_class_col}, 
+            retryable=True)
+         return
+      resource_paths = self.get_resource_paths()
+      model_registry.touch(self.uid)
+      if jobqueue.in_worker():
+         # workers run the jobs they claimed on the claiming thread
+         model_registry.classify(job_context,
+            self.model_type,
+            self.meta,
+            resource_paths,
+            in_csv,
+            in_desc_col,
+            in_res_col,
+            out_csv,
+            out_class_col)
+         return
       # do sh.t on separate thread and return immediately
       # Thread(target = model_registry.classify, args = (
       #    job_context,
@@ -629,6 +1035,15 @@ class Classifier:
       return
 
 
+class JobCancelled(Exception):
+   pass
+
+
+# raised by a worker finishing a job it no longer holds, see jobqueue.holds()
+class JobReleased(Exception):
+   pass
+
+
 class JobContext():
 
    def __init__(self, 
@@ -647,18 +1062,17 @@ class JobContext():
       self.progress_percentage = progress_percentage
       self.progress_text = progress_text
       self.aux_progress_callback = None
+      # the worker running the job, which has to hold its claim to finish it
+      self.claimed_by = None
+      self.claim_checked_on = None
+      self.cancel_checked_on = None
       # create job work dir
       self.work_dir = os.path.join(config.WORK_PATH, 
          secure_filename(self.dir_name))
       if not os.path.exists(self.work_dir): os.makedirs(self.work_dir)
-      # set up job logging (add handlers only at creation)
-      self.logger = logging.getLogger(self.uid)
-      if not len(self.logger.handlers):
-         handler = logging.FileHandler(
-            os.path.join(self.work_dir, 'progress.log'))
-         handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s'))
-         self.logger.addHandler(handler)
+      # set up job logging, the log file is opened on demand
+      self.log_path = os.path.join(self.work_dir, 'progress.log')
+      self.logger = logpipe.job_logger(self.uid, self.log_path)
 
    @classmethod
    def create(cls, classifier_uid):
@@ -726,7 +1140,75 @@ class JobContext():
          jobs.append(job)
       return jobs
    
+   # fields returned by the API
+   def to_dict(self):
+      return {'uid': self.uid,
+         'dir_name': self.dir_name,
+         'created_on': self.created_on,
+         'classifier_uid': self.classifier_uid,
+         'status': self.status,
+         'progress_percentage': self.progress_percentage,
+         'progress_text': self.progress_text}
+   
+   # whether the job was asked to stop, rechecked if last checked more than
+   # max_age_sec ago; a cancellation once seen is final
+   def cancel_requested(self, max_age_sec=0):
+      now = time.time()
+      if self.cancel_checked_on != None and now - self.cancel_checked_on < max_age_sec:
+         return False
+      c = persistence.cursor()
+      c.execute('SELECT cancel_requested FROM JOB WHERE UID=?', [self.uid])
+      row = c.fetchone()
+      cancelled = row != None and row[0] == 1
+      self.cancel_checked_on = None if cancelled else now
+      return cancelled
+
+   # whether the worker running the job still holds its claim, rechecked if
+   # last checked more than max_age_sec ago; a lost claim is final
+   def holds_claim(self, max_age_sec=0):
+      now = time.time()
+      if self.claim_checked_on != None and now - self.claim_checked_on < max_age_sec:
+         return True
+      held = jobqueue.holds(self.uid, self.claimed_by)
+      self.claim_checked_on = now if held else None
+      return held
+   
+   # stops the job at its next progress update, a job that hasn't started
+   # yet is cancelled right away
+   def cancel(self, started=True):
+      if self.status in ['Done', 'Error', 'Cancelled']:
+         raise Exception('Job %s has finished already' % self.uid)
+      db = persistence.db()
+      c = db.cursor()
+      c.execute('UPDATE JOB SET cancel_requested=1 WHERE UID=?', [self.uid])
+      db.commit()
+      self.logger.info('Cancellation requested')
+      if not started:
+         self.status = 'Cancelled'
+         self.progress_text = 'Cancelled'
+         self.save()
+         progressbus.publish(self.uid, self.status, self.progress_percentage, self.progress_text)
+         admission.job_finished(self.uid)
+         self.record_usage()
+   
    def update_progress(self, percentage, text, status='Progress'):
+      # the claim and cancellations are rechecked at most every second while
+      # in progress, and always before the job ends
+      max_age_sec = 0 if progressbus.is_terminal(status) else _cancel_check_sec
+      if self.claimed_by != None and not self.holds_claim(max_age_sec):
+         raise JobReleased('Job %s was released from worker %s' % (self.uid, self.claimed_by))
+      cancelled = self.cancel_requested(max_age_sec)
+      if cancelled and not status in ['Done', 'Error']:
+         raise JobCancelled('Job %s was cancelled' % self.uid)
+      # the failure a cancellation ends in
+      if cancelled and status == 'Error': status = 'Cancelled'
+      if self.aux_progress_callback != None:
+         # hooks treat a cancelled job as failed, they run before the status
+         # is published and may turn it into a failure, returning the
+         # (status, text) to publish instead
+         override = self.aux_progress_callback(percentage, text, 
+            'Error' if status == 'Cancelled' else status)
+         if override != None: status, text = override
       if not status == 'Error':
          self.logger.info('JobProgress:%d %s' % (percentage, text))
       else:
@@ -735,8 +1217,11 @@ class JobContext():
       self.progress_percentage = percentage
       self.progress_text = text
       self.save()
-      if self.aux_progress_callback != None:
-         self.aux_progress_callback(percentage, text, status)
+      progressbus.publish(self.uid, status, percentage, text)
+      if progressbus.is_terminal(status): 
+         admission.job_finished(self.uid)
+         logpipe.release(self.log_path)
+         self.record_usage()
 
    def mark_done(self):
       self.update_progress(100, 'Done', 'Done')
@@ -744,12 +1229,41 @@ class JobContext():
    def remove(self):
       db = persistence.db()
       c = db.cursor()
+      logpipe.release(self.log_path)
       try: shutil.rmtree(self.work_dir)
       except: pass
       c.execute('DELETE FROM JOB WHERE UID=?', [self.uid])
       db.commit()
+      admission.job_finished(self.uid)
       logging.info('Removed job %s' % self.uid)
    
+   # marks the job as used now, measuring its work dir unless size=False
+   def record_usage(self, size=True):
+      db = persistence.db()
+      c = db.cursor()
+      now = str(datetime.datetime.now())
+      if size:
+         c.execute('UPDATE JOB SET work_dir_size=?, last_accessed=? WHERE UID=?',
+            [dir_size(self.work_dir), now, self.uid])
+      else:
+         c.execute('UPDATE JOB SET last_accessed=? WHERE UID=?', [now, self.uid])
+      db.commit()
+   
+   # (uid, work_dir_size) of up to limit finished jobs, least recently used
+   # first, or of those created before created_before
+   @classmethod
+   def get_finished(cls, limit, created_before=None):
+      c = persistence.cursor()
+      if created_before == None:
+         c.execute("""SELECT uid, work_dir_size FROM JOB
+                   WHERE status IN ('Done', 'Error', 'Cancelled')
+                   ORDER BY last_accessed LIMIT ?""", [limit])
+      else:
+         c.execute("""SELECT uid, work_dir_size FROM JOB
+                   WHERE status IN ('Done', 'Error', 'Cancelled') AND created_on<?
+                   LIMIT ?""", [created_before, limit])
+      return c.fetchall()
+   
    def save(self):
       db = persistence.db()
       c = db.cursor()
@@ -778,15 +1292,17 @@ class JobContext():
                classifier_uid,
                status,
                progress_percentage,
-               progress_text)
-               VALUES (?,?,?,?,?,?,?)""",
+               progress_text,
+               last_accessed)
+               VALUES (?,?,?,?,?,?,?,?)""",
                [self.uid, 
                self.dir_name, 
                self.created_on, 
                self.classifier_uid,
                self.status,
                self.progress_percentage,
-               self.progress_text])
+               self.progress_text,
+               self.created_on])
             db.commit()
          except: 
             db.rollback()
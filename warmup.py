@@ -0,0 +1,80 @@
+from threading import Thread
+import Queue
+import datetime
+import logging
+
+import config
+import persistence
+import model_registry
+import store
+import jobqueue
+
+# warms up the models of classifiers in the background, see
+# model_registry.warm(): all enabled ones by recent usage at startup, and
+# single ones as they are fetched or enabled; in-memory models are loaded by
+# the processes running jobs, resource files are pre-read once, by the server,
+# into the page cache all processes share
+
+class WarmupThread(Thread):
+
+   def __init__(self, budget_mb, usage_days):
+      Thread.__init__(self)
+      self.setDaemon(True)
+      self.queue = Queue.Queue()
+      self.budget = budget_mb*1024*1024
+      self.usage_days = usage_days
+
+   def run(self):
+      while True:
+         classifier_uid = self.queue.get()
+         try:
+            if classifier_uid == None: self.warm_all()
+            else: self.warm(store.Classifier.get(classifier_uid))
+         except Exception as e:
+            logging.exception('Warm-up failed')
+
+   def warm(self, classifier, evict=True):
+      if classifier == None or not classifier.enabled or not classifier.trained(): return None
+      if model_registry.capabilities(classifier.model_type)['supports_warm']:
+         if jobqueue.dispatching(): return None
+      elif jobqueue.in_worker(): return None
+      resources = classifier.get_resource_paths()
+      size = model_registry.read_size(resources)
+      return model_registry.warm(classifier.uid, classifier.model_type, classifier.meta,
+         resources, size, self.budget, evict)
+
+   # jobs and the latest job by classifier within usage_days
+   def get_usage(self):
+      since = str(datetime.datetime.now() - datetime.timedelta(days=self.usage_days))
+      c = persistence.cursor()
+      c.execute("""SELECT classifier_uid, COUNT(*), MAX(created_on) FROM JOB
+                   WHERE created_on>? GROUP BY classifier_uid""", [since])
+      return dict((row[0], (row[1], row[2])) for row in c.fetchall())
+
+   # warms the classifiers used most first, and the latest trained ones of
+   # those not used, as long as they fit in the budget
+   def warm_all(self):
+      usage = self.get_usage()
+      classifiers = [classifier for classifier in store.Classifier.get_all()
+         if classifier.enabled and classifier.trained()]
+      classifiers.sort(key = lambda classifier: 
+         (usage.get(classifier.uid, (0, ''))[0], 
+         usage.get(classifier.uid, (0, ''))[1],
+         classifier.finished_on), reverse=True)
+      warmed = 0
+      for classifier in classifiers:
+         if self.warm(classifier, evict=False) != None: warmed += 1
+      logging.info('Warm-up kept %d of %d classifiers warm' % (warmed, len(classifiers)))
+
+_thread = None
+
+# starts warming up all enabled classifiers
+def start():
+   global _thread
+   _thread = WarmupThread(config.MODEL_WARM_BUDGET_MB, config.PREWARM_USAGE_DAYS)
+   _thread.start()
+   _thread.queue.put(None)
+
+# warms up a classifier once the ones before it are, if warm-up is on
+def request(classifier_uid):
+   if _thread != None: _thread.queue.put(classifier_uid)
@@ -0,0 +1,170 @@
+from threading import Thread
+import subprocess
+import time
+import logging
+import sys
+import os
+
+import config
+import store
+import jobqueue
+import model_registry
+import warmup
+
+# a worker process claims jobs from the queue in classr.db and runs up to
+# config.PARALLEL_JOBS of them at a time; the server starts and supervises
+# config.WORKER_PROCESSES of them
+
+def _run_classify(job, payload):
+   classifier = store.Classifier.get(payload['classifier_uid'])
+   if classifier == None: raise Exception('Classifier %s not found' % payload['classifier_uid'])
+   classifier.classify(job,
+      payload['in_csv'],
+      payload['in_desc_col'],
+      payload['in_res_col'],
+      payload['out_csv'],
+      payload['out_class_col'])
+
+def _run_pasir(job, payload):
+   # only workers running PASIR jobs need the JVM
+   import pasir
+   pasir.run_payload(job, payload)
+
+_handlers = {
+   'classify': _run_classify,
+   'pasir': _run_pasir
+}
+
+# fails the records a job keeps outside of classr.db, if any
+def abandon(kind, payload, text):
+   if kind == 'pasir':
+      import pasir
+      pasir.abandon_payload(payload, text)
+
+def run_job(job_uid, kind, payload, worker=None):
+   job = store.JobContext.get(job_uid)
+   if job == None:
+      logging.warning('Skipping queued job %s, it has been deleted' % job_uid)
+      return
+   if job.cancel_requested():
+      job.cancel(started=False)
+      abandon(kind, payload, 'Cancelled')
+      return
+   job.logger.info('Claimed by worker %s' % jobqueue.worker_id())
+   # results are only written while the claim holds
+   job.claimed_by = worker
+   try:
+      _handlers[kind](job, payload)
+   except store.JobReleased as e:
+      job.logger.warning('Dropping the results, the job was released from worker %s' % worker)
+   except Exception as e:
+      job.logger.exception('Job failed')
+      job.update_progress(100, str(e), 'Error')
+
+
+class WorkerThread(Thread):
+
+   def __init__(self, worker):
+      Thread.__init__(self)
+      self.worker = worker
+      self.setDaemon(True)
+
+   def run(self):
+      while True:
+         try:
+            claimed = jobqueue.claim(self.worker)
+         except Exception as e:
+            logging.exception('Worker %s failed to claim a job' % self.worker)
+            claimed = None
+         if claimed == None:
+            time.sleep(config.QUEUE_POLL_INTERVAL_SEC)
+            continue
+         job_uid, kind, payload = claimed
+         try:
+            run_job(job_uid, kind, payload, self.worker)
+         except store.JobReleased as e:
+            logging.warning('Worker %s lost job %s' % (self.worker, job_uid))
+         except Exception as e:
+            logging.exception('Worker %s failed running job %s' % (self.worker, job_uid))
+         finally:
+            jobqueue.finish(job_uid, self.worker)
+
+
+class WorkerSupervisorThread(Thread):
+# keeps config.WORKER_PROCESSES worker processes running, restarting those
+# that exit, killing those that stop sending heartbeats, and releasing the
+# jobs of dead workers
+
+   def __init__(self, processes):
+      Thread.__init__(self)
+      self.processes = [None] * processes
+      self.setDaemon(True)
+      self.interval_sec = config.WORKER_HEARTBEAT_SEC
+
+   def run(self):
+      logging.info('Setting up %d worker processes' % len(self.processes))
+      while True:
+         try:
+            dead = []
+            # a hung worker is killed before its jobs are handed to others
+            stale = jobqueue.stale_workers(6*config.WORKER_HEARTBEAT_SEC)
+            for process in self.processes:
+               if process != None and process.poll() == None and jobqueue.worker_id(process.pid) in stale:
+                  logging.warning('Worker process %d missed its heartbeats, killing it' % process.pid)
+                  process.kill()
+                  process.wait()
+            for i, process in enumerate(self.processes):
+               if process != None and process.poll() == None: continue
+               if process != None:
+                  logging.warning('Worker process %d exited with code %d, restarting' %
+                     (process.pid, process.returncode))
+                  dead.append(jobqueue.worker_id(process.pid))
+               self.processes[i] = self.spawn(i)
+            self.release(dead)
+         except Exception as e:
+            logging.exception('Worker supervisor encountered an error')
+         time.sleep(self.interval_sec)
+
+   def spawn(self, index):
+      env = dict(os.environ)
+      env['CLASSR_WORKER'] = str(index)
+      return subprocess.Popen(
+         [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'worker.py')],
+         env = env)
+
+   def release(self, dead):
+      failed = jobqueue.release(dead, 6*config.WORKER_HEARTBEAT_SEC)
+      for job_uid, kind, payload in failed:
+         logging.warning('Failing job %s of a dead worker' % job_uid)
+         job = store.JobContext.get(job_uid)
+         if job != None:
+            try: job.update_progress(100, 'Worker process died', 'Error')
+            except: logging.exception('Failed to fail job %s' % job_uid)
+         try: abandon(kind, payload, 'Worker process died')
+         except: logging.exception('Failed to fail the records of job %s' % job_uid)
+
+
+def serve():
+   jobqueue.become_worker()
+   worker = jobqueue.worker_id()
+   parent_pid = os.getppid()
+   logging.info('Worker %s running %d jobs at a time' % (worker, config.PARALLEL_JOBS))
+   model_registry.preload(config.PRELOAD_MODEL_TYPES)
+   for i in range(config.PARALLEL_JOBS):
+      WorkerThread(worker).start()
+   # models loaded into memory are the worker's own
+   if config.PREWARM_MODELS: warmup.start()
+   if config.PREWARM:
+      import pasir
+      prewarm_thread = Thread(target = pasir.prewarm)
+      prewarm_thread.setDaemon(True)
+      prewarm_thread.start()
+   # stop along with the server
+   while os.getppid() == parent_pid:
+      try: jobqueue.heartbeat(worker)
+      except: logging.exception('Worker %s failed to send its heartbeat' % worker)
+      time.sleep(config.WORKER_HEARTBEAT_SEC)
+   logging.info('Worker %s exits, its server is gone' % worker)
+
+if __name__ == '__main__':
+   serve()
@@ -0,0 +1,50 @@
+import os
+
+import xgbm.classifier
+
+# model type plugin of the XGBM (pv+bow) classifier, see model_registry
+
+def classify(job_context,
+             meta,
+             resources,
+             in_csv,
+             in_desc_col,
+             in_res_col,
+             out_csv,
+             out_class_col,
+             capabilities):
+   # parametrize call for the XGBM (pv+bow) classifier
+   xgbm.classifier.run(
+      in_csv                 = in_csv,
+      in_voc                 = os.path.join(resources['vocab'], 'vocab.txt'),
+      out_csv                = out_csv,
+      in_model               = os.path.join(resources['model'], 'model.dat'),
+      pv_weights_dir         = resources['pv'],
+      vec_desc_dm            = os.path.join(job_context.work_dir, 'vec-desc-dm.csv'),
+      vec_desc_dbow          = os.path.join(job_context.work_dir, 'vec-desc-dbow.csv'),
+      vec_res_dm             = os.path.join(job_context.work_dir, 'vec-res-dm.csv'),
+      vec_res_dbow           = os.path.join(job_context.work_dir, 'vec-res-dbow.csv'),
+      pv_desc_txt            = os.path.join(job_context.work_dir, 'desc.txt'),
+      pv_res_txt             = os.path.join(job_context.work_dir, 'res.txt'),
+      desc_col               = in_desc_col,
+      res_col                = in_res_col,
+      clean_desc_out_col     = 'clean.description',
+      clean_res_out_col      = 'clean.resolution',
+      clean_combined_out_col = 'clean.combined',
+      ticketclass_out_col    = out_class_col,
+      dm_dim                 = 200,
+      dm_objective           = 'negative',
+      dm_negative_samples    = 10,
+      dm_window              = 4,
+      dm_subsample           = 0.1,
+      dm_iters               = 30,
+      dbow_dim               = 200,
+      dbow_objective         = 'negative',
+      dbow_negative_samples  = 5,
+      dbow_window            = 6,
+      dbow_subsample         = 0,
+      dbow_iters             = 30,
+      threads                = capabilities['threads'],
+      max_ngram              = 1,
+      orig_input             = '',
+      job_context            = job_context)